@@ -1,4 +1,4 @@
-from Adafruit_BBIO import GPIO
+from hardware import GPIO
 import logging
 
 __author__ = 'marcus'
@@ -0,0 +1,123 @@
+# coding=utf-8
+"""
+Turns G2/G3 arcs into straight moves.
+
+The length of the segments adapts to the arc: it is as long as possible without leaving the arc by more than the
+chordal tolerance. But it never gets so short that the serial line cannot keep up - at the current feed rate the
+T-Bone must not get more moves per second than we can send it. Still every arc gets at least one segment per eighth of
+a circle - for tiny radii at high speed the arc is rather printed slower than not at all.
+"""
+from math import atan2, ceil, cos, pi, sin, sqrt
+
+__author__ = 'marcus'
+
+_default_chordal_tolerance = 0.01  # mm
+# 38400 baud are ~3840 bytes/s - with about 120 bytes per move that are 32 moves/s
+_default_moves_per_second = 30.0
+_default_min_segment_length = 0.1  # mm
+# the longest angle a segment may cover - so a small arc at full speed is still an arc
+_max_segment_angle = pi / 4
+# arcs where start & end are closer than this are full circles
+_full_circle_epsilon = 1e-6
+_axis_names = ('x', 'y', 'z', 'e')
+
+
+def linearize_arc(start, target, clockwise, feed_rate=None, chordal_tolerance=_default_chordal_tolerance,
+                  moves_per_second=_default_moves_per_second, min_segment_length=_default_min_segment_length):
+    """
+    Returns the list of move target positions which follow the arc in the XY plane from start to target.
+    start: the current position of all axis
+    target: the decoded G2/G3 arguments - x, y, z, e like G1 and either the center offset i, j or the radius r
+    feed_rate: the speed of the arc in mm/s - the segments get slower if the serial line could not keep up with them
+    """
+    end = dict((axis_name, target.get(axis_name, start[axis_name])) for axis_name in _axis_names)
+    if 'i' in target or 'j' in target:
+        center_x = start['x'] + target.get('i', 0.0)
+        center_y = start['y'] + target.get('j', 0.0)
+    elif 'r' in target:
+        center_x, center_y = _center_from_radius(start, end, target['r'], clockwise)
+    else:
+        raise ArcError("An arc needs either I & J or R")
+    radius = sqrt((start['x'] - center_x) ** 2 + (start['y'] - center_y) ** 2)
+    if radius == 0:
+        raise ArcError("The arc has no radius")
+    start_angle = atan2(start['y'] - center_y, start['x'] - center_x)
+    end_angle = atan2(end['y'] - center_y, end['x'] - center_x)
+    travel = end_angle - start_angle
+    if abs(end['x'] - start['x']) < _full_circle_epsilon and abs(end['y'] - start['y']) < _full_circle_epsilon:
+        travel = 0.0
+    if clockwise:
+        if travel >= 0:
+            travel -= 2 * pi
+    elif travel <= 0:
+        travel += 2 * pi
+
+    segment_length = segment_length_for(radius, feed_rate, chordal_tolerance, moves_per_second, min_segment_length)
+    segments = max(1, int(ceil(abs(travel) / _max_segment_angle)), int(ceil(abs(travel) * radius / segment_length)))
+    target_speed = target.get('target_speed')
+    if feed_rate and moves_per_second:
+        # the chord is what the machine moves
+        chord_length = 2 * radius * sin(abs(travel) / segments / 2)
+        if chord_length * moves_per_second < feed_rate:
+            target_speed = chord_length * moves_per_second
+
+    moves = []
+    for segment in range(1, segments):
+        fraction = float(segment) / segments
+        angle = start_angle + travel * fraction
+        move = {
+            'type': 'move',
+            'x': center_x + radius * cos(angle),
+            'y': center_y + radius * sin(angle),
+            'z': start['z'] + (end['z'] - start['z']) * fraction,
+            'e': start['e'] + (end['e'] - start['e']) * fraction
+        }
+        moves.append(move)
+    # the last one ends exactly where the g code wanted it
+    last_move = {'type': 'move'}
+    last_move.update(end)
+    moves.append(last_move)
+    if target_speed:
+        for move in moves:
+            move['target_speed'] = target_speed
+    return moves
+
+
+def segment_length_for(radius, feed_rate, chordal_tolerance=_default_chordal_tolerance,
+                       moves_per_second=_default_moves_per_second, min_segment_length=_default_min_segment_length):
+    if chordal_tolerance < radius:
+        # the chord whose middle is chordal_tolerance away from the arc
+        length = 2 * sqrt(chordal_tolerance * (2 * radius - chordal_tolerance))
+    else:
+        length = 2 * radius
+    if feed_rate and moves_per_second:
+        length = max(length, float(feed_rate) / moves_per_second)
+    return max(length, min_segment_length)
+
+
+def _center_from_radius(start, end, radius, clockwise):
+    # see the grbl arc implementation: a negative radius selects the arc longer than a half circle
+    delta_x = end['x'] - start['x']
+    delta_y = end['y'] - start['y']
+    distance_sqr = delta_x * delta_x + delta_y * delta_y
+    if distance_sqr == 0:
+        raise ArcError("An arc with a radius cannot be a full circle")
+    h_x2_div_d = 4.0 * radius * radius - distance_sqr
+    if h_x2_div_d < 0:
+        raise ArcError("The radius %s is too small to reach the end of the arc" % radius)
+    h_x2_div_d = -sqrt(h_x2_div_d) / sqrt(distance_sqr)
+    if not clockwise:
+        h_x2_div_d = -h_x2_div_d
+    if radius < 0:
+        h_x2_div_d = -h_x2_div_d
+    center_x = start['x'] + 0.5 * (delta_x - (delta_y * h_x2_div_d))
+    center_y = start['y'] + 0.5 * (delta_y + (delta_x * h_x2_div_d))
+    return center_x, center_y
+
+
+class ArcError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
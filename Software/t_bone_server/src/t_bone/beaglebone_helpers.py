@@ -1,6 +1,8 @@
 from flask import logging
 import os
 
+from firmware_simulator import FirmwareSimulator
+import hardware
 from printer import Printer
 
 __author__ = 'marcus'
@@ -10,6 +12,7 @@ _reset_pin = "P9_12"
 _default_serial_port = "/dev/ttyO1"
 _serial_port_config_file = "/sys/devices/bone_capemgr.%s/slots"
 _create_serial_port_script = "echo BB-UART1 > %s"
+_firmware_simulator = None
 
 ALLOWED_EXTENSIONS = {'gcode'}
 
@@ -27,13 +30,26 @@ def check_for_serial_port():
 
 
 def create_printer():
-    serial_port_ = check_for_serial_port()
-    printer = Printer(serial_port=serial_port_, reset_pin=_reset_pin)
+    if hardware.is_simulated():
+        # no cape, no T-Bone - talk to a simulated one
+        serial_port_ = get_firmware_simulator().serial_port
+        printer = Printer(serial_port=serial_port_, reset_pin=None)
+    else:
+        serial_port_ = check_for_serial_port()
+        printer = Printer(serial_port=serial_port_, reset_pin=_reset_pin)
 
     #basically the printer is just a bunch of stuff
     return printer
 
 
+def get_firmware_simulator():
+    global _firmware_simulator
+    if not _firmware_simulator:
+        _logger.info("Starting firmware simulator")
+        _firmware_simulator = FirmwareSimulator()
+    return _firmware_simulator
+
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
@@ -0,0 +1,474 @@
+# coding=utf-8
+"""
+Measures how fast G-code gets from the file to the serial line.
+
+Synthetic G-code corpora (long straight infill, dense arcs of tiny segments, retractions, z-hops and vase mode) are
+fed line by line through read_gcode_to_printer to the PrintQueue and executed by the Printer, just like a
+GCodePrintThread does. The machine is either a fake one which just counts what would be written to the serial port
+or the firmware simulator.
+
+For each corpus it reports the G-code lines per second, the executed moves per second and the serial bytes per move.
+The peak memory is reported once for the whole process - it only ever grows from corpus to corpus. The results can be
+saved as JSON to compare changes:
+
+    PYTHONPATH=src python -m t_bone.benchmark --machine=fake --moves=5000 --output=before.json
+"""
+from copy import deepcopy
+import getopt
+import json
+import logging
+from math import cos, pi, sin
+import resource
+import sys
+import time
+
+from firmware_simulator import FirmwareSimulator
+from gcode_interpreter import read_gcode_to_printer
+import hardware
+from machine import MachineCommand, encode_command
+from printer import Printer
+import tracing
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+FAKE_MACHINE = 'fake'
+SIMULATED_MACHINE = 'simulated'
+_default_moves = 2000
+_idle_wait_time = 0.01
+
+# the trinamic printer - w/o encoder to keep the machine simple
+BENCHMARK_CONFIG = {
+    "x-axis": {
+        "motor": 2,
+        "current": 1.2,
+        "steps-per-mm": 1280,
+        "max-speed": 200,
+        "max-acceleration": 3000.0,
+        "bow-acceleration": 1000.0,
+        "time-reference": "time",
+        "inverted": False,
+        "end-stops": {
+            "left": {
+                "polarity": "virtual",
+                "position": 220
+            },
+            "right": {
+                "polarity": "negative"
+            }
+        },
+        "home-speed": 100.0,
+        "home-acceleration": 1000.0,
+        "home-precision-speed": 5
+    },
+    "y-axis": {
+        "motor": 1,
+        "current": 1.2,
+        "steps-per-mm": 1280,
+        "max-speed": 200,
+        "max-acceleration": 3000.0,
+        "bow-acceleration": 1000.0,
+        "time-reference": "time",
+        "end-stops": {
+            "left": {
+                "polarity": "negative"
+            },
+            "right": {
+                "polarity": "virtual",
+                "position": 200
+            }
+        },
+        "home-speed": 100.0,
+        "home-acceleration": 1000.0,
+        "home-precision-speed": 5
+    },
+    "z-axis": {
+        "motors": [4, 5],
+        "current": 0.5,
+        "inverted": {
+            "4": True,
+            "5": True
+        },
+        "steps-per-mm": 32000.0,
+        "max-speed": 10,
+        "max-acceleration": 100.0,
+        "time-reference": "clock signal",
+        "end-stops": {
+            "left": {
+                "polarity": "negative",
+                "motor": 4
+            },
+            "right": {
+                "polarity": "virtual",
+                "position": 20.2
+            }
+        },
+        "home-speed": 2,
+        "home-acceleration": 125.0,
+        "home-precision-speed": 1,
+        "home-retract": 3
+    },
+    "printer": {
+        "print-queue": {
+            "min-length": 20,
+            "max-length": 30
+        },
+        "homing-timeout": 15,
+        "home-retract": 10,
+        "heated-bed": {
+            "output": 2,
+            "type": "2 Point",
+            "sensor-type": "B57560G104F",
+            "hysteresis": 1
+        },
+        "default-speed": 10,
+        "fan-duty-cycle": 100.0,
+        "fan-frequency": 500
+    },
+    "extruder": {
+        "motor": 3,
+        "current": 0.5,
+        "steps-per-mm": 11792.23,
+        "step-scaling-correction": 0.3,
+        "max-speed": 300,
+        "max-acceleration": 10,
+        "bow-acceleration": 10,
+        "time-reference": "time",
+        "inverted": False,
+        "heater": {
+            "output": 1,
+            "type": "PID",
+            "sensor-type": "j-head",
+            "max-duty-cycle": 60,
+            "pid-config": {
+                "Kp": 17.0,
+                "Ki": 0.1,
+                "Kd": 0
+            }
+        }
+    }
+}
+
+_gcode_header = ["G21 ; metric", "G90 ; absolute positions", "M82 ; absolute extrusion", "G92 E0"]
+_extrusion_per_mm = 0.033
+
+
+def straight_infill(moves):
+    """
+    long zig zag lines over the bed
+    """
+    lines = list(_gcode_header)
+    extrusion = 0.0
+    for i in range(moves):
+        y = 20.0 + (i % 300) * 0.4
+        x = 20.0 if i % 2 else 180.0
+        extrusion += 160.0 * _extrusion_per_mm
+        lines.append("G1 X%.3f Y%.3f E%.5f F4800" % (x, y, extrusion))
+    return lines
+
+
+def dense_arcs(moves, radius=5.0, segment_length=0.1):
+    """
+    circles made of tiny segments - like sliced arcs
+    """
+    lines = list(_gcode_header)
+    segments_per_circle = int(2 * pi * radius / segment_length)
+    extrusion = 0.0
+    for i in range(moves):
+        angle = 2 * pi * (i % segments_per_circle) / segments_per_circle
+        extrusion += segment_length * _extrusion_per_mm
+        lines.append("G1 X%.3f Y%.3f E%.5f F2400" % (100.0 + radius * cos(angle), 100.0 + radius * sin(angle),
+                                                      extrusion))
+    return lines
+
+
+def arc_moves(moves, radius=5.0):
+    """
+    the circles of dense_arcs as G3 quarter circles - like arc welded g code
+    """
+    lines = list(_gcode_header)
+    lines.append("G1 X%.3f Y%.3f F2400" % (100.0 + radius, 100.0))
+    quarter_extrusion = pi * radius / 2 * _extrusion_per_mm
+    extrusion = 0.0
+    for i in range(moves):
+        angle = pi / 2 * (i % 4)
+        end_angle = angle + pi / 2
+        extrusion += quarter_extrusion
+        lines.append("G3 X%.3f Y%.3f I%.3f J%.3f E%.5f F2400" % (
+            100.0 + radius * cos(end_angle), 100.0 + radius * sin(end_angle), -radius * cos(angle),
+            -radius * sin(angle), extrusion))
+    return lines
+
+
+def retractions(moves, retraction=1.5):
+    """
+    short extrusions with a retraction & travel in between
+    """
+    lines = list(_gcode_header)
+    extrusion = 0.0
+    for i in range(moves // 4):
+        x = 50.0 + (i % 50) * 2.0
+        y = 50.0 + (i // 50 % 50) * 2.0
+        lines.append("G1 X%.3f Y%.3f F6000" % (x, y))
+        lines.append("G1 E%.5f F1800" % extrusion)
+        extrusion += 1.0 * _extrusion_per_mm
+        lines.append("G1 X%.3f Y%.3f E%.5f F1800" % (x + 1.0, y, extrusion))
+        lines.append("G1 E%.5f F1800" % (extrusion - retraction))
+    return lines
+
+
+def z_hops(moves, hop=0.4, layer_height=0.2):
+    """
+    travels lifting the nozzle before and lowering it after
+    """
+    lines = list(_gcode_header)
+    z = layer_height
+    for i in range(moves // 3):
+        x = 20.0 + (i % 16) * 10.0
+        y = 20.0 + (i // 16 % 16) * 10.0
+        lines.append("G1 Z%.3f F600" % (z + hop))
+        lines.append("G1 X%.3f Y%.3f F6000" % (x, y))
+        lines.append("G1 Z%.3f F600" % z)
+    return lines
+
+
+def vase_mode(moves, radius=30.0, segments_per_layer=120, layer_height=0.2):
+    """
+    a continuous spiral - every move goes up a bit
+    """
+    lines = list(_gcode_header)
+    extrusion = 0.0
+    segment_length = 2 * pi * radius / segments_per_layer
+    for i in range(moves):
+        angle = 2 * pi * (i % segments_per_layer) / segments_per_layer
+        z = layer_height * (1.0 + float(i) / segments_per_layer)
+        extrusion += segment_length * _extrusion_per_mm
+        lines.append("G1 X%.3f Y%.3f Z%.4f E%.5f F1800" % (100.0 + radius * cos(angle), 100.0 + radius * sin(angle),
+                                                            z, extrusion))
+    return lines
+
+
+CORPORA = {
+    'straight-infill': straight_infill,
+    'dense-arcs': dense_arcs,
+    'arc-moves': arc_moves,
+    'retractions': retractions,
+    'z-hops': z_hops,
+    'vase-mode': vase_mode
+}
+# in a sensible order for the report
+_corpus_names = ('straight-infill', 'dense-arcs', 'arc-moves', 'retractions', 'z-hops', 'vase-mode')
+
+
+class CountingConnection(object):
+    """
+    Stands in for the serial connection of a machine: it counts what would have been written and acknowledges
+    everything with an empty command buffer.
+    """
+
+    def __init__(self):
+        self.commands_sent = 0
+        self.moves_sent = 0
+        self.bytes_sent = 0
+        self.move_bytes_sent = 0
+
+    def send_command(self, command, timeout=None, trace=None):
+        length = len(encode_command(command))
+        if trace:
+            trace.stamp(tracing.WRITTEN)
+            trace.stamp(tracing.ACKNOWLEDGED)
+        self.commands_sent += 1
+        self.bytes_sent += length
+        if command.command_number == 10:
+            self.moves_sent += 1
+            self.move_bytes_sent += length
+            return MachineCommand("0,0,40,1")
+        elif command.command_number == 31:
+            return MachineCommand("31,0,40")
+        return MachineCommand("0,0")
+
+    def stop(self):
+        pass
+
+
+class Benchmark(object):
+    def __init__(self, machine_type=FAKE_MACHINE, config=None, baud_rate=None, speedup=1000.0):
+        """
+        machine_type: 'fake' for a counting machine, 'simulated' for the firmware simulator
+        baud_rate & speedup: of the firmware simulator
+        """
+        hardware.select_backend(hardware.SIMULATED)
+        if not config:
+            config = BENCHMARK_CONFIG
+        self.machine_type = machine_type
+        self.firmware_simulator = None
+        if machine_type == SIMULATED_MACHINE:
+            self.firmware_simulator = FirmwareSimulator(baud_rate=baud_rate, speedup=speedup)
+            self.printer = Printer(serial_port=self.firmware_simulator.serial_port, reset_pin=None)
+            self.printer.connect()
+        elif machine_type == FAKE_MACHINE:
+            self.printer = Printer(serial_port=None, reset_pin=None)
+            self.printer.machine.machine_connection = CountingConnection()
+        else:
+            raise BenchmarkError("Unknown machine %s" % machine_type)
+        self.printer.configure(deepcopy(config))
+
+        self._print_queue = None
+        self.moves_executed = 0
+        # count every movement the printer thread executes
+        execute_movement = self.printer.execute_movement
+
+        def counting_execute_movement(movement):
+            try:
+                execute_movement(movement)
+                if movement['type'] == 'move':
+                    self.moves_executed += 1
+            finally:
+                # the execution queue knows when all of its movements are done
+                self._print_queue.execution_queue.task_done()
+
+        self.printer.execute_movement = counting_execute_movement
+
+    def run(self, name, lines):
+        moves_before = self.moves_executed
+        bytes_before, serial_moves_before = self._serial_statistics()
+        start = time.time()
+        self._print_queue = self.printer.create_print_queue()
+        self.printer.start_print(self._print_queue)
+        for line in lines:
+            read_gcode_to_printer(line, self.printer)
+        self.printer.finish_print()
+        self._wait_for_execution()
+        duration = time.time() - start
+        moves = self.moves_executed - moves_before
+        bytes_after, serial_moves_after = self._serial_statistics()
+        serial_moves = serial_moves_after - serial_moves_before
+        result = {
+            'corpus': name,
+            'machine': self.machine_type,
+            'lines': len(lines),
+            'moves': moves,
+            'duration': duration,
+            'lines_per_second': len(lines) / duration,
+            'moves_per_second': moves / duration,
+            'serial_bytes': bytes_after - bytes_before,
+            'serial_bytes_per_move': float(bytes_after - bytes_before) / serial_moves if serial_moves else 0.0
+        }
+        _logger.info("Benchmark %s: %s", name, result)
+        return result
+
+    def stop(self):
+        self.printer.stop()
+        if self.firmware_simulator:
+            self.firmware_simulator.stop()
+
+    def _wait_for_execution(self):
+        # finish_print returns as soon as the last movement got picked up - not once it is executed
+        self._print_queue.execution_queue.join()
+        # the simulated firmware only accepts the next print once it has worked through its queue
+        while self.firmware_simulator and self.firmware_simulator.in_motion():
+            time.sleep(_idle_wait_time)
+
+    def _serial_statistics(self):
+        if self.firmware_simulator:
+            return self.firmware_simulator.bytes_received, self.firmware_simulator.moves_received
+        connection = self.printer.machine.machine_connection
+        return connection.bytes_sent, connection.moves_sent
+
+
+def run_benchmarks(corpora=_corpus_names, moves=_default_moves, machine_type=FAKE_MACHINE, baud_rate=None,
+                   speedup=1000.0, config=None):
+    benchmark = Benchmark(machine_type=machine_type, config=config, baud_rate=baud_rate, speedup=speedup)
+    results = []
+    try:
+        for name in corpora:
+            results.append(benchmark.run(name, CORPORA[name](moves)))
+    finally:
+        benchmark.stop()
+    return results
+
+
+def peak_memory():
+    # of the whole process, on linux in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _print_results(results, process_peak_memory):
+    print "%-16s %8s %8s %10s %10s %12s" % (
+        "corpus", "lines", "moves", "lines/s", "moves/s", "bytes/move")
+    for result in results:
+        print "%-16s %8d %8d %10.1f %10.1f %12.1f" % (
+            result['corpus'], result['lines'], result['moves'], result['lines_per_second'],
+            result['moves_per_second'], result['serial_bytes_per_move'])
+    print "peak memory of the process: %d kB" % process_peak_memory
+
+
+class BenchmarkError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def main(argv=None):
+    usage = "usage: benchmark.py [--machine=fake|simulated] [--moves=%s] [--corpus=name]* [--baud=38400] " \
+            "[--speedup=1000] [--coalesce] [--output=results.json]" % _default_moves
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "m:n:c:b:s:o:Ch",
+                                   ["machine=", "moves=", "corpus=", "baud=", "speedup=", "output=", "coalesce",
+                                    "help"])
+    except getopt.error, msg:
+        print >> sys.stderr, msg
+        print >> sys.stderr, usage
+        return 2
+    machine_type = FAKE_MACHINE
+    moves = _default_moves
+    corpora = []
+    baud_rate = None
+    speedup = 1000.0
+    output = None
+    config = None
+    for opt, value in opts:
+        if opt in ("-h", "--help"):
+            print usage
+            print "corpora: %s" % ", ".join(_corpus_names)
+            return 0
+        elif opt in ("-m", "--machine"):
+            machine_type = value
+        elif opt in ("-n", "--moves"):
+            moves = int(value)
+        elif opt in ("-c", "--corpus"):
+            if value not in CORPORA:
+                print >> sys.stderr, "unknown corpus %s, use one of %s" % (value, ", ".join(_corpus_names))
+                return 2
+            corpora.append(value)
+        elif opt in ("-b", "--baud"):
+            baud_rate = int(value)
+        elif opt in ("-s", "--speedup"):
+            speedup = float(value)
+        elif opt in ("-o", "--output"):
+            output = value
+        elif opt in ("-C", "--coalesce"):
+            config = deepcopy(BENCHMARK_CONFIG)
+            config['printer']['segment-coalescing'] = True
+    if not corpora:
+        corpora = _corpus_names
+    # the printer is pretty chatty - and logging would be measured too
+    logging.basicConfig(level=logging.WARN)
+    results = run_benchmarks(corpora=corpora, moves=moves, machine_type=machine_type, baud_rate=baud_rate,
+                             speedup=speedup, config=config)
+    process_peak_memory = peak_memory()
+    _print_results(results, process_peak_memory)
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump({'corpora': results, 'peak_memory': process_peak_memory}, output_file, indent=4,
+                      separators=(',', ': '))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
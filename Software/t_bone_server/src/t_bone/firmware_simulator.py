@@ -0,0 +1,396 @@
+# coding=utf-8
+"""
+Simulates the T-Bone arduino firmware on a pseudo terminal.
+
+It speaks the same serial protocol as the ArduinoClient: configuration commands are acknowledged, moves are queued
+in a bounded move queue which drains in simulated time according to the trapezoid duration of each move, and a
+keep alive ping with the queue fill is sent every second. Optionally the transfer time of each byte at the UART
+baud rate is emulated too.
+
+Just hand the serial port of the simulator to the machine:
+
+    simulator = FirmwareSimulator()
+    machine = Machine(serial_port=simulator.serial_port)
+"""
+from collections import deque
+import getopt
+import logging
+import os
+import pty
+import sys
+from threading import Thread
+import threading
+import time
+import tty
+
+from helpers import trapezoid_profile
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+# the firmware constants
+COMMAND_QUEUE_LENGTH = 40
+NUMBER_OF_MOTORS = 5
+DEFAULT_COMMAND_BUFFER_DEPTH = NUMBER_OF_MOTORS
+_default_baud_rate = 38400
+_heartbeat_interval = 1.0
+_bits_per_byte = 10  # 8N1 with start & stop bit
+
+# command numbers
+_k_ok = 0
+_k_error = -9
+_k_keep_alive = -128
+
+# motion states
+_no_motion = 0
+_in_motion = 1
+_finishing_motion = 2
+
+
+class FirmwareSimulator(object):
+    def __init__(self, baud_rate=_default_baud_rate, speedup=1.0, queue_length=COMMAND_QUEUE_LENGTH):
+        """
+        baud_rate: emulate the transfer time of the UART, None for no delay
+        speedup: how many simulated seconds pass in one real second, e.g. 10 lets the moves drain 10 times faster
+        """
+        self.baud_rate = baud_rate
+        self.speedup = float(speedup)
+        self.queue_length = queue_length
+        self.master_fd, self._slave_fd = pty.openpty()
+        # no echo, no line handling - just like a serial line
+        tty.setraw(self._slave_fd)
+        self.serial_port = os.ttyname(self._slave_fd)
+        self._write_lock = threading.Lock()
+        self._state_lock = threading.RLock()
+        self._start_time = time.time()
+        # statistics
+        self.commands_received = 0
+        self.moves_received = 0
+        self.moves_executed = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._reset()
+        self.running = True
+        self._listening_thread = Thread(target=self._listen)
+        self._listening_thread.daemon = True
+        self._heartbeat_thread = Thread(target=self._heartbeat)
+        self._heartbeat_thread.daemon = True
+        self._listening_thread.start()
+        # like the firmware after a reset
+        self._send(_k_ok, 0)
+        self._heartbeat_thread.start()
+
+    def stop(self):
+        self.running = False
+        if self._heartbeat_thread.isAlive():
+            self._heartbeat_thread.join()
+        try:
+            os.close(self._slave_fd)
+            os.close(self.master_fd)
+        except OSError:
+            pass
+
+    def queue_count(self):
+        with self._state_lock:
+            self._advance()
+            return self._queue_count
+
+    def in_motion(self):
+        # still moving or still working through the queue after the motion got finished
+        with self._state_lock:
+            self._advance()
+            return self._motion_state != _no_motion
+
+    def position(self, motor):
+        with self._state_lock:
+            self._advance()
+            return self._positions[motor]
+
+    def simulated_time(self):
+        return (time.time() - self._start_time) * self.speedup
+
+    def _reset(self):
+        self._motion_state = _no_motion
+        self._min_buffer_depth = DEFAULT_COMMAND_BUFFER_DEPTH
+        # each entry is a list of moves - the leading motor and its followers
+        self._move_queue = deque()
+        self._queue_count = 0
+        self._busy_until = 0.0
+        self._last_advance = self.simulated_time()
+        self._positions = [0] * (NUMBER_OF_MOTORS + 1)
+
+    def _advance(self):
+        # execute everything from the queue which would have been started until now
+        now = self.simulated_time()
+        while self._busy_until <= now and self._move_queue:
+            if not (self._queue_count > self._min_buffer_depth or self._motion_state == _finishing_motion):
+                break
+            if self._motion_state == _no_motion:
+                break
+            if self._min_buffer_depth != 0 and self._min_buffer_depth > DEFAULT_COMMAND_BUFFER_DEPTH:
+                self._min_buffer_depth = DEFAULT_COMMAND_BUFFER_DEPTH
+            entry = self._move_queue.popleft()
+            self._queue_count -= len(entry)
+            start = max(self._busy_until, self._last_advance)
+            if entry[0]['type'] == 'set_position':
+                self._positions[entry[0]['motor']] = entry[0]['target']
+                continue
+            self._busy_until = start + self._move_duration(entry[0])
+            for move in entry:
+                self._positions[move['motor']] = move['target']
+            self.moves_executed += 1
+        if self._motion_state == _finishing_motion and not self._move_queue and self._busy_until <= now:
+            self._motion_state = _no_motion
+        self._last_advance = now
+
+    def _move_duration(self, move):
+        distance = abs(move['target'] - self._positions[move['motor']])
+        return trapezoid_duration(distance, move['v_start'], move['v_max'], move['v_stop'], move['a_max'])
+
+    def _listen(self):
+        buff = ""
+        while self.running:
+            try:
+                data = os.read(self.master_fd, 1024)
+            except OSError:
+                break
+            if not data:
+                break
+            buff += data
+            while ';' in buff:
+                line, buff = buff.split(';', 1)
+                line = line.strip()
+                if line:
+                    self._wire_delay(len(line) + 1)
+                    self.bytes_received += len(line) + 1
+                    self._handle(line)
+
+    def _heartbeat(self):
+        while self.running:
+            time.sleep(_heartbeat_interval)
+            if self.running:
+                self._send(_k_keep_alive, self.queue_count(), self.queue_length)
+
+    def _wire_delay(self, number_of_bytes):
+        if self.baud_rate:
+            time.sleep(float(number_of_bytes * _bits_per_byte) / self.baud_rate)
+
+    def _send(self, command_number, *arguments):
+        line = ",".join([str(command_number)] + [str(argument) for argument in arguments]) + ";\r\n"
+        self._wire_delay(len(line))
+        with self._write_lock:
+            try:
+                os.write(self.master_fd, line)
+                self.bytes_sent += len(line)
+            except OSError:
+                self.running = False
+
+    def _handle(self, line):
+        parts = line.split(",")
+        try:
+            command_number = int(parts[0])
+            arguments = [_decode_number(part) for part in parts[1:]]
+        except ValueError:
+            _logger.warn("Unable to decode command %s", line)
+            self._send(_k_error, 'U', parts[0])
+            return
+        self.commands_received += 1
+        with self._state_lock:
+            self._advance()
+            handler = _handlers.get(command_number)
+            if handler:
+                handler(self, arguments)
+            else:
+                self._send(_k_error, 'U', command_number)
+
+    def _on_init(self, arguments):
+        self._reset()
+        self._send(_k_ok, 0)
+
+    def _on_configure(self, arguments):
+        # current, encoder, endstops and inverting - nothing to simulate
+        if not arguments or not 0 < arguments[0] <= NUMBER_OF_MOTORS:
+            self._send(_k_error, -1)
+        else:
+            self._send(_k_ok, 0)
+
+    def _on_move(self, arguments):
+        entry = []
+        for index in range(0, len(arguments) - 6, 7):
+            motor = int(arguments[index])
+            if motor == 0:
+                break
+            move_type = int(arguments[index + 2])
+            if move_type not in (ord('s'), ord('w')):
+                self._send(_k_error, -2, move_type)
+                return
+            v_max, a_max, v_start, v_stop = [float(argument) for argument in arguments[index + 3:index + 7]]
+            if v_max <= 0:
+                self._send(_k_error, -3)
+                return
+            if a_max <= 0:
+                self._send(_k_error, -4)
+                return
+            if v_start < 0 or v_start > v_max:
+                self._send(_k_error, -5)
+                return
+            if v_stop < 0 or v_stop > v_max:
+                self._send(_k_error, -6)
+                return
+            entry.append({
+                'type': 'move',
+                'motor': motor,
+                'target': int(arguments[index + 1]),
+                'v_max': v_max,
+                'a_max': a_max,
+                'v_start': v_start,
+                'v_stop': v_stop
+            })
+        if not entry:
+            self._send(_k_error, -1)
+            return
+        if self._queue_count + len(entry) > self.queue_length:
+            self._send(_k_error, -100)
+            return
+        self._move_queue.append(entry)
+        self._queue_count += len(entry)
+        self.moves_received += 1
+        self._advance()
+        if self._motion_state == _in_motion:
+            running = 1
+        else:
+            running = -1
+        self._send(_k_ok, self._queue_count, self.queue_length, running)
+
+    def _on_movement(self, arguments):
+        if not arguments or arguments[0] == 0:
+            if self._motion_state == _in_motion:
+                self._send(11, 1)
+            elif self._motion_state == _finishing_motion:
+                self._send(11, 2)
+            else:
+                self._send(11, -1)
+        elif arguments[0] < 0:
+            if self._motion_state != _in_motion:
+                self._send(_k_error, -1)
+            else:
+                self._send(_k_ok, 0)
+                self._motion_state = _finishing_motion
+                self._min_buffer_depth = 0
+                self._advance()
+        else:
+            if self._motion_state != _no_motion:
+                self._send(_k_error, -1)
+            else:
+                self._send(_k_ok, 0)
+                if len(arguments) > 1 and arguments[1] > DEFAULT_COMMAND_BUFFER_DEPTH:
+                    self._min_buffer_depth = int(arguments[1])
+                else:
+                    self._min_buffer_depth = DEFAULT_COMMAND_BUFFER_DEPTH
+                self._motion_state = _in_motion
+                self._busy_until = max(self._busy_until, self.simulated_time())
+
+    def _on_home(self, arguments):
+        if len(arguments) < 6:
+            self._send(_k_error, -1)
+            return
+        motor = int(arguments[0])
+        self._positions[motor] = 0
+        for follower in arguments[6:]:
+            if 0 < follower <= NUMBER_OF_MOTORS:
+                self._positions[int(follower)] = 0
+        self._send(_k_ok, motor - 1)
+
+    def _on_set_position(self, arguments):
+        if len(arguments) < 2 or arguments[1] < 0:
+            self._send(_k_error, -1)
+            return
+        self._move_queue.append([{
+            'type': 'set_position',
+            'motor': int(arguments[0]),
+            'target': int(arguments[1])
+        }])
+        self._queue_count += 1
+        self._advance()
+        self._send(_k_ok, self._queue_count, self.queue_length)
+
+    def _on_position(self, arguments):
+        self._send(30, self._positions[int(arguments[0])])
+
+    def _on_commands(self, arguments):
+        self._send(31, self._queue_count, self.queue_length)
+
+    def _on_status(self, arguments):
+        # status register, position, left & right endstop, encoder position
+        self._send(32, 0, self._positions[int(arguments[0])], -1, -1, self._positions[int(arguments[0])])
+
+
+_handlers = {
+    1: FirmwareSimulator._on_configure,
+    2: FirmwareSimulator._on_configure,
+    3: FirmwareSimulator._on_configure,
+    4: FirmwareSimulator._on_configure,
+    9: FirmwareSimulator._on_init,
+    10: FirmwareSimulator._on_move,
+    11: FirmwareSimulator._on_movement,
+    12: FirmwareSimulator._on_home,
+    13: FirmwareSimulator._on_set_position,
+    30: FirmwareSimulator._on_position,
+    31: FirmwareSimulator._on_commands,
+    32: FirmwareSimulator._on_status,
+}
+
+
+def trapezoid_duration(distance, v_start, v_max, v_stop, acceleration):
+    # how long does it take to travel the distance, starting with v_start and ending with v_stop
+    acceleration_time, cruise_time, deceleration_time, _ = trapezoid_profile(distance, v_start, v_max, v_stop,
+                                                                             acceleration)
+    return acceleration_time + cruise_time + deceleration_time
+
+
+def _decode_number(text):
+    text = text.strip()
+    if text.endswith('L'):
+        # python 2 longs
+        text = text[:-1]
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "b:s:h", ["baud=", "speedup=", "help"])
+    except getopt.error, msg:
+        print >> sys.stderr, msg
+        print >> sys.stderr, "usage: firmware_simulator.py [--baud=38400] [--speedup=1.0]"
+        return 2
+    baud_rate = _default_baud_rate
+    speedup = 1.0
+    for opt, value in opts:
+        if opt in ("-h", "--help"):
+            print "usage: firmware_simulator.py [--baud=38400] [--speedup=1.0]"
+            return 0
+        elif opt in ("-b", "--baud"):
+            baud_rate = int(value)
+        elif opt in ("-s", "--speedup"):
+            speedup = float(value)
+    logging.basicConfig(level=logging.INFO)
+    simulator = FirmwareSimulator(baud_rate=baud_rate, speedup=speedup)
+    print "T-Bone firmware simulator listening on %s" % simulator.serial_port
+    try:
+        while simulator.running:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+# coding=utf-8
+"""
+An index of a g code file - so nobody has to read the whole file again to know what is in it.
+
+The index is built once when the file is uploaded and stored next to it. It knows
+ - the byte offset of every n-th line - so we can jump to any line by reading at most n lines,
+ - where each layer starts, at which height and with which extruder position and feed rate,
+ - how many lines there are, how much gets extruded and the bounding box of the print,
+ - the first extruder and bed temperature - so the printer can heat up before the print starts.
+
+The GCodeIndexBuilder takes the file in chunks. NumPy finds the line breaks of a chunk, only the move commands get
+decoded one by one.
+"""
+from Queue import Queue
+import json
+import logging
+import os
+import re
+from threading import Thread
+import threading
+
+import numpy
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.index.json'
+_index_version = 3
+_default_line_interval = 1000
+_default_chunk_size = 1024 * 1024
+_newline = ord('\n')
+# moves and set positions - everything up to the comment
+_command_pattern = re.compile(r'^[ \t]*(G92|G0?[0-3])[ \t]+([^;\r\n]*)', re.MULTILINE)
+_argument_pattern = re.compile(r'([XYZEF])[ \t]*(-?\d*\.?\d+)')
+_temperature_pattern = re.compile(r'^[ \t]*(M104|M109|M140|M190)[ \t]+[^;\r\n]*?S[ \t]*(\d*\.?\d+)', re.MULTILINE)
+_heaters = {'M104': 'extruder', 'M109': 'extruder', 'M140': 'bed', 'M190': 'bed'}
+_axis_names = ('x', 'y', 'z', 'e')
+
+
+class GCodeIndexBuilder(object):
+    def __init__(self, line_interval=_default_line_interval):
+        self.line_interval = line_interval
+        self.line_count = 0
+        self.size = 0
+        # the byte offset of line 0, line_interval, 2 * line_interval …
+        self.line_offsets = []
+        self.layers = []
+        self.extrusion = 0.0
+        self.bounding_box = None
+        # the first temperature set for each heater
+        self.temperatures = {}
+        self._remainder = ''
+        self._position = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'e': 0.0}
+        # in mm/minute - as in the g code
+        self._feed_rate = None
+        # where the current height was set - and the extruder position and feed rate before
+        self._z_line = 0
+        self._z_offset = 0
+        self._z_e = 0.0
+        self._z_feed_rate = None
+        self._layer_z = None
+
+    def feed(self, data):
+        # the chunks do not have to end at a line break
+        if self._remainder:
+            data = self._remainder + data
+        last_newline = data.rfind('\n')
+        if last_newline < 0:
+            self._remainder = data
+            return
+        self._remainder = data[last_newline + 1:]
+        self._add_lines(data[:last_newline + 1])
+
+    def finish(self):
+        if self._remainder:
+            # the last line has no line break
+            remainder = self._remainder
+            self._remainder = ''
+            self._add_lines(remainder + '\n', trailing_newline=False)
+        return self.to_dict()
+
+    def to_dict(self):
+        return {
+            'version': _index_version,
+            'size': self.size,
+            'line_count': self.line_count,
+            'line_interval': self.line_interval,
+            'line_offsets': self.line_offsets,
+            'layers': self.layers,
+            'extrusion': self.extrusion,
+            'bounding_box': self.bounding_box,
+            'temperatures': self.temperatures
+        }
+
+    def _add_lines(self, text, trailing_newline=True):
+        chunk_offset = self.size
+        first_line = self.line_count
+        bytes_array = numpy.frombuffer(text, dtype=numpy.uint8)
+        line_ends = numpy.flatnonzero(bytes_array == _newline)
+        number_of_lines = len(line_ends)
+        # the start of each line relative to the chunk
+        line_starts = numpy.empty(number_of_lines, dtype=numpy.int64)
+        line_starts[0] = 0
+        line_starts[1:] = line_ends[:-1] + 1
+        first_indexed = (-first_line) % self.line_interval
+        self.line_offsets.extend(
+            (line_starts[first_indexed::self.line_interval] + chunk_offset).tolist())
+
+        matches = list(_command_pattern.finditer(text))
+        if matches:
+            match_lines = numpy.searchsorted(line_ends, [match.start() for match in matches])
+            for match, line in zip(matches, match_lines.tolist()):
+                self._add_command(match.group(1), match.group(2), first_line + line,
+                                  chunk_offset + int(line_starts[line]))
+
+        if len(self.temperatures) < len(set(_heaters.values())):
+            for match in _temperature_pattern.finditer(text):
+                temperature = float(match.group(2))
+                heater = _heaters[match.group(1)]
+                if temperature > 0 and heater not in self.temperatures:
+                    self.temperatures[heater] = temperature
+
+        self.line_count += number_of_lines
+        self.size += len(text) if trailing_newline else len(text) - 1
+
+    def _add_command(self, code, arguments, line, offset):
+        values = {}
+        for axis, value in _argument_pattern.findall(arguments):
+            values[axis.lower()] = float(value)
+        if not values:
+            return
+        position = self._position
+        feed_rate = values.pop('f', None)
+        if code == 'G92':
+            position.update(values)
+            return
+        extruded = 0.0
+        if 'e' in values:
+            extruded = values['e'] - position['e']
+        if 'z' in values and not values['z'] == position['z']:
+            self._z_line = line
+            self._z_offset = offset
+            self._z_e = position['e']
+            self._z_feed_rate = self._feed_rate
+        position.update(values)
+        if feed_rate is not None:
+            self._feed_rate = feed_rate
+        if extruded > 0 and ('x' in values or 'y' in values):
+            self.extrusion += extruded
+            if not position['z'] == self._layer_z:
+                self._layer_z = position['z']
+                self.layers.append({
+                    'z': position['z'],
+                    'line': self._z_line,
+                    'offset': self._z_offset,
+                    'e': self._z_e,
+                    'feed_rate': self._z_feed_rate
+                })
+            self._add_to_bounding_box(position)
+
+    def _add_to_bounding_box(self, position):
+        point = [position['x'], position['y'], position['z']]
+        if not self.bounding_box:
+            self.bounding_box = {'min': list(point), 'max': list(point)}
+        else:
+            self.bounding_box['min'] = map(min, self.bounding_box['min'], point)
+            self.bounding_box['max'] = map(max, self.bounding_box['max'], point)
+
+
+class GCodeIndex(object):
+    def __init__(self, index_dict):
+        self.size = index_dict['size']
+        self.line_count = index_dict['line_count']
+        self.line_interval = index_dict['line_interval']
+        self.line_offsets = index_dict['line_offsets']
+        self.layers = index_dict['layers']
+        self.extrusion = index_dict['extrusion']
+        self.bounding_box = index_dict['bounding_box']
+        self.temperatures = index_dict['temperatures']
+        # the content hash - if it was computed during the upload
+        self.sha1 = index_dict.get('sha1')
+
+    def line_offset(self, line):
+        """
+        returns the nearest indexed line before or at the line and its byte offset
+        """
+        if line < 0 or line >= self.line_count:
+            raise IndexError("There is no line %s" % line)
+        index = line // self.line_interval
+        return index * self.line_interval, self.line_offsets[index]
+
+    def layer(self, layer_number):
+        return self.layers[layer_number]
+
+    def progress(self, offset):
+        if not self.size:
+            return 1.0
+        return float(offset) / self.size
+
+
+def build_index(filename, line_interval=_default_line_interval, chunk_size=_default_chunk_size):
+    builder = GCodeIndexBuilder(line_interval=line_interval)
+    with open(filename, 'rb') as gcode_file:
+        while True:
+            data = gcode_file.read(chunk_size)
+            if not data:
+                break
+            builder.feed(data)
+    return builder.finish()
+
+
+def write_index(filename, index_dict):
+    stat = os.stat(filename)
+    index_dict = dict(index_dict)
+    index_dict['mtime'] = stat.st_mtime
+    index_file_name = filename + INDEX_SUFFIX
+    # write it under another name first - so nobody reads a half written index
+    temporary_file_name = index_file_name + '.tmp'
+    with open(temporary_file_name, 'w') as index_file:
+        json.dump(index_dict, index_file)
+    os.rename(temporary_file_name, index_file_name)
+
+
+def read_index(filename):
+    """
+    Returns the index of the file - or None if there is none or the file changed since it got indexed.
+    """
+    index_file_name = filename + INDEX_SUFFIX
+    if not os.path.exists(index_file_name):
+        return None
+    try:
+        with open(index_file_name) as index_file:
+            index_dict = json.load(index_file)
+    except (IOError, ValueError) as e:
+        _logger.warn("Unable to read index %s: %s", index_file_name, e)
+        return None
+    stat = os.stat(filename)
+    if not index_dict.get('version') == _index_version or not index_dict.get('size') == stat.st_size \
+            or not index_dict.get('mtime') == stat.st_mtime:
+        return None
+    return GCodeIndex(index_dict)
+
+
+class GCodeIndexer(object):
+    """
+    Indexes the files one after the other in a background thread.
+    """
+
+    def __init__(self, line_interval=_default_line_interval):
+        self.line_interval = line_interval
+        self._queue = Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._indexer_thread = Thread(target=self._index_files)
+        self._indexer_thread.daemon = True
+        self._indexer_thread.start()
+
+    def request(self, filename):
+        with self._lock:
+            if filename in self._pending:
+                return
+            self._pending.add(filename)
+        self._queue.put(filename)
+
+    def index(self, filename):
+        # the index if it is there - otherwise it gets built
+        index = read_index(filename)
+        if not index:
+            self.request(filename)
+        return index
+
+    def is_pending(self, filename):
+        with self._lock:
+            return filename in self._pending
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _index_files(self):
+        while True:
+            filename = self._queue.get()
+            if filename is None:
+                return
+            try:
+                if not read_index(filename):
+                    _logger.info("Indexing %s", filename)
+                    write_index(filename, build_index(filename, line_interval=self.line_interval))
+            except (IOError, OSError) as e:
+                _logger.warn("Unable to index %s: %s", filename, e)
+            finally:
+                with self._lock:
+                    self._pending.discard(filename)
@@ -1,50 +1,174 @@
 import logging
+import os
 import re
 from threading import Thread
+import time
 
 from helpers import file_len
+from arcs import ArcError
+from planner_process import PlannerProcess
 from printer import PrinterError
+import tracing
+from upload import UploadReader, UploadError
 
 
 __author__ = 'marcus'
 
 _text_and_number_pattern = re.compile('([a-zA-Z]+)(\-?\d+(.\d+)?)')
 _logger = logging.getLogger(__name__)
+# how often the progress of the planner process is looked at
+_planner_progress_wait_time = 0.1
+# how far below their temperatures the heaters may be to start in the middle of a print
+_start_layer_temperature_tolerance = 5.0
 
 
 class GCodePrintThread(Thread):
-    def __init__(self, file, printer, callback):
+    def __init__(self, file, printer, callback, index=None, start_layer=None, upload=None):
         # this constructor could be a bit more elegant
         super(GCodePrintThread, self).__init__()
         self.file = file
         self.printer = printer
         self.callback = callback
+        self.index = index
+        # if the file is still uploaded we follow the upload
+        self.upload = upload
         #let's see how many lines the print file got and reset progress
-        self.lines_to_print = file_len(file)
-        _logger.info("Number of lines in file: %s, with %s comments", self.lines_to_print)
-        self.lines_printed = 0
+        if upload:
+            self.file_size = upload.expected_size
+            # nobody knows yet
+            self.lines_to_print = None
+        elif index:
+            self.file_size = os.path.getsize(file)
+            self.lines_to_print = index.line_count
+        else:
+            self.file_size = os.path.getsize(file)
+            self.lines_to_print = file_len(file)
+        _logger.info("Number of lines in file: %s", self.lines_to_print)
+        self.start_line = 0
+        self.start_offset = 0
+        # restore the extruder position & feed rate of the layer we start at
+        self.start_lines = []
+        if start_layer:
+            if upload:
+                raise PrinterError("Cannot start at a layer of %s before the upload is finished" % file)
+            if not index:
+                raise PrinterError("Cannot start at a layer without an index of %s" % file)
+            self._check_ready_for_layer(index, start_layer)
+            layer = index.layer(start_layer)
+            self.start_line = layer['line']
+            self.start_offset = layer['offset']
+            self.start_lines.append("G92 E%s" % layer['e'])
+            if layer['feed_rate']:
+                self.start_lines.append("G1 F%s" % layer['feed_rate'])
+        self.lines_printed = self.start_line
+        self.bytes_printed = self.start_offset
         self.printing = False
+        # all lines are handed to the printer - it is just executing the rest
+        self.finished_reading = False
+        self.stopped = False
+        self.error = None
+
+    def progress(self):
+        file_size = self.file_size
+        if self.upload and not file_size:
+            # the best we know
+            file_size = self.upload.bytes_written
+        if not file_size:
+            return 1.0
+        return float(self.bytes_printed) / file_size
+
+    def stop(self):
+        # no more lines are read - whatever is planned already gets printed
+        self.stopped = True
+
+    def _check_ready_for_layer(self, index, start_layer):
+        # nobody knows where the head is or the filament is cold - starting in the middle would crash or grind
+        if not self.printer.homed:
+            raise PrinterError("Cannot start at layer %s before the printer is homed" % start_layer)
+        heaters = {'extruder': self.printer.extruder_heater}
+        if self.printer.heated_bed:
+            heaters['bed'] = self.printer.heated_bed
+        for name, heater in heaters.iteritems():
+            temperature = index.temperatures.get(name) or heater.get_set_temperature()
+            if name == 'extruder' and not temperature:
+                raise PrinterError("Cannot start at layer %s without an extruder temperature" % start_layer)
+            if temperature and heater.temperature < temperature - _start_layer_temperature_tolerance:
+                raise PrinterError("Cannot start at layer %s before the %s is heated to %s" %
+                                   (start_layer, name, temperature))
 
     def run(self):
         self.printing = True
         try:
-            gcode_input = open(self.file)
-            _logger.info("starting GCODE interpretation from %s to %s", input, self.printer)
-            self.lines_printed = 0
+            if self.printer.planner_process is not None and not self.upload:
+                self._print_in_planner_process()
+                return
+            if self.upload:
+                gcode_input = UploadReader(self.upload)
+            else:
+                gcode_input = open(self.file)
+                gcode_input.seek(self.start_offset)
+            _logger.info("starting GCODE interpretation from %s to %s", self.file, self.printer)
+            self.lines_printed = self.start_line
+            self.bytes_printed = self.start_offset
             self.printer.start_print()
-            for line in gcode_input:
+            for line in self.start_lines:
                 read_gcode_to_printer(line, self.printer)
-                self.lines_printed += 1
+            try:
+                for line in gcode_input:
+                    if self.stopped:
+                        _logger.info("Stopped printing %s", self.file)
+                        break
+                    read_gcode_to_printer(line, self.printer)
+                    self.lines_printed += 1
+                    self.bytes_printed += len(line)
+            except UploadError as e:
+                # we print what we got - there is nothing else we can do
+                _logger.error("Stopped reading %s: %s", self.file, e)
+                self.error = e
+            finally:
+                gcode_input.close()
+            self.finished_reading = True
             self.printer.finish_print()
             _logger.info("finished gcode reading to %s ", self.printer)
             # todo and here we need some more or less clever plan - since we cannot restart the print thread
+        except Exception as e:
+            self.error = e
+            raise
         finally:
             self.printing = False
             if self.callback:
                 self.callback()
 
+    def _print_in_planner_process(self):
+        _logger.info("starting GCODE interpretation from %s to %s in a planner process", self.file, self.printer)
+        planner = PlannerProcess(self.printer, self.file, read_gcode_to_printer, start_offset=self.start_offset,
+                                 start_lines=self.start_lines, **self.printer.planner_process)
+        self.printer.start_print(print_queue=planner)
+        if self.stopped:
+            # there is nothing to read then
+            planner.stop()
+        planner.start()
+        while not planner.reading_finished:
+            if self.stopped and not planner.ring.stopped:
+                _logger.info("Stopped printing %s", self.file)
+                planner.stop()
+            self._update_planner_progress(planner)
+            time.sleep(_planner_progress_wait_time)
+        self._update_planner_progress(planner)
+        self.finished_reading = True
+        self.printer.finish_print()
+        _logger.info("finished gcode reading to %s ", self.printer)
+        if planner.error:
+            raise PrinterError(planner.error)
+
+    def _update_planner_progress(self, planner):
+        lines, bytes_read = planner.progress()
+        self.lines_printed = self.start_line + lines
+        self.bytes_printed = self.start_offset + bytes_read
+
 
 def read_gcode_to_printer(line, printer):
+    trace = printer.tracer.start()
     gcode = decode_gcode_line(line)
     # handling the negative case first is silly but gives us more flexibility in the elif struct
     if not gcode:
@@ -52,8 +176,20 @@ def read_gcode_to_printer(line, printer):
         pass
     elif "G0" == gcode.code or "G1" == gcode.code:  #TODO G1 & G0 is different
         #we simply interpret the arguments as positions
-        positions = _decode_positions(gcode, line)
+        positions = decode_positions(gcode, line)
+        if trace:
+            trace.stamp(tracing.DECODED)
+            positions['trace'] = trace
         printer.move_to(positions)
+    elif "G2" == gcode.code or "G3" == gcode.code:
+        positions = decode_positions(gcode, line)
+        if trace:
+            trace.stamp(tracing.DECODED)
+            positions['trace'] = trace
+        try:
+            printer.arc_to(positions, clockwise="G2" == gcode.code)
+        except ArcError as e:
+            raise PrinterError("Unable to print arc %s: %s" % (line.strip(), e))
     elif "G20" == gcode.code:
         #we cannot switch to inches - sorry folks
         raise PrinterError("Currently only metric units are supported!")
@@ -61,7 +197,7 @@ def read_gcode_to_printer(line, printer):
         _logger.info("Using metric units according to the g code")
     elif "G28" == gcode.code:
         #TODO in'st that also to enqueue??
-        positions = _decode_positions(gcode, line)
+        positions = decode_positions(gcode, line)
         homing_axis = []
         if not printer.homed:
             printer.homed = True
@@ -88,7 +224,7 @@ def read_gcode_to_printer(line, printer):
         raise PrinterError("Currently only absolute positions are supported!")
     elif "G92" == gcode.code:
         #set XPOS
-        positions = _decode_positions(gcode, line)
+        positions = decode_positions(gcode, line)
         printer.set_position(positions)
     elif "M82" == gcode.code:
         _logger.info("Using absolute positions")
@@ -96,7 +232,7 @@ def read_gcode_to_printer(line, printer):
     elif "M83" == gcode.code:
         raise PrinterError("Currently only absolute positions are supported!")
     elif "M104" == gcode.code:
-        options = _decode_positions(gcode, line)
+        options = decode_positions(gcode, line)
         if 's' in options:
             temperature = options['s']
             if not temperature > printer.extruder_heater.max_temperature:
@@ -104,7 +240,7 @@ def read_gcode_to_printer(line, printer):
             else:
                 _logger.error("Setting be temperature to %s got ignored, too hot", temperature)
     elif "M106" == gcode.code:
-        options = _decode_positions(gcode, line)
+        options = decode_positions(gcode, line)
         if 's' in options:
             fan_speed = options['s'] / 255.0
             # printer.set_fan(fan_speed)
@@ -117,7 +253,7 @@ def read_gcode_to_printer(line, printer):
         except RuntimeError as e:
             _logger.error("Unable to set printer fan to 0:%s", e)
     elif "M109" == gcode.code:
-        options = _decode_positions(gcode, line)
+        options = decode_positions(gcode, line)
         #Set extruder heater temperature in degrees celsius and wait for this temperature to be achieved
         #Example: M190 S60"
         if 's' in options:
@@ -127,7 +263,7 @@ def read_gcode_to_printer(line, printer):
                 #todo a timeout value would be great?
                 pass
     elif "M140" == gcode.code:
-        options = _decode_positions(gcode, line)
+        options = decode_positions(gcode, line)
         if 's' in options:
             temperature = options['s']
             if printer.heated_bed:
@@ -143,7 +279,7 @@ def read_gcode_to_printer(line, printer):
     elif "M190" == gcode.code:
         #Wait for bed temperature to reach target temp
         #Example: M190 S60"
-        options = _decode_positions(gcode, line)
+        options = decode_positions(gcode, line)
         if 's' in options:
             temperature = options['s']
             if printer.heated_bed:
@@ -159,7 +295,7 @@ def read_gcode_to_printer(line, printer):
         _logger.warn("Unknown GCODE %s ignored", gcode)
 
 
-def _decode_positions(gcode, line):
+def decode_positions(gcode, line):
     positions = {}
     if gcode.options:
         for argument in gcode.options:
@@ -189,7 +325,9 @@ class GCode:
 
 # decode a line of text to gcode.
 def decode_gcode_line(line):
-    _logger.debug("decoding line %s", line)
+    debug = _logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        _logger.debug("decoding line %s", line)
     # we nee a result
     result = None
     #and prepare the line
@@ -204,11 +342,13 @@ def decode_gcode_line(line):
         if part.strip():
             relevant_parts.append(part.strip())
     if len(relevant_parts) > 0:
-        _logger.debug("read gcode %s", relevant_parts[0])
+        if debug:
+            _logger.debug("read gcode %s", relevant_parts[0])
         result = GCode(relevant_parts[0])
     if len(relevant_parts) > 1:
         result.options = relevant_parts[1:]
-        _logger.debug("found arguments: %s", result.options)
+        if debug:
+            _logger.debug("found arguments: %s", result.options)
 
     return result
 
@@ -0,0 +1,242 @@
+# coding=utf-8
+"""
+The hardware the print server runs on.
+
+GPIO, PWM and ADC are used just like the Adafruit_BBIO modules. Which hardware is behind them is decided on first
+use: the environment variable T_BONE_HARDWARE or the 'hardware' entry of the printer config select between
+'beaglebone' (the real thing) and 'simulated' (virtual pins and a simple thermal model of the heaters).
+
+Simulated printers of a farm each get a namespace for their pins - so they do not heat each others thermistors.
+"""
+import logging
+from math import exp
+import os
+import threading
+import time
+
+import beagle_bone_pins
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+HARDWARE_ENVIRONMENT_VARIABLE = 'T_BONE_HARDWARE'
+BEAGLEBONE = 'beaglebone'
+SIMULATED = 'simulated'
+
+_backend = None
+_backend_lock = threading.Lock()
+# e.g. 'left/P9_14'
+_namespace_separator = '/'
+
+
+def select_backend(name):
+    global _backend
+    with _backend_lock:
+        if _backend and _backend.name == name:
+            return _backend
+        if _backend:
+            raise HardwareError("Hardware is already %s, cannot switch to %s" % (_backend.name, name))
+        if name == BEAGLEBONE:
+            _backend = BeagleBoneBackend()
+        elif name == SIMULATED:
+            _backend = SimulatedBackend()
+        else:
+            raise HardwareError("Unknown hardware %s" % name)
+        _logger.info("Using %s hardware", name)
+        return _backend
+
+
+def configure(config):
+    # the environment wins over the config - so you can test any config on a build machine
+    name = os.environ.get(HARDWARE_ENVIRONMENT_VARIABLE)
+    if not name and config and 'printer' in config and 'hardware' in config['printer']:
+        name = config['printer']['hardware']
+    if name:
+        select_backend(name)
+    return get_backend()
+
+
+def get_backend():
+    if not _backend:
+        select_backend(os.environ.get(HARDWARE_ENVIRONMENT_VARIABLE, BEAGLEBONE))
+    return _backend
+
+
+def is_simulated():
+    return get_backend().name == SIMULATED
+
+
+def pin_of(namespace, pin):
+    # the pin in the namespace of a simulated printer - the pin itself without namespace
+    if not namespace:
+        return pin
+    return namespace + _namespace_separator + pin
+
+
+class _BackendModule(object):
+    # stands in for GPIO, PWM or ADC of whatever backend is selected
+    def __init__(self, module_name):
+        self._module_name = module_name
+
+    def __getattr__(self, attribute):
+        return getattr(getattr(get_backend(), self._module_name), attribute)
+
+
+GPIO = _BackendModule('GPIO')
+PWM = _BackendModule('PWM')
+ADC = _BackendModule('ADC')
+
+
+class BeagleBoneBackend(object):
+    name = BEAGLEBONE
+
+    def __init__(self):
+        from Adafruit_BBIO import GPIO, PWM, ADC
+
+        self.GPIO = GPIO
+        self.PWM = PWM
+        self.ADC = ADC
+        self.ADC.setup()
+
+
+class SimulatedBackend(object):
+    name = SIMULATED
+
+    def __init__(self):
+        self.GPIO = SimulatedGPIO()
+        self.PWM = SimulatedPWM()
+        self.ADC = SimulatedADC()
+        self.thermal_model = ThermalModel(self.GPIO, self.PWM)
+        self.ADC.thermal_model = self.thermal_model
+
+
+class SimulatedGPIO(object):
+    HIGH = 1
+    LOW = 0
+    OUT = 1
+    IN = 0
+
+    def __init__(self):
+        self.directions = {}
+        self.values = {}
+
+    def setup(self, pin, direction, *args, **kwargs):
+        self.directions[pin] = direction
+        self.values.setdefault(pin, self.LOW)
+
+    def output(self, pin, value):
+        self.values[pin] = value
+
+    def input(self, pin):
+        return self.values.get(pin, self.LOW)
+
+    def cleanup(self):
+        self.directions.clear()
+        self.values.clear()
+
+
+class SimulatedPWM(object):
+    def __init__(self):
+        self.duty_cycles = {}
+        self.frequencies = {}
+
+    def start(self, pin, duty_cycle=0.0, frequency=2000, polarity=0):
+        self.duty_cycles[pin] = float(duty_cycle)
+        self.frequencies[pin] = frequency
+
+    def set_duty_cycle(self, pin, duty_cycle):
+        self.duty_cycles[pin] = float(duty_cycle)
+
+    def set_frequency(self, pin, frequency):
+        self.frequencies[pin] = frequency
+
+    def stop(self, pin):
+        self.duty_cycles[pin] = 0.0
+
+    def cleanup(self):
+        self.duty_cycles.clear()
+
+
+class SimulatedADC(object):
+    def __init__(self):
+        self.thermal_model = None
+
+    def setup(self):
+        pass
+
+    def read(self, pin):
+        return self.thermal_model.read(pin)
+
+    def read_raw(self, pin):
+        return self.read(pin) * 1800.0
+
+
+class ThermalModel(object):
+    """
+    Every heater output of the cape heats the thermistor at its input.
+
+    The temperature rises with the heating rate at full power and cools down proportional to the difference to the
+    ambient temperature. The thermistor is a 100k NTC with a 4.7k pull up.
+    """
+
+    def __init__(self, gpio, pwm, ambient_temperature=22.0, heating_rate=5.0, cooling_rate=0.02):
+        self._gpio = gpio
+        self._pwm = pwm
+        self.ambient_temperature = ambient_temperature
+        self.heating_rate = heating_rate
+        self.cooling_rate = cooling_rate
+        self._lock = threading.Lock()
+        # input pin -> output pin of the cape
+        self._cape_outputs = {}
+        # and of every namespace which was read so far
+        self._outputs = {}
+        self.temperatures = {}
+        for heater_config in beagle_bone_pins.pwm_config:
+            self._cape_outputs[heater_config['temp']] = heater_config['out']
+            self._outputs[heater_config['temp']] = heater_config['out']
+            self.temperatures[heater_config['temp']] = ambient_temperature
+        self._last_update = time.time()
+
+    def update(self):
+        with self._lock:
+            now = time.time()
+            elapsed = now - self._last_update
+            self._last_update = now
+            for input_pin, output_pin in self._outputs.iteritems():
+                # relax exponentially towards the temperature where heating and cooling are balanced
+                steady_temperature = self.ambient_temperature + self.heating_rate * self._power(
+                    output_pin) / self.cooling_rate
+                self.temperatures[input_pin] = steady_temperature + (
+                    self.temperatures[input_pin] - steady_temperature) * exp(-self.cooling_rate * elapsed)
+
+    def read(self, input_pin):
+        self.update()
+        if input_pin not in self._outputs:
+            self._add_input(input_pin)
+        temperature = self.temperatures.get(input_pin, self.ambient_temperature)
+        resistance = 100000.0 * exp(3950.0 * (1.0 / (temperature + 273.15) - 1.0 / 298.15))
+        return resistance / (resistance + 4700.0)
+
+    def _add_input(self, input_pin):
+        namespace, separator, cape_pin = input_pin.rpartition(_namespace_separator)
+        if cape_pin in self._cape_outputs:
+            with self._lock:
+                self._outputs[input_pin] = namespace + separator + self._cape_outputs[cape_pin]
+                self.temperatures[input_pin] = self.ambient_temperature
+
+    def _power(self, output_pin):
+        # heaters are either pwm or just switched on & off
+        if output_pin in self._pwm.duty_cycles:
+            return self._pwm.duty_cycles[output_pin] / 100.0
+        if self._gpio.values.get(output_pin) == self._gpio.HIGH:
+            return 1.0
+        return 0.0
+
+
+class HardwareError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
@@ -1,8 +1,9 @@
-from Adafruit_BBIO import ADC, PWM, GPIO
 from flask import logging
+from collections import deque
 from threading import Thread
 import threading
 import time
+from hardware import ADC, PWM, GPIO
 import thermistors
 
 __author__ = 'marcus'
@@ -11,14 +12,24 @@ _DEFAULT_READOUT_DELAY = 0.1
 _DEFAULT_CURRENT_READOUT_DELAY = 60
 _PWM_LOCK = threading.Lock()
 _DEFAULT_MAX_TEMPERATURE = 250
-ADC.setup()
+# with the first read thrown away that are 20 ADC reads per second and input - no more than without the sampler
+_DEFAULT_SAMPLE_DELAY = 0.15
+_DEFAULT_OVERSAMPLING = 2
+_DEFAULT_FILTER_LENGTH = 5
+_MAX_READ_RETRIES = 100
+# a sample older than that many sample delays - and at least that many seconds - means the sampler is stuck
+_STALE_SAMPLE_PERIODS = 10
+_MIN_STALE_SAMPLE_AGE = 2.0
+_MAX_SAMPLE_FAILURES = 3
+# how long a heater may go without a temperature before it is given up
+_MAX_SAMPLER_FAILURE_TIME = 10.0
 
 ADC_LOCK = threading.Lock()
 
 
-class Heater(Thread):
-    def __init__(self, thermometer, output, machine=None, max_temperature=None, current_measurement=None):
-        super(Heater, self).__init__()
+class Heater(object):
+    def __init__(self, thermometer, output, scheduler, machine=None, max_temperature=None, current_measurement=None,
+                 readout_delay=None):
         if max_temperature:
             self.max_temperature = max_temperature
         else:
@@ -29,15 +40,29 @@ class Heater(Thread):
         self.active = False
         self._set_temperature = 0.0
         self.temperature = 0.0
-        self.readout_delay = _DEFAULT_READOUT_DELAY
+        if readout_delay:
+            self.readout_delay = readout_delay
+        else:
+            self.readout_delay = _DEFAULT_READOUT_DELAY
         self._current_measurement = current_measurement
         self.current_consumption = 0.0
         self.current_readout_delay = _DEFAULT_CURRENT_READOUT_DELAY
         self._wait_for_current_readout = 0
-        self.start()
+        # how late the last control update was and the worst so far
+        self.jitter = 0.0
+        self.max_jitter = 0.0
+        # all heaters share one scheduler - it is not created per heater
+        self._scheduler = scheduler
+
+    def start(self):
+        # the subclasses start when they are completely configured
+        self._wait_for_current_readout = self.current_readout_delay + self.readout_delay
+        self.active = True
+        self._scheduler.add_heater(self)
 
     def stop(self):
         self.active = False
+        self._scheduler.remove_heater(self)
 
     def set_temperature(self, temperature):
         if not self.max_temperature or temperature < self.max_temperature:
@@ -48,33 +73,28 @@ class Heater(Thread):
     def get_set_temperature(self):
         return self._set_temperature
 
-    def run(self):
-        self._wait_for_current_readout = self.current_readout_delay + self.readout_delay
-        self.active = True
-        try:
-            while self.active:
-                self.temperature = self._thermometer.read()
-                self.update_heater()
-                time.sleep(self.readout_delay)
-        except Exception as e:
-            _logger.error("Heater thread crashed %s", e)
-        finally:
-            self.cleanup()
+    def control(self):
+        self.temperature = self._thermometer.read()
+        self.update_heater()
 
     def update_heater(self):
         raise Exception("please implement")
 
+    def switch_off(self):
+        # for one cycle - the next update decides again
+        raise Exception("please implement")
+
     def cleanup(self):
         pass
 
 
 class PwmHeater(Heater):
-    def __init__(self, thermometer, pid_controller, output, maximum_duty_cycle=None, current_measurement=None,
-                 machine=None,
-                 pwm_frequency=None, max_temperature=None):
-        super(PwmHeater, self).__init__(thermometer=thermometer, output=output,
+    def __init__(self, thermometer, pid_controller, output, scheduler, maximum_duty_cycle=None,
+                 current_measurement=None, machine=None,
+                 pwm_frequency=None, max_temperature=None, readout_delay=None):
+        super(PwmHeater, self).__init__(thermometer=thermometer, output=output, scheduler=scheduler,
                                         machine=machine, max_temperature=max_temperature,
-                                        current_measurement=current_measurement)
+                                        current_measurement=current_measurement, readout_delay=readout_delay)
         self._pid_controller = pid_controller
         if maximum_duty_cycle:
             self._maximum_duty_cycle = float(maximum_duty_cycle)
@@ -91,6 +111,7 @@ class PwmHeater(Heater):
 
         with _PWM_LOCK:
             PWM.start(self._output, 0.0, self.pwm_frequency, 0)
+        self.start()
 
     def set_temperature(self, temperature):
         super(PwmHeater, self).set_temperature(temperature)
@@ -101,6 +122,11 @@ class PwmHeater(Heater):
         self.duty_cycle = self._pid_controller.update(self.temperature)
         self._apply_duty_cycle()
 
+    def switch_off(self):
+        self.duty_cycle = 0.0
+        with _PWM_LOCK:
+            PWM.set_duty_cycle(self._output, 0.0)
+
     def _apply_duty_cycle(self):
         # todo this is a hack because the current reading si only avail on arduino
         try:
@@ -132,12 +158,12 @@ class PwmHeater(Heater):
 
 
 class OnOffHeater(Heater):
-    def __init__(self, thermometer, output, active_high=True,
+    def __init__(self, thermometer, output, scheduler, active_high=True,
                  max_temperature=None, hysteresis=0,
-                 machine=None, current_measurement=None):
-        super(OnOffHeater, self).__init__(thermometer=thermometer, output=output,
+                 machine=None, current_measurement=None, readout_delay=None):
+        super(OnOffHeater, self).__init__(thermometer=thermometer, output=output, scheduler=scheduler,
                                           machine=machine, max_temperature=max_temperature,
-                                          current_measurement=current_measurement)
+                                          current_measurement=current_measurement, readout_delay=readout_delay)
         self.hysteresis = hysteresis
         GPIO.setup(output, GPIO.OUT)
         if active_high:
@@ -153,6 +179,7 @@ class OnOffHeater(Heater):
 
         self._is_active = False
         self._set_active(False)
+        self.start()
 
     def _set_active(self, active):
         self._is_active = active
@@ -169,6 +196,9 @@ class OnOffHeater(Heater):
             if self.temperature < self._set_temperature - self.hysteresis:
                 self._set_active(True)
 
+    def switch_off(self):
+        self._set_active(False)
+
     def cleanup(self):
         GPIO.output(self._output, self._on_off_config['off'])
 
@@ -176,27 +206,238 @@ class OnOffHeater(Heater):
         GPIO.output(self._output, self._on_off_config['off'])
 
 
+class HeaterScheduler(Thread):
+    """
+    Runs the control updates of all heaters on one thread.
+
+    Each heater is updated every readout_delay seconds. How late an update was is stored as jitter at the
+    heater. If a heater crashes it is switched off and removed - the others keep running. Without a temperature
+    reading a heater is just switched off until there is one again - only after max_sampler_failure_time seconds
+    it is given up.
+    """
+
+    def __init__(self, max_sampler_failure_time=_MAX_SAMPLER_FAILURE_TIME):
+        super(HeaterScheduler, self).__init__()
+        self.daemon = True
+        self.max_sampler_failure_time = max_sampler_failure_time
+        # heater -> next update time
+        self._schedule = {}
+        # heater -> since when it has no temperature
+        self._sampler_failures = {}
+        self._schedule_lock = threading.RLock()
+        self.active = True
+        self.start()
+
+    def add_heater(self, heater):
+        with self._schedule_lock:
+            # None means as soon as possible
+            self._schedule[heater] = None
+
+    def remove_heater(self, heater):
+        with self._schedule_lock:
+            if heater in self._schedule:
+                del self._schedule[heater]
+                self._sampler_failures.pop(heater, None)
+                heater.cleanup()
+
+    def stop(self):
+        self.active = False
+        if self.isAlive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        try:
+            while self.active:
+                with self._schedule_lock:
+                    now = time.time()
+                    next_update = now + _DEFAULT_READOUT_DELAY
+                    for heater, update_time in self._schedule.items():
+                        if update_time is None or update_time <= now:
+                            update_time = self._update(heater, update_time, now)
+                        if update_time is not None and update_time < next_update:
+                            next_update = update_time
+                # a condition would be nicer - but its wait polls in python 2
+                wait_time = next_update - time.time()
+                if wait_time > 0:
+                    time.sleep(wait_time)
+        finally:
+            with self._schedule_lock:
+                for heater in self._schedule.keys():
+                    heater.active = False
+                    heater.cleanup()
+                self._schedule.clear()
+
+    def _update(self, heater, update_time, now):
+        if update_time is None:
+            # the first update has no schedule to be late for
+            update_time = now
+        heater.jitter = now - update_time
+        heater.max_jitter = max(heater.max_jitter, heater.jitter)
+        try:
+            heater.control()
+            self._sampler_failures.pop(heater, None)
+        except SamplerError as e:
+            if heater not in self._sampler_failures:
+                _logger.warn("Heater is off until there is a temperature again: %s", e)
+                self._sampler_failures[heater] = now
+            if now - self._sampler_failures[heater] < self.max_sampler_failure_time:
+                heater.switch_off()
+            else:
+                return self._give_up(heater, e)
+        except Exception as e:
+            return self._give_up(heater, e)
+        update_time += heater.readout_delay
+        if update_time < now:
+            # we are more than a whole period late - no need to catch up
+            update_time = now + heater.readout_delay
+        self._schedule[heater] = update_time
+        return update_time
+
+    def _give_up(self, heater, error):
+        _logger.error("Heater crashed %s", error)
+        heater.active = False
+        del self._schedule[heater]
+        self._sampler_failures.pop(heater, None)
+        heater.cleanup()
+        return None
+
+
 class Thermometer(object):
-    def __init__(self, themistor_type, analog_input):
+    def __init__(self, themistor_type, analog_input, sampler=None):
         self._thermistor_type = themistor_type
         self._input = analog_input
+        # resolve the conversion once - not for every single sample
+        self._convert = thermistors.get_converter(themistor_type)
+        self._sampler = sampler
+        if sampler:
+            sampler.add_input(analog_input)
 
     def read(self):
-        unsuccesfull = 0
         value = None
-        with ADC_LOCK:
-            while not value:
-                # adafruit says it is a bug http://learn.adafruit.com/setting-up-io-python-library-on-beaglebone-black/adc
-                try:
-                    ADC.read(self._input)
-                    value = ADC.read(self._input)  # read 0 to 1
-                except IOError as e:
-                    if unsuccesfull>10:
-                        _logger.warn("Error reading value: %s", e)
-                    unsuccesfull += 1
-                    if unsuccesfull > 100:
-                        raise e
-        return thermistors.get_thermistor_reading(self._thermistor_type, value)
+        if self._sampler:
+            # raises a SamplerError if the sampler has no recent value - the heater must not run on an old one
+            value = self._sampler.read(self._input)
+        if value is None:
+            # no sampler or it has not sampled the input yet
+            with ADC_LOCK:
+                value = read_analog_input(self._input)
+        return self._convert(value)
+
+
+def read_analog_input(analog_input, samples=1):
+    # reads the input as value from 0 to 1 - you should hold the ADC_LOCK
+    unsuccesfull = 0
+    values = []
+    # adafruit says it is a bug http://learn.adafruit.com/setting-up-io-python-library-on-beaglebone-black/adc
+    # so the first read is always thrown away
+    first_read = True
+    while len(values) < samples:
+        try:
+            value = ADC.read(analog_input)  # read 0 to 1
+            if first_read:
+                first_read = False
+            elif value:
+                values.append(value)
+        except IOError as e:
+            if unsuccesfull > 10:
+                _logger.warn("Error reading value: %s", e)
+            unsuccesfull += 1
+            if unsuccesfull > _MAX_READ_RETRIES:
+                raise e
+    if samples == 1:
+        return values[0]
+    return sum(values) / len(values)
+
+
+class AnalogSampler(Thread):
+    """
+    Reads all registered analog inputs in a fixed schedule.
+
+    Each input is oversampled and the averages go to a ring buffer per input. The median of the ring buffer is
+    published as latest value, so reading it needs neither the ADC_LOCK nor any ADC access. Each value is published
+    with the time it was sampled at - if it gets too old or the input failed too often in a row reading it raises a
+    SamplerError.
+    """
+
+    def __init__(self, sample_delay=None, oversampling=None, filter_length=None, max_sample_age=None):
+        super(AnalogSampler, self).__init__()
+        self.daemon = True
+        if sample_delay:
+            self.sample_delay = sample_delay
+        else:
+            self.sample_delay = _DEFAULT_SAMPLE_DELAY
+        if oversampling:
+            self.oversampling = oversampling
+        else:
+            self.oversampling = _DEFAULT_OVERSAMPLING
+        if filter_length:
+            self.filter_length = filter_length
+        else:
+            self.filter_length = _DEFAULT_FILTER_LENGTH
+        # None - a few sample delays, whatever the sample delay is configured to
+        self.max_sample_age = max_sample_age
+        self._inputs = ()
+        self._ring_buffers = {}
+        # input -> (value, time it was sampled)
+        self._values = {}
+        # input -> failed samples in a row
+        self._failures = {}
+        # set before the start - so stopping it right away stops it
+        self.active = True
+        self.start()
+
+    def add_input(self, analog_input):
+        if analog_input not in self._ring_buffers:
+            self._ring_buffers[analog_input] = deque(maxlen=self.filter_length)
+            # the sampling loop just picks up the new tuple
+            self._inputs = self._inputs + (analog_input,)
+
+    def read(self, analog_input):
+        """
+        The filtered value of the input - or None if it has not been sampled yet.
+        """
+        sample = self._values.get(analog_input)
+        if sample is None:
+            return None
+        failures = self._failures.get(analog_input, 0)
+        if failures >= _MAX_SAMPLE_FAILURES:
+            raise SamplerError("Analog input %s failed %s times in a row" % (analog_input, failures))
+        value, sample_time = sample
+        age = time.time() - sample_time
+        if age > (self.max_sample_age or max(_STALE_SAMPLE_PERIODS * self.sample_delay, _MIN_STALE_SAMPLE_AGE)):
+            raise SamplerError("Last sample of analog input %s is %0.2fs old" % (analog_input, age))
+        return value
+
+    def stop(self):
+        self.active = False
+
+    def run(self):
+        while self.active:
+            for analog_input in self._inputs:
+                self._sample(analog_input)
+            time.sleep(self.sample_delay)
+
+    def _sample(self, analog_input):
+        try:
+            with ADC_LOCK:
+                value = read_analog_input(analog_input, self.oversampling)
+        except IOError as e:
+            self._failures[analog_input] = self._failures.get(analog_input, 0) + 1
+            _logger.error("Unable to sample analog input %s: %s", analog_input, e)
+            return
+        self._failures[analog_input] = 0
+        ring_buffer = self._ring_buffers[analog_input]
+        ring_buffer.append(value)
+        filtered_values = sorted(ring_buffer)
+        self._values[analog_input] = (filtered_values[len(filtered_values) // 2], time.time())
+
+
+class SamplerError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
 
 
 # from http://code.activestate.com/recipes/577231-discrete-pid-controller/
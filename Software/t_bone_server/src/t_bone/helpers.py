@@ -1,9 +1,17 @@
+from collections import namedtuple
+import os
+import sys
 from numpy import sqrt
 from t_bone import machine
 
 
 __author__ = 'marcus'
 
+_infinity = float("inf")
+
+# everything to convert millimeters of several axis to steps - each field has one value per axis name
+StepConversion = namedtuple('StepConversion', ['axis_names', 'steps_per_mm'])
+
 
 def convert_mm_to_steps(millimeters, conversion_factor):
     if millimeters is None:
@@ -20,6 +28,35 @@ def convert_acceleration_clock_ref_to_realtime_ref(acceleration):
     return acceleration * machine.clock_frequency**2 / (512*256) / (2**24)
 
 
+def compile_step_conversion(axis_config, axis_names):
+    steps_per_mm = [float(axis_config[axis_name]['steps_per_mm']) for axis_name in axis_names]
+    return StepConversion(tuple(axis_names), tuple(steps_per_mm))
+
+
+def trapezoid_profile(distance, v_start, v_max, v_stop, acceleration):
+    """
+    Splits a move in its acceleration, cruising and deceleration phase.
+    Returns the time spent in each of them and the highest speed reached.
+    """
+    if distance <= 0:
+        return 0.0, 0.0, 0.0, 0.0
+    if acceleration <= 0 or acceleration == _infinity:
+        return 0.0, float(distance) / v_max, 0.0, v_max
+    acceleration_distance = (v_max ** 2 - v_start ** 2) / (2.0 * acceleration)
+    deceleration_distance = (v_max ** 2 - v_stop ** 2) / (2.0 * acceleration)
+    if acceleration_distance + deceleration_distance <= distance:
+        return (v_max - v_start) / acceleration, \
+               (distance - acceleration_distance - deceleration_distance) / v_max, \
+               (v_max - v_stop) / acceleration, \
+               v_max
+    # we never reach v_max - it is a triangle
+    peak_speed = sqrt(max((2.0 * acceleration * distance + v_start ** 2 + v_stop ** 2) / 2.0, 0.0))
+    if peak_speed < max(v_start, v_stop):
+        # we cannot even reach the stop speed, just travel at the average
+        return 0.0, 2.0 * distance / (v_start + v_stop), 0.0, max(v_start, v_stop)
+    return (peak_speed - v_start) / acceleration, 0.0, (peak_speed - v_stop) / acceleration, peak_speed
+
+
 def calculate_relative_vector(delta_x, delta_y, delta_z, delta_e):
     length = sqrt(delta_x ** 2 + delta_y ** 2 + delta_z ** 2 + delta_e**2)
     if length == 0:
@@ -60,4 +97,10 @@ def file_len(fname):
     with open(fname) as f:
         for i, l in enumerate(f):
             pass
-    return i + 1
\ No newline at end of file
+    return i + 1
+
+
+def python_command(module_file, *arguments):
+    # to run a module as script in a fresh python process - a fork of the threaded server could inherit held locks
+    script = os.path.splitext(module_file)[0] + '.py'
+    return [sys.executable, script] + list(arguments)
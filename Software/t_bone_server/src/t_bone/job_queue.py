@@ -0,0 +1,335 @@
+# coding=utf-8
+"""
+The print jobs waiting for the printer.
+
+The jobs are printed one after the other in the order of the queue. The queue is stored in a small JSON file, so it
+survives a restart of the server - a job which was heating or printing when the server stopped has failed then.
+
+The JobScheduler takes the jobs from the queue. While the current job is finishing - all lines are read, the printer
+executes the last moves - it already heats up for the next job and makes sure the next job is indexed. The
+temperatures come from the g code index. A job only starts printing once the heaters got close to their temperatures.
+While the current job is still printing the heaters only get hotter - a heater the next job wants cooler is set once
+the current job is done. Cancelling a heating job switches its heaters off again.
+"""
+import json
+import logging
+import os
+import threading
+from threading import Thread
+import time
+
+from gcode_interpreter import GCodePrintThread
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+HEATING = 'heating'
+PRINTING = 'printing'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+_active_states = (QUEUED, HEATING, PRINTING)
+# how many finished jobs are remembered
+_default_history_length = 50
+_scheduler_wait_time = 0.5
+_default_temperature_tolerance = 5.0
+
+
+class JobQueue(object):
+    def __init__(self, job_file=None, history_length=_default_history_length):
+        self.job_file = job_file
+        self.history_length = history_length
+        self._jobs = []
+        self._next_id = 1
+        self._lock = threading.RLock()
+        self._load()
+
+    def enqueue(self, file, start_layer=None):
+        with self._lock:
+            job = {
+                'id': self._next_id,
+                'file': file,
+                'name': os.path.basename(file),
+                'start_layer': start_layer,
+                'state': QUEUED,
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'error': None
+            }
+            self._next_id += 1
+            self._jobs.append(job)
+            self._save()
+            _logger.info("Queued %s as job %s", file, job['id'])
+            return dict(job)
+
+    def jobs(self):
+        with self._lock:
+            return [dict(job) for job in self._jobs]
+
+    def job(self, job_id):
+        with self._lock:
+            job = self._find(job_id)
+            return dict(job) if job else None
+
+    def next_job(self):
+        # the job which is heating or the first waiting one
+        with self._lock:
+            for job in self._jobs:
+                if job['state'] in (QUEUED, HEATING):
+                    return dict(job)
+            return None
+
+    def move(self, job_id, position):
+        """
+        Moves the job to the position among the queued jobs - 0 is next.
+        """
+        with self._lock:
+            job = self._find(job_id)
+            if not job:
+                raise JobError("There is no job %s" % job_id)
+            if not job['state'] == QUEUED:
+                raise JobError("Job %s is %s and cannot be moved" % (job_id, job['state']))
+            self._jobs.remove(job)
+            queued = [index for index, other_job in enumerate(self._jobs) if other_job['state'] == QUEUED]
+            if position < 0:
+                raise JobError("There is no position %s" % position)
+            if position < len(queued):
+                self._jobs.insert(queued[position], job)
+            else:
+                self._jobs.append(job)
+            self._save()
+            return dict(job)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._find(job_id)
+            if not job:
+                raise JobError("There is no job %s" % job_id)
+            if job['state'] not in _active_states:
+                raise JobError("Job %s is %s already" % (job_id, job['state']))
+            self.update(job_id, CANCELLED)
+            return dict(job)
+
+    def update(self, job_id, state, error=None):
+        """
+        Changes the state of the job - returns False if the job was finished already.
+        """
+        with self._lock:
+            job = self._find(job_id)
+            if not job or job['state'] not in _active_states:
+                return False
+            job['state'] = state
+            if state == PRINTING:
+                job['started'] = time.time()
+            elif state not in _active_states:
+                job['finished'] = time.time()
+                job['error'] = error
+                self._forget_old_jobs()
+            self._save()
+            return True
+
+    def _find(self, job_id):
+        for job in self._jobs:
+            if job['id'] == job_id:
+                return job
+        return None
+
+    def _forget_old_jobs(self):
+        finished = [job for job in self._jobs if job['state'] not in _active_states]
+        for job in finished[:-self.history_length or None]:
+            self._jobs.remove(job)
+
+    def _load(self):
+        if not self.job_file or not os.path.exists(self.job_file):
+            return
+        try:
+            with open(self.job_file) as job_file:
+                stored = json.load(job_file)
+        except (IOError, ValueError) as e:
+            _logger.warn("Unable to read jobs from %s: %s", self.job_file, e)
+            return
+        self._jobs = stored['jobs']
+        self._next_id = stored['next_id']
+        for job in self._jobs:
+            if job['state'] in (HEATING, PRINTING):
+                # we do not know what happened to it
+                job['error'] = "The server stopped while it was %s" % job['state']
+                job['state'] = FAILED
+
+    def _save(self):
+        if not self.job_file:
+            return
+        try:
+            temporary_file_name = self.job_file + '.tmp'
+            with open(temporary_file_name, 'w') as job_file:
+                json.dump({'jobs': self._jobs, 'next_id': self._next_id}, job_file)
+            os.rename(temporary_file_name, self.job_file)
+        except (IOError, OSError) as e:
+            _logger.warn("Unable to store jobs in %s: %s", self.job_file, e)
+
+
+class JobScheduler(Thread):
+    """
+    Prints the jobs of the queue one after the other.
+    """
+
+    def __init__(self, printer, job_queue, indexer=None, upload_manager=None,
+                 temperature_tolerance=_default_temperature_tolerance):
+        super(JobScheduler, self).__init__()
+        self.daemon = True
+        self.printer = printer
+        self.job_queue = job_queue
+        self.indexer = indexer
+        self.upload_manager = upload_manager
+        self.temperature_tolerance = temperature_tolerance
+        self.current_job = None
+        self.print_thread = None
+        self.running = True
+        # the job heating up for its start & what the heaters were set to before
+        self._heating_job = None
+        self._heating_temperatures = {}
+        self._previous_temperatures = {}
+        self._lock = threading.Lock()
+
+    def stop(self):
+        self.running = False
+
+    def cancel(self, job_id):
+        job = self.job_queue.cancel(job_id)
+        with self._lock:
+            if self.current_job and self.current_job['id'] == job_id:
+                self.print_thread.stop()
+            elif self._heating_job == job_id:
+                self._cool_down()
+        return job
+
+    def run(self):
+        while self.running:
+            try:
+                self.schedule()
+            except Exception:
+                _logger.exception("Unable to schedule the next job")
+            time.sleep(_scheduler_wait_time)
+
+    def schedule(self):
+        with self._lock:
+            if self.print_thread:
+                if self.print_thread.isAlive():
+                    if self.print_thread.finished_reading:
+                        # the printer is busy with the last moves - time to get ready for the next job
+                        self._prepare(self.job_queue.next_job())
+                    return
+                self._finish_current_job()
+            job = self.job_queue.next_job()
+            if job:
+                self._prepare(job)
+                job = self.job_queue.job(job['id'])
+                if job['state'] == HEATING and self._heated():
+                    self._start(job)
+
+    def _prepare(self, job):
+        if not job or not job['state'] == QUEUED:
+            return
+        temperatures = self._temperatures(job)
+        if temperatures is None:
+            # still indexing
+            return
+        _logger.info("Heating up for job %s: %s", job['id'], temperatures)
+        if self._heating_job is None:
+            self._previous_temperatures = dict((name, heater.get_set_temperature())
+                                               for name, heater in self._heaters().iteritems())
+        self._heating_job = job['id']
+        self._heating_temperatures = temperatures
+        # the current job may still need its heaters that hot
+        self._heat(temperatures, only_raise=self.print_thread is not None)
+        self.job_queue.update(job['id'], HEATING)
+
+    def _heat(self, temperatures, only_raise=False):
+        for name, heater in self._heaters().iteritems():
+            if name in temperatures:
+                if only_raise and temperatures[name] < heater.get_set_temperature():
+                    continue
+                heater.set_temperature(temperatures[name])
+
+    def _cool_down(self):
+        # nothing prints if the heating job does not - otherwise the current job gets its temperatures back
+        if self.print_thread:
+            _logger.info("Job %s does not need the heaters anymore", self._heating_job)
+            self._heat(dict((name, self._previous_temperatures[name]) for name in self._heating_temperatures
+                            if name in self._previous_temperatures))
+        else:
+            _logger.info("Switching the heaters of job %s off", self._heating_job)
+            self._heat(dict((name, 0.0) for name in self._heating_temperatures))
+        self._heating_job = None
+        self._heating_temperatures = {}
+
+    def _temperatures(self, job):
+        # returns None if we have to wait for the index
+        if self._upload(job) or not self.indexer:
+            return {}
+        if not os.path.exists(job['file']):
+            # it will fail when it starts
+            return {}
+        index = self.indexer.index(job['file'])
+        if not index:
+            return None
+        return index.temperatures
+
+    def _heaters(self):
+        heaters = {'extruder': self.printer.extruder_heater}
+        if self.printer.heated_bed:
+            heaters['bed'] = self.printer.heated_bed
+        return heaters
+
+    def _heated(self):
+        for heater in self._heaters().itervalues():
+            if heater.temperature < heater.get_set_temperature() - self.temperature_tolerance:
+                return False
+        return True
+
+    def _start(self, job):
+        upload = self._upload(job)
+        index = None
+        if self.indexer and not upload:
+            index = self.indexer.index(job['file'])
+        try:
+            self.print_thread = GCodePrintThread(job['file'], self.printer, None, index=index,
+                                                 start_layer=job['start_layer'], upload=upload)
+        except Exception as e:
+            _logger.warn("Unable to start job %s: %s", job['id'], e)
+            self.job_queue.update(job['id'], FAILED, error=str(e))
+            self._cool_down()
+            return
+        self._heating_job = None
+        self.current_job = job
+        self.job_queue.update(job['id'], PRINTING)
+        _logger.info("Printing job %s: %s", job['id'], job['file'])
+        self.print_thread.start()
+
+    def _finish_current_job(self):
+        if self.print_thread.error:
+            self.job_queue.update(self.current_job['id'], FAILED, error=str(self.print_thread.error))
+        else:
+            self.job_queue.update(self.current_job['id'], DONE)
+        _logger.info("Finished job %s", self.current_job['id'])
+        self.current_job = None
+        self.print_thread = None
+        if self._heating_job is not None:
+            # the next job gets its temperatures - even if they are lower
+            self._heat(self._heating_temperatures)
+
+    def _upload(self, job):
+        if not self.upload_manager:
+            return None
+        return self.upload_manager.uploads.get(job['file'])
+
+
+class JobError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
@@ -0,0 +1,148 @@
+# coding=utf-8
+"""
+Logging which never lets the SD card slow down the printer.
+
+The AsyncRotatingFileHandler just puts the records into a bounded queue. A writer thread takes them from there,
+writes them in batches to the log file and rotates it when it gets too big. If the writer cannot keep up debug
+records are dropped first - and if the queue is full everything is dropped - but the logging thread never waits.
+"""
+from Queue import Queue, Empty, Full
+import logging
+import os
+from threading import Thread
+import threading
+import time
+
+__author__ = 'marcus'
+
+_default_max_bytes = 10 * 1024 * 1024
+_default_backup_count = 3
+_default_queue_size = 10000
+_default_batch_size = 500
+# above this fill level of the queue debug records are dropped
+_default_debug_high_water = 0.5
+_stop_wait_time = 5
+
+
+class AsyncRotatingFileHandler(logging.Handler):
+    def __init__(self, filename, max_bytes=_default_max_bytes, backup_count=_default_backup_count,
+                 queue_size=_default_queue_size, batch_size=_default_batch_size,
+                 debug_high_water=_default_debug_high_water):
+        logging.Handler.__init__(self)
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self._queue = Queue(maxsize=queue_size)
+        self._debug_limit = int(queue_size * debug_high_water)
+        self.dropped_records = 0
+        self._dropped_lock = threading.Lock()
+        self._stream = None
+        self._size = 0
+        self._running = True
+        self._writer_thread = Thread(target=self._write)
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    def emit(self, record):
+        # this runs on the thread which logs - so it must be quick
+        if record.levelno <= logging.DEBUG and self._queue.qsize() >= self._debug_limit:
+            self._drop()
+            return
+        try:
+            self._queue.put_nowait(self._prepare(record))
+        except Full:
+            self._drop()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        # wait until everything that got logged so far has been written
+        if self._running and self._writer_thread.isAlive() and not self._writer_thread is threading.current_thread():
+            self._queue.join()
+
+    def close(self):
+        if self._running:
+            self._running = False
+            # wake up the writer - it writes everything left and stops
+            self._queue.put(None)
+            self._writer_thread.join(_stop_wait_time)
+        logging.Handler.close(self)
+
+    def _prepare(self, record):
+        # the arguments may have changed until the writer gets to them - so we format them now
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info) if self.formatter else \
+                logging._defaultFormatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _drop(self):
+        with self._dropped_lock:
+            self.dropped_records += 1
+
+    def _write(self):
+        reported_drops = 0
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            lines = []
+            for record in batch:
+                if record is None:
+                    stop = True
+                    continue
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+            if self.dropped_records != reported_drops:
+                lines.append("%s - %s - WARNING - Dropped %s log records, the log file could not keep up" % (
+                    time.strftime("%Y-%m-%d %H:%M:%S"), __name__, self.dropped_records - reported_drops))
+                reported_drops = self.dropped_records
+            if lines:
+                try:
+                    self._write_lines(lines)
+                except (IOError, OSError):
+                    self.handleError(batch[0])
+            for record in batch:
+                self._queue.task_done()
+        if self._stream:
+            self._stream.close()
+            self._stream = None
+
+    def _write_lines(self, lines):
+        if not self._stream:
+            self._stream = open(self.filename, 'a')
+            self._size = self._stream.tell()
+        text = "\n".join(lines) + "\n"
+        if self.max_bytes and self._size + len(text) > self.max_bytes and self._size > 0:
+            self._rollover()
+        self._stream.write(text)
+        self._stream.flush()
+        self._size += len(text)
+
+    def _rollover(self):
+        self._stream.close()
+        # just like the RotatingFileHandler: t_bone.log -> t_bone.log.1 -> t_bone.log.2 …
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = "%s.%d" % (self.filename, i)
+                destination = "%s.%d" % (self.filename, i + 1)
+                if os.path.exists(source):
+                    if os.path.exists(destination):
+                        os.remove(destination)
+                    os.rename(source, destination)
+            destination = self.filename + ".1"
+            if os.path.exists(destination):
+                os.remove(destination)
+            os.rename(self.filename, destination)
+        self._stream = open(self.filename, 'w')
+        self._size = 0
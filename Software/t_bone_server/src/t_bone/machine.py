@@ -7,7 +7,8 @@ import serial
 import threading
 import time
 from math import floor
-import Adafruit_BBIO.GPIO as GPIO
+from hardware import GPIO
+import tracing
 
 __author__ = 'marcus'
 
@@ -21,34 +22,47 @@ clock_frequency = 16000000
 
 _logger = logging.getLogger(__name__)
 
+# the direction of a frame on the serial line - for the recorder
+OUT = 0
+IN = 1
+
 MAXIMUM_FREQUENCY_ACCELERATION = 2 ** 22 - 2
 MAXIMUM_FREQUENCY_BOW = 2 ** 24 - 2
 
 
 class Machine():
-    def __init__(self, serial_port, reset_pin):
-        # preapre the reset pin
+    def __init__(self, serial_port, reset_pin=None):
+        # preapre the reset pin - w/o a reset pin (e.g. the firmware simulator) we cannot reset the arduino
         self.reset_pin = reset_pin
         _logger.debug("Defining ports & pins")
-        GPIO.setup(self.reset_pin, GPIO.OUT)
-        GPIO.output(self.reset_pin, GPIO.HIGH)
+        if self.reset_pin:
+            GPIO.setup(self.reset_pin, GPIO.OUT)
+            GPIO.output(self.reset_pin, GPIO.HIGH)
         self.serial_port = serial_port
         self.remaining_buffer = ""
         self.machine_connection = None
         self.command_queue = Queue()
         self.batch_mode = False
 
-    def connect(self):
-        _logger.info("resetting arduino at %s", self.serial_port)
-        GPIO.output(self.reset_pin, GPIO.LOW)
-        # reset the arduino
-        time.sleep(1)
-        GPIO.output(self.reset_pin, GPIO.HIGH)
-        time.sleep(15)
+    def connect(self, serial_reactor=None, serial_recorder=None):
+        """
+        serial_reactor: watches the serial line - instead of a listening thread of its own
+        serial_recorder: records everything on the serial line
+        """
+        if self.reset_pin:
+            _logger.info("resetting arduino at %s", self.serial_port)
+            GPIO.output(self.reset_pin, GPIO.LOW)
+            # reset the arduino
+            time.sleep(1)
+            GPIO.output(self.reset_pin, GPIO.HIGH)
+            time.sleep(15)
         _logger.info("waiting for arduino")
         if not self.machine_connection:
             machineSerial = serial.Serial(self.serial_port, 38400, timeout=_default_timeout)
-            self.machine_connection = _MachineConnection(machineSerial)
+            if serial_reactor:
+                self.machine_connection = serial_reactor.connect(machineSerial, recorder=serial_recorder)
+            else:
+                self.machine_connection = _MachineConnection(machineSerial, recorder=serial_recorder)
         init_command = MachineCommand()
         init_command.command_number = 9
         reply = self.machine_connection.send_command(init_command)
@@ -234,10 +248,18 @@ class Machine():
         self.batch_mode = False
 
 
-    def move_to(self, motors):
+    def move_to(self, motors, trace=None):
+        command = self.create_move_command(motors)
+        if command:
+            self.send_move_command(command, trace=trace)
+
+    def create_move_command(self, motors):
+        debug = _logger.isEnabledFor(logging.DEBUG)
+        # this does not talk to the machine - so moves can be prepared on any thread
         if not motors:
-            _logger.debug("Move_to: Warning! no motor to move??")
-            return
+            if debug:
+                _logger.debug("Move_to: Warning! no motor to move??")
+            return None
         command = MachineCommand()
         command.command_number = 10
         command.arguments = []
@@ -257,9 +279,10 @@ class Machine():
                 #command.arguments.append(bow_)
                 command.arguments.append(abs(float(min(floor(motor['entry_speed']),motor['nominal_speed']))))
                 command.arguments.append(abs(float(min(floor(motor['exit_speed']),motor['nominal_speed']))))
-                _logger.debug("Move_to: %s to target %s as %s with nominal speed %s, entry speed %s and exit speed %s."
-                    " Accel: %s", int(motor['motor']), int(motor['target']), motor['type'],motor['nominal_speed'],
-                    motor['entry_speed'],motor['exit_speed'],motor['acceleration'])
+                if debug:
+                    _logger.debug("Move_to: %s to target %s as %s with nominal speed %s, entry speed %s and exit speed %s."
+                        " Accel: %s", int(motor['motor']), int(motor['target']), motor['type'],motor['nominal_speed'],
+                        motor['entry_speed'],motor['exit_speed'],motor['acceleration'])
             else:
                 for index, axis_motor in enumerate(motor):
                     command.arguments.append(int(axis_motor['motor']))
@@ -276,14 +299,16 @@ class Machine():
                     #command.arguments.append(bow_)
                     command.arguments.append(abs(float(min(floor(axis_motor['entry_speed']),axis_motor['nominal_speed']))))
                     command.arguments.append(abs(float(min(floor(axis_motor['exit_speed']),axis_motor['nominal_speed']))))
-                    _logger.debug("Move_to: %s to target %s as %s with nominal speed %s, entry speed %s and exit speed %s."
-                    " Accel: %s", int(axis_motor['motor']), int(axis_motor['target']), axis_motor['type'],
-                    axis_motor['nominal_speed'],axis_motor['entry_speed'],axis_motor['exit_speed'],
-                    axis_motor['acceleration'])
-
-
+                    if debug:
+                        _logger.debug("Move_to: %s to target %s as %s with nominal speed %s, entry speed %s and exit speed %s."
+                        " Accel: %s", int(axis_motor['motor']), int(axis_motor['target']), axis_motor['type'],
+                        axis_motor['nominal_speed'],axis_motor['entry_speed'],axis_motor['exit_speed'],
+                        axis_motor['acceleration'])
+        return command
 
-        reply = self.machine_connection.send_command(command)
+    def send_move_command(self, command, trace=None):
+        debug = _logger.isEnabledFor(logging.DEBUG)
+        reply = self.machine_connection.send_command(command, trace=trace)
         if not reply or reply.command_number != 0:
             _logger.error("Unable to move motor: %s -> %s", command, reply)
             raise MachineError("Unable to add motor move", reply)
@@ -292,7 +317,8 @@ class Machine():
             command_max_buffer_length = int(reply.arguments[1])
             command_buffer_free = command_max_buffer_length - command_buffer_length
             command_queue_running = int(reply.arguments[2]) > 0
-            _logger.debug("Arduino command Buffer at %s of %s", command_buffer_length, command_max_buffer_length)
+            if debug:
+                _logger.debug("Arduino command Buffer at %s of %s", command_buffer_length, command_max_buffer_length)
             if command_queue_running and command_buffer_free <= _min_command_buffer_free_space:
                 buffer_free = False
                 wait_time = 0
@@ -313,7 +339,7 @@ class Machine():
                                 "Waiting for free arduino command buffer: %s free of % s total, waiting for %s free",
                                 command_buffer_free, command_buffer_length, _min_command_buffer_free_space)
                             wait_time = 0
-                        else:
+                        elif debug:
                             _logger.debug("waiting for free buffer")
                     else:
                         _logger.warn("Waiting for a free command timed out!")
@@ -378,16 +404,22 @@ class Machine():
 
 
 class _MachineConnection:
-    def __init__(self, machine_serial):
+    def __init__(self, machine_serial, recorder=None):
         self.listening_thread = Thread(target=self)
         self.machine_serial = machine_serial
+        self.recorder = recorder
         self.remaining_buffer = ""
         self.response_queue = Queue()
         # let's suck empty the serial connection by reading everything with an extremely short timeout
         init_start = time.clock()
         last = ''
+        drained = ''
         while not last is ';' and time.clock() - init_start < _default_timeout:
             last = machine_serial.read()
+            drained += last
+        if recorder and last == ';':
+            # that is something the machine said as well
+            recorder.record(IN, drained[:-1].strip())
             #after we have started let's see if the connection is alive
         command = None
         while (not command or command.command_number != -128) and time.clock() - init_start < _default_timeout:
@@ -408,36 +440,38 @@ class _MachineConnection:
             self.listening_thread.join()
         with self.serial_lock:
             self.machine_serial.close()
+        if self.recorder:
+            self.recorder.stop()
 
-    def send_command(self, command, timeout=None):
+    def send_command(self, command, timeout=None, trace=None):
+        debug = _logger.isEnabledFor(logging.DEBUG)
         with self.serial_lock:
-            _logger.debug("sending command %s", command)
+            if debug:
+                _logger.debug("sending command %s", command)
             if not timeout:
                 timeout = _default_timeout
                 # empty the queue?? shouldn't it be empty??
             self.response_queue.empty()
-            self.machine_serial.write(str(command.command_number))
-            if command.arguments:
-                self.machine_serial.write(",")
-                for param in command.arguments[:-1]:
-                    if isinstance(param, float):
-                        self.machine_serial.write("%.6g" % param)
-                        # todo on the other hand an e representation may as well be helpful?
-                    else:
-                        self.machine_serial.write(repr(param))
-                    self.machine_serial.write(",")
-                self.machine_serial.write(repr(command.arguments[-1]))
-            self.machine_serial.write(";\n")
+            line = encode_command(command)
+            self.machine_serial.write(line)
             self.machine_serial.flush()
+            if self.recorder:
+                self.recorder.record(OUT, line.rstrip(';\n'))
+            if trace:
+                trace.stamp(tracing.WRITTEN)
             try:
                 while True:
                     response = self.response_queue.get(timeout=timeout)
                     if not response.command_number == -1:
-                        _logger.debug("Received %s as response to %s", response, command)
+                        if trace:
+                            trace.stamp(tracing.ACKNOWLEDGED)
+                        if debug:
+                            _logger.debug("Received %s as response to %s", response, command)
                         return response
                     else:
                         # todo do we timeout here?
-                        _logger.debug("Still waiting: %s", response)
+                        if debug:
+                            _logger.debug("Still waiting: %s", response)
             except Empty:
                 # disconnect in panic
                 self.run_on = False
@@ -452,7 +486,15 @@ class _MachineConnection:
 
     def __call__(self, *args, **kwargs):
         while self.run_on:
-            command = self._read_next_command()
+            # looked at for each command - the logging config may change while we listen
+            debug = _logger.isEnabledFor(logging.DEBUG)
+            try:
+                command = self._read_next_command()
+            except (serial.SerialException, OSError):
+                if not self.run_on:
+                    # the line went away while we stopped listening anyway
+                    return
+                raise
             if command:
                 # if it is just the heart beat we write down the time
                 if command.command_number == -128:
@@ -465,14 +507,19 @@ class _MachineConnection:
                 else:
                     # we add it to the response queue
                     self.response_queue.put(command)
-                    _logger.debug("received command %s", command)
+                    if debug:
+                        _logger.debug("received command %s", command)
 
     def _read_next_command(self):
+        debug = _logger.isEnabledFor(logging.DEBUG)
         line = self._doRead()  # read a ';' terminated line
         if not line or not line.strip():
             return None
         line = line.strip()
-        _logger.debug("machine said:\'%s\'", line)
+        if self.recorder:
+            self.recorder.record(IN, line)
+        if debug:
+            _logger.debug("machine said:\'%s\'", line)
         command = MachineCommand(line)
         return command
 
@@ -493,6 +540,22 @@ class _MachineConnection:
             return ''
 
 
+def encode_command(command):
+    # the line the arduino gets for a command
+    line = str(command.command_number)
+    if command.arguments:
+        parameters = []
+        for param in command.arguments[:-1]:
+            if isinstance(param, float):
+                parameters.append("%.6g" % param)
+                # todo on the other hand an e representation may as well be helpful?
+            else:
+                parameters.append(repr(param))
+        parameters.append(repr(command.arguments[-1]))
+        line += "," + ",".join(parameters)
+    return line + ";\n"
+
+
 class MachineCommand():
     def __init__(self, input_line=None):
         self.command_number = None
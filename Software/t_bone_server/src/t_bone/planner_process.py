@@ -0,0 +1,553 @@
+# coding=utf-8
+"""
+Reading and planning a print in a process of its own.
+
+Parsing, planning, the heaters, the serial connection and the web server all share one interpreter lock - so a slow
+recalculation of the plan or a burst of requests delays the moves on their way to the machine. With the planner
+process the g code file is read and planned by a worker process. The printer thread just takes the planned blocks and
+sends them.
+
+The blocks go through a BlockRing - a ring buffer of fixed size records in shared memory. Only the worker moves the
+head and only the printer moves the tail, so there is no lock: the worker writes a record before it moves the head, the
+printer reads it before it moves the tail. If the ring is full the worker waits, if it is empty the printer does. A
+worker which ends without a word ends the print with an error - the printer does not wait for it forever.
+
+The worker runs this module as a script of its own - neither the threads of the server nor their locks (e.g. the
+one of the log writer) come along. It gets the configured axis and planner settings of the printer and compiles the
+moves just like the printer would, it just never talks to the machine. The ring is a file in memory both processes
+map. Lines which are no moves - heaters, homing, the fan - are passed through the ring as text and the printer thread
+executes them when it gets there. Homing ends the moves planned so far and the worker plans on from the homed axis.
+"""
+import getopt
+import json
+import logging
+import mmap
+import os
+from Queue import Empty
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from helpers import python_command
+from machine import Machine, MachineCommand
+from printer import Printer
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+# the records in the ring
+MOVE = 1
+SET_POSITION = 2
+LINE = 3
+END = 4
+ERROR = 5
+
+# the g codes the worker handles itself - the rest goes to the printer
+PLANNED_CODES = frozenset(('G0', 'G1', 'G2', 'G3', 'G92', 'G20', 'G21', 'G90', 'G91', 'M82', 'M83'))
+# the printer executes them - but the worker has to know where the axis are afterwards
+HOMING_CODES = frozenset(('G28',))
+_block_axis_names = ('x', 'y', 'z', 'e')
+_block_speed_keys = ('millimeters', 'acceleration', 'entry_speed', 'nominal_speed', 'exit_speed')
+_max_motors = 8
+# motor, target, type, nominal speed, acceleration, entry speed, exit speed
+_motor_arguments = 7
+_text_size = 128
+# kind, number of motors, the axis set by a set position, text length, which motor arguments are integers,
+# positions, speeds, motor arguments, text
+_record = struct.Struct('<BBHH2xQ%sd%sd%sd%ss' % (len(_block_axis_names), len(_block_speed_keys),
+                                                   _max_motors * _motor_arguments, _text_size))
+_empty_positions = (0.0,) * len(_block_axis_names)
+_empty_speeds = (0.0,) * len(_block_speed_keys)
+_empty_arguments = (0.0,) * (_max_motors * _motor_arguments)
+_positions_start = 5
+_speeds_start = _positions_start + len(_block_axis_names)
+_arguments_start = _speeds_start + len(_block_speed_keys)
+
+# head & tail are 32 bit - so they are written in one go
+_counter = struct.Struct('<I')
+_progress = struct.Struct('<IQ')
+_head_offset = 0
+_tail_offset = 4
+_stop_offset = 8
+_reading_finished_offset = 12
+_progress_offset = 16
+_header_size = 32
+
+_default_ring_size = 256
+# how long both sides wait before they look at the ring again
+_ring_wait_time = 0.001
+_finish_wait_time = 0.01
+_worker_join_timeout = 5.0
+# a stopped printer may never take another block - how long the worker waits for room then
+_stopped_write_timeout = 5.0
+# the ring is a file in memory if there is such a place
+_ring_directory = '/dev/shm'
+
+
+class BlockRing(object):
+    """
+    A ring of planned blocks in shared memory - for exactly one writer and one reader.
+    """
+
+    def __init__(self, capacity=_default_ring_size, path=None):
+        """
+        path: the file to map - so another process can map it too, anonymous memory if None
+        """
+        if capacity < 1:
+            raise PlannerProcessError("The ring needs room for at least one block, not %s" % capacity)
+        self.capacity = capacity
+        self.path = path
+        size = ring_file_size(capacity)
+        if path:
+            with open(path, 'r+b') as ring_file:
+                self.buffer = mmap.mmap(ring_file.fileno(), size)
+        else:
+            self.buffer = mmap.mmap(-1, size)
+        # head & tail run to twice the capacity - so a full ring is different from an empty one
+        self._positions = 2 * capacity
+        self.stopped_write_timeout = _stopped_write_timeout
+
+    def write(self, values):
+        head = self._get(_head_offset)
+        tail = self._get(_tail_offset)
+        deadline = None
+        while (head - tail) % self._positions >= self.capacity:
+            if self.stopped:
+                # as long as the printer takes blocks it gets them - if it does not it is gone
+                if deadline is None:
+                    deadline = time.time() + self.stopped_write_timeout
+                elif time.time() >= deadline:
+                    raise PlannerProcessError("Nobody takes the blocks of the stopped ring")
+            time.sleep(_ring_wait_time)
+            if self._get(_tail_offset) != tail:
+                tail = self._get(_tail_offset)
+                deadline = None
+        _record.pack_into(self.buffer, self._record_offset(head), *values)
+        # only now the reader may take it
+        self._set(_head_offset, (head + 1) % self._positions)
+
+    def read(self, timeout=None):
+        tail = self._get(_tail_offset)
+        if self._get(_head_offset) == tail:
+            deadline = None if timeout is None else time.time() + timeout
+            while self._get(_head_offset) == tail:
+                if deadline is not None and time.time() >= deadline:
+                    raise Empty()
+                time.sleep(_ring_wait_time)
+        values = _record.unpack_from(self.buffer, self._record_offset(tail))
+        self._set(_tail_offset, (tail + 1) % self._positions)
+        return values
+
+    def qsize(self):
+        return (self._get(_head_offset) - self._get(_tail_offset)) % self._positions
+
+    def empty(self):
+        return self._get(_head_offset) == self._get(_tail_offset)
+
+    @property
+    def stopped(self):
+        return self._get(_stop_offset) == 1
+
+    def stop(self):
+        self._set(_stop_offset, 1)
+
+    @property
+    def reading_finished(self):
+        return self._get(_reading_finished_offset) == 1
+
+    def finish_reading(self):
+        self._set(_reading_finished_offset, 1)
+
+    def progress(self):
+        # the lines and bytes the worker has read
+        return _progress.unpack_from(self.buffer, _progress_offset)
+
+    def set_progress(self, lines, bytes_read):
+        _progress.pack_into(self.buffer, _progress_offset, lines, bytes_read)
+
+    def close(self):
+        self.buffer.close()
+
+    def _record_offset(self, position):
+        return _header_size + (position % self.capacity) * _record.size
+
+    def _get(self, offset):
+        return _counter.unpack_from(self.buffer, offset)[0]
+
+    def _set(self, offset, value):
+        _counter.pack_into(self.buffer, offset, value)
+
+
+def ring_file_size(capacity):
+    return _header_size + capacity * _record.size
+
+
+def create_ring_file(capacity):
+    # all zeros - an empty ring
+    directory = _ring_directory if os.path.isdir(_ring_directory) else None
+    handle, path = tempfile.mkstemp(prefix='planner-', suffix='.ring', dir=directory)
+    try:
+        os.ftruncate(handle, ring_file_size(capacity))
+    finally:
+        os.close(handle)
+    return path
+
+
+def encode_block(movement):
+    """
+    Turns a movement which left the print queue into the values of a ring record.
+    """
+    positions = tuple(float(movement[axis_name]) for axis_name in _block_axis_names)
+    if movement['type'] == 'move':
+        command = movement['move_command']
+        arguments = command.arguments if command else []
+        motor_count = len(arguments) // _motor_arguments
+        if motor_count > _max_motors:
+            raise PlannerProcessError("Cannot pass a move of %s motors through the ring" % motor_count)
+        speeds = tuple(float(movement[key]) for key in _block_speed_keys)
+        # the machine gets integers written differently
+        integer_arguments = 0
+        for index, argument in enumerate(arguments):
+            if isinstance(argument, (int, long)):
+                integer_arguments |= 1 << index
+        arguments = tuple(float(argument) for argument in arguments) + _empty_arguments[len(arguments):]
+        return (MOVE, motor_count, 0, 0, integer_arguments) + positions + speeds + arguments + ('',)
+    elif movement['type'] == 'set_position':
+        set_axis = 0
+        for index, axis_name in enumerate(_block_axis_names):
+            if 's%s' % axis_name in movement:
+                set_axis |= 1 << index
+        return (SET_POSITION, 0, set_axis, 0, 0) + positions + _empty_speeds + _empty_arguments + ('',)
+    raise PlannerProcessError("Cannot pass a movement of type %s through the ring" % movement['type'])
+
+
+def encode_text(kind, text):
+    # lines & errors - longer lines are no moves, nothing important gets lost
+    text = text[:_text_size]
+    return (kind, 0, 0, len(text), 0) + _empty_positions + _empty_speeds + _empty_arguments + (text,)
+
+
+def decode_block(values):
+    """
+    Turns the values of a MOVE or SET_POSITION record back into a movement for the printer.
+    """
+    kind = values[0]
+    movement = dict(zip(_block_axis_names, values[_positions_start:_speeds_start]))
+    if kind == MOVE:
+        movement['type'] = 'move'
+        movement.update(zip(_block_speed_keys, values[_speeds_start:_arguments_start]))
+        motor_count = values[1]
+        if motor_count:
+            integer_arguments = values[4]
+            command = MachineCommand()
+            command.command_number = 10
+            command.arguments = list(values[_arguments_start:_arguments_start + motor_count * _motor_arguments])
+            for index, argument in enumerate(command.arguments):
+                if integer_arguments & (1 << index):
+                    command.arguments[index] = int(argument)
+            movement['move_command'] = command
+        else:
+            movement['move_command'] = None
+    else:
+        movement['type'] = 'set_position'
+        set_axis = values[2]
+        for index, axis_name in enumerate(_block_axis_names):
+            if set_axis & (1 << index):
+                movement['s%s' % axis_name] = movement[axis_name]
+    return movement
+
+
+def decode_text(values):
+    return values[-1][:values[3]]
+
+
+class PlannerProcess(object):
+    """
+    Plans a g code file in a worker process. While the file is printed it stands in for the print queue of the
+    printer - the printer thread takes the planned blocks from here.
+    """
+
+    def __init__(self, printer, file, gcode_reader, start_offset=0, start_lines=None, ring_size=_default_ring_size):
+        self.printer = printer
+        self.file = file
+        # reads a line of g code to a printer - for the moves in the worker & the rest in the printer thread
+        self.gcode_reader = gcode_reader
+        self.start_offset = start_offset
+        # planned before the file - to restore the position when starting in the middle
+        self.start_lines = start_lines or []
+        self.ring = BlockRing(ring_size, path=create_ring_file(ring_size))
+        # the printer got everything the worker planned
+        self.finished = False
+        self.error = None
+        self._process = None
+        self._settings_file = None
+
+    def start(self):
+        handle, self._settings_file = tempfile.mkstemp(prefix='planner-', suffix='.json')
+        with os.fdopen(handle, 'w') as settings_file:
+            json.dump(planning_settings(self.printer, self.start_lines), settings_file)
+        self._process = subprocess.Popen(python_command(__file__, '--settings=%s' % self._settings_file,
+                                                        '--ring=%s' % self.ring.path,
+                                                        '--ring-size=%s' % self.ring.capacity,
+                                                        '--start-offset=%s' % self.start_offset, self.file),
+                                         close_fds=True)
+        _logger.info("Planning %s in process %s", self.file, self._process.pid)
+
+    def stop(self):
+        # the worker stops reading - whatever is planned already gets printed
+        self.ring.stop()
+
+    @property
+    def reading_finished(self):
+        if self.ring.reading_finished or self.finished:
+            return True
+        # a worker which is gone does not read any more - even if it could not say so
+        return self._process is not None and self._process.poll() is not None
+
+    def progress(self):
+        return self.ring.progress()
+
+    def next_movement_to_execute(self, timeout=None):
+        while True:
+            if self.finished:
+                time.sleep(timeout or 0)
+                raise Empty()
+            values = self.ring.read(timeout)
+            kind = values[0]
+            if kind == MOVE or kind == SET_POSITION:
+                return decode_block(values)
+            elif kind == LINE:
+                self._execute_line(decode_text(values))
+            elif kind == ERROR:
+                self.error = decode_text(values)
+                _logger.error("Unable to plan %s: %s", self.file, self.error)
+                self.finished = True
+            else:
+                self.finished = True
+
+    def finish(self, timeout=None):
+        # waits until the printer got everything
+        while not self.finished:
+            if self._process.poll() is not None and self.ring.empty():
+                if not self.finished:
+                    self.error = "The planner for %s ended unexpectedly" % self.file
+                    _logger.error(self.error)
+                    self.finished = True
+                break
+            time.sleep(_finish_wait_time)
+        deadline = time.time() + _worker_join_timeout
+        while self._process.poll() is None and time.time() < deadline:
+            time.sleep(_finish_wait_time)
+        if self._process.poll() is None:
+            _logger.warn("The planner for %s did not end - terminating it", self.file)
+            self._process.terminate()
+            self._process.wait()
+        self.ring.close()
+        for temporary_file in (self.ring.path, self._settings_file):
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+
+    def _execute_line(self, line):
+        try:
+            self.gcode_reader(line, self.printer)
+        except Exception as e:
+            _logger.exception("Unable to execute %s", line)
+            self.error = "Unable to execute %s: %s" % (line, e)
+            self.stop()
+
+    def __str__(self):
+        return "%s blocks planned" % self.ring.qsize()
+
+
+class _BlockSink(object):
+    # takes the place of the execution queue of the print queue in the worker
+    def __init__(self, ring):
+        self.ring = ring
+
+    def put(self, movement, timeout=None):
+        self.ring.write(encode_block(movement))
+
+    def qsize(self):
+        return self.ring.qsize()
+
+    def empty(self):
+        return self.ring.empty()
+
+
+class _NoTracer(object):
+    # traces do not cross the process boundary
+    def start(self):
+        return None
+
+
+class _CompilingPrinter(Printer):
+    """
+    Just the configured axis of a printer - enough to plan & compile the moves. There is no printer thread, no heater
+    and no machine connection - so it is no Thread either.
+    """
+
+    def __init__(self, settings):
+        self.axis = settings['axis']
+        self.print_queue_min_length = settings['min-length']
+        self.print_queue_max_length = settings['max-length']
+        self.default_speed = settings['default-speed']
+        self.segment_coalescing = settings['segment-coalescing']
+        self.arc_settings = settings['arc-settings']
+        self.homed = settings['homed']
+        # it only creates the move commands
+        self.machine = Machine(serial_port=None)
+        self._postconfig()
+
+
+class PlanningPrinter(object):
+    """
+    What the worker reads the moves to - it just plans them. The print analyzer reads the moves to it too.
+    """
+
+    def __init__(self, print_queue, axis, homed):
+        self.print_queue = print_queue
+        self.axis = axis
+        self.homed = homed
+        self.tracer = _NoTracer()
+
+    def move_to(self, position):
+        position['type'] = 'move'
+        self.print_queue.plan_new_movement(position)
+
+    def arc_to(self, position, clockwise):
+        position['type'] = 'move'
+        self.print_queue.plan_arc(position, clockwise)
+
+    def set_position(self, positions):
+        if positions:
+            positions['type'] = 'set_position'
+            self.print_queue.plan_new_movement(positions)
+
+    def home(self, axis):
+        # the printer thread does the homing - the axis it homes are at 0 afterwards
+        homed_axis = [axis_name for axis_name in axis if self.axis[axis_name]['end-stops'].get('left')]
+        self.set_position(dict((axis_name, 0.0) for axis_name in homed_axis))
+
+
+def gcode_command(line):
+    # just the g code - without comment & options, None for an empty line
+    words = line.split(';', 1)[0].split(None, 1)
+    return words[0] if words else None
+
+
+def planning_settings(printer, start_lines=None):
+    """
+    What the worker needs to know of the configured printer.
+    """
+    return {
+        'axis': printer.axis,
+        'min-length': printer.print_queue_min_length,
+        'max-length': printer.print_queue_max_length,
+        'default-speed': printer.default_speed,
+        'segment-coalescing': printer.segment_coalescing,
+        'arc-settings': printer.arc_settings,
+        'homed': printer.homed,
+        'start-lines': start_lines or []
+    }
+
+
+def _plan(printer, ring, file_name, start_offset, start_lines, gcode_reader):
+    # runs in the worker process
+    print_queue = printer.create_print_queue()
+    print_queue.execution_queue = _BlockSink(ring)
+    planning_printer = PlanningPrinter(print_queue, printer.axis, printer.homed)
+    lines = 0
+    bytes_read = 0
+    try:
+        for line in start_lines:
+            gcode_reader(line, planning_printer)
+        with open(file_name) as gcode_file:
+            gcode_file.seek(start_offset)
+            for line in gcode_file:
+                if ring.stopped:
+                    break
+                code = line.split(';', 1)[0].strip()
+                if code:
+                    command = gcode_command(code)
+                    if command in PLANNED_CODES:
+                        gcode_reader(line, planning_printer)
+                    elif command in HOMING_CODES:
+                        # everything before gets to the machine before it homes
+                        print_queue.flush()
+                        ring.write(encode_text(LINE, code))
+                        gcode_reader(line, planning_printer)
+                    else:
+                        ring.write(encode_text(LINE, code))
+                lines += 1
+                bytes_read += len(line)
+                ring.set_progress(lines, bytes_read)
+        ring.finish_reading()
+        print_queue.flush()
+        ring.write(encode_text(END, ''))
+    except PlannerProcessError as e:
+        # the printer does not read the ring any more - it would not read an error either
+        ring.finish_reading()
+        _logger.warn("Stopped planning %s: %s", file_name, e)
+    except Exception as e:
+        ring.finish_reading()
+        ring.write(encode_text(ERROR, str(e)))
+
+
+class PlannerProcessError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def main(argv=None):
+    usage = "usage: planner_process.py --settings=settings.json --ring=file.ring [--ring-size=%s] " \
+            "[--start-offset=0] file.gcode" % _default_ring_size
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "s:r:n:o:h", ["settings=", "ring=", "ring-size=", "start-offset=", "help"])
+    except getopt.error, msg:
+        print >> sys.stderr, msg
+        print >> sys.stderr, usage
+        return 2
+    settings_file = None
+    ring_file = None
+    ring_size = _default_ring_size
+    start_offset = 0
+    for opt, value in opts:
+        if opt in ("-h", "--help"):
+            print usage
+            return 0
+        elif opt in ("-s", "--settings"):
+            settings_file = value
+        elif opt in ("-r", "--ring"):
+            ring_file = value
+        elif opt in ("-n", "--ring-size"):
+            ring_size = int(value)
+        elif opt in ("-o", "--start-offset"):
+            start_offset = int(value)
+    if not settings_file or not ring_file or len(args) != 1:
+        print >> sys.stderr, usage
+        return 2
+    # none of the handlers of the server - the worker just complains on stderr
+    logging.basicConfig(level=logging.WARN)
+    # the interpreter imports this module - so it is imported here
+    from gcode_interpreter import read_gcode_to_printer
+    with open(settings_file) as settings_input:
+        settings = json.load(settings_input)
+    ring = BlockRing(ring_size, path=ring_file)
+    try:
+        _plan(_CompilingPrinter(settings), ring, args[0], start_offset, settings['start-lines'],
+              read_gcode_to_printer)
+    finally:
+        ring.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,399 @@
+# coding=utf-8
+"""
+Estimates how long a print takes - without a printer.
+
+The g code is read just like in the planner process and runs through the same PrintQueue and Planner as on the
+printer. But instead of going to the T-Bone the planned blocks are taken from the execution queue and the durations of
+their speed trapezoids are added up - for the whole print and for each layer, together with the maximum speeds and how
+much of the time is spent accelerating.
+
+The AnalysisService runs each analysis in a python process of its own and keeps the results next to the g code file.
+The process is started from scratch - a fork of the threaded server could inherit locks held by its other threads.
+"""
+from Queue import Queue, Empty
+import getopt
+import hashlib
+import json
+import logging
+from math import sqrt
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from gcode_interpreter import read_gcode_to_printer
+from helpers import python_command, trapezoid_profile
+import json_config_file
+from planner_process import PlanningPrinter, PLANNED_CODES, HOMING_CODES, gcode_command
+from printer import PrintQueue, PrinterError, read_segment_coalescing_settings, read_arc_settings, \
+    read_axis_limits
+from segment_coalescer import SegmentCoalescer
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+ANALYSIS_SUFFIX = '.analysis.json'
+_axis_names = ('x', 'y', 'z', 'e')
+
+
+class PrintAnalyzer(object):
+    def __init__(self, config):
+        printer_config = config['printer']
+        # the planner just needs the limits of each axis
+        self.axis = read_axis_limits(config)
+        self.print_queue_min_length = printer_config['print-queue']['min-length']
+        self.print_queue_max_length = printer_config['print-queue']['max-length']
+        self.default_speed = printer_config['default-speed']
+        self.segment_coalescing = read_segment_coalescing_settings(printer_config)
+        self.arc_settings = read_arc_settings(printer_config)
+
+    def analyze_file(self, filename):
+        with open(filename) as gcode_file:
+            return self.analyze_lines(gcode_file)
+
+    def analyze_lines(self, lines):
+        coalescer = None
+        if self.segment_coalescing is not None:
+            coalescer = SegmentCoalescer(**self.segment_coalescing)
+        print_queue = PrintQueue(axis_config=self.axis, min_length=self.print_queue_min_length,
+                                 max_length=self.print_queue_max_length, default_target_speed=self.default_speed,
+                                 coalescer=coalescer, arc_settings=self.arc_settings)
+        # nobody takes the blocks from the queue while we plan - so it must not block
+        print_queue.execution_queue = Queue()
+        statistics = _PrintStatistics()
+        # the moves are read just like in the planner process - heaters & co. do not take any time here
+        planning_printer = _AnalyzingPrinter(print_queue, self.axis, statistics)
+        start = time.time()
+        line_number = 0
+        for line in lines:
+            line_number += 1
+            command = gcode_command(line)
+            if command in PLANNED_CODES or command in HOMING_CODES:
+                try:
+                    read_gcode_to_printer(line, planning_printer)
+                except PrinterError as e:
+                    raise AnalysisError("Unable to analyze line %s: %s" % (line_number, e.msg))
+            statistics.add_blocks(_take_blocks(print_queue))
+        print_queue.flush()
+        statistics.add_blocks(_take_blocks(print_queue))
+        result = statistics.to_dict()
+        result['lines'] = line_number
+        result['analysis_time'] = time.time() - start
+        if result['analysis_time'] > 0:
+            result['blocks_per_second'] = result['blocks'] / result['analysis_time']
+        return result
+
+
+def analyze_file(filename, config):
+    return PrintAnalyzer(config).analyze_file(filename)
+
+
+class _AnalyzingPrinter(PlanningPrinter):
+    # counts the homings on the way
+    def __init__(self, print_queue, axis, statistics):
+        super(_AnalyzingPrinter, self).__init__(print_queue, axis, homed=False)
+        self.statistics = statistics
+
+    def home(self, axis):
+        self.statistics.homings += 1
+        super(_AnalyzingPrinter, self).home(axis)
+
+
+def _take_blocks(print_queue):
+    blocks = []
+    while True:
+        try:
+            blocks.append(print_queue.execution_queue.get_nowait())
+        except Empty:
+            return blocks
+
+
+class _PrintStatistics(object):
+    def __init__(self):
+        self.blocks = 0
+        self.homings = 0
+        self.acceleration_time = 0.0
+        self.cruise_time = 0.0
+        self.deceleration_time = 0.0
+        self.distance = 0.0
+        self.extrusion = 0.0
+        self.max_speed = 0.0
+        self.max_axis_speeds = dict((axis_name, 0.0) for axis_name in _axis_names)
+        self.layers = []
+        self._layer = None
+
+    def add_blocks(self, blocks):
+        for block in blocks:
+            if block['type'] == 'move':
+                self._add_move(block)
+
+    def _add_move(self, block):
+        acceleration_time, cruise_time, deceleration_time, peak_speed = trapezoid_profile(
+            block['millimeters'], sqrt(block['entry_speed_sqr']), sqrt(block['nominal_speed_sqr']),
+            sqrt(block['exit_speed_sqr']), block['acceleration'])
+        duration = acceleration_time + cruise_time + deceleration_time
+        self.blocks += 1
+        self.acceleration_time += acceleration_time
+        self.cruise_time += cruise_time
+        self.deceleration_time += deceleration_time
+        self.distance += block['millimeters']
+        if block['delta_e'] > 0:
+            self.extrusion += block['delta_e']
+        self.max_speed = max(self.max_speed, peak_speed)
+        unit_vector = block['relative_move_vector']
+        for axis_name in _axis_names:
+            self.max_axis_speeds[axis_name] = max(self.max_axis_speeds[axis_name],
+                                                  peak_speed * abs(unit_vector[axis_name]))
+        # a new layer starts with the first extrusion at a new height - so z hops stay in their layer
+        extruding = block['delta_e'] > 0 and (block['delta_x'] or block['delta_y'])
+        if self._layer is None or (extruding and not block['z'] == self._layer['z']):
+            self._layer = {'z': block['z'], 'duration': 0.0, 'blocks': 0}
+            self.layers.append(self._layer)
+        self._layer['duration'] += duration
+        self._layer['blocks'] += 1
+
+    def to_dict(self):
+        duration = self.acceleration_time + self.cruise_time + self.deceleration_time
+        return {
+            'blocks': self.blocks,
+            'duration': duration,
+            'acceleration_time': self.acceleration_time,
+            'cruise_time': self.cruise_time,
+            'deceleration_time': self.deceleration_time,
+            'acceleration_share': (self.acceleration_time + self.deceleration_time) / duration if duration else 0.0,
+            'distance': self.distance,
+            'extrusion': self.extrusion,
+            'max_speed': self.max_speed,
+            'max_axis_speeds': self.max_axis_speeds,
+            'homings': self.homings,
+            'layers': self.layers
+        }
+
+
+class AnalysisService(object):
+    """
+    Analyzes g code files in worker processes and caches the results in memory and next to the file.
+    """
+
+    def __init__(self, config, processes=1):
+        self.config = config
+        self.processes = processes
+        # the analysis depends on the config as well as on the file
+        self._config_hash = hashlib.md5(json.dumps(config, sort_keys=True)).hexdigest()
+        # the workers read the config from there
+        self._config_file = None
+        self._results = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def analysis(self, filename):
+        """
+        Returns the analysis of the file - or {'status': 'running'} and starts it if it is not there yet.
+        """
+        signature = self._signature(filename)
+        with self._lock:
+            if filename in self._results and self._results[filename]['signature'] == signature:
+                return self._results[filename]
+            result = self._read_cached(filename, signature)
+            if not result and filename in self._pending:
+                pending_signature, worker = self._pending[filename]
+                if pending_signature == signature and not worker.done():
+                    self._start_workers()
+                    return {'status': 'running'}
+                del self._pending[filename]
+                if pending_signature == signature:
+                    result = worker.result()
+                    result['signature'] = signature
+                    if result['status'] == 'done':
+                        self._write_cached(filename, result)
+                else:
+                    worker.stop()
+            if result:
+                self._results[filename] = result
+                self._start_workers()
+                return result
+            _logger.info("Analyzing %s", filename)
+            self._pending[filename] = signature, _AnalysisWorker(filename)
+            self._start_workers()
+            return {'status': 'running'}
+
+    def stop(self):
+        with self._lock:
+            for _, worker in self._pending.values():
+                worker.stop()
+            self._pending.clear()
+            if self._config_file:
+                os.remove(self._config_file)
+                self._config_file = None
+
+    def _start_workers(self):
+        # not more processes than configured - the others start once someone asks again
+        workers = [worker for _, worker in self._pending.values()]
+        running = len([worker for worker in workers if worker.running()])
+        for worker in workers:
+            if running >= self.processes:
+                break
+            if not worker.started():
+                if not self._config_file:
+                    self._config_file = _write_temporary_file(json.dumps(self.config), '.json')
+                worker.start(self._config_file)
+                running += 1
+
+    def _signature(self, filename):
+        stat = os.stat(filename)
+        return [stat.st_size, stat.st_mtime, self._config_hash]
+
+    def _read_cached(self, filename, signature):
+        cache_file = filename + ANALYSIS_SUFFIX
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file) as analysis_file:
+                result = json.load(analysis_file)
+        except (IOError, ValueError) as e:
+            _logger.warn("Unable to read analysis %s: %s", cache_file, e)
+            return None
+        if not result.get('signature') == signature:
+            return None
+        return result
+
+    def _write_cached(self, filename, result):
+        cache_file = filename + ANALYSIS_SUFFIX
+        try:
+            with open(cache_file, 'w') as analysis_file:
+                json.dump(result, analysis_file)
+        except IOError as e:
+            _logger.warn("Unable to write analysis %s: %s", cache_file, e)
+
+
+class _AnalysisWorker(object):
+    # analyzes one file by running this module as script - the result comes back in a file
+    def __init__(self, filename):
+        self.filename = filename
+        self._process = None
+        self._output_file = None
+
+    def start(self, config_file):
+        self._output_file = _write_temporary_file('', ANALYSIS_SUFFIX)
+        self._process = subprocess.Popen(python_command(__file__, '--config=%s' % config_file,
+                                                        '--output=%s' % self._output_file, self.filename),
+                                         close_fds=True)
+
+    def started(self):
+        return self._process is not None
+
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def done(self):
+        return self._process is not None and self._process.poll() is not None
+
+    def result(self):
+        try:
+            with open(self._output_file) as output_file:
+                return json.load(output_file)
+        except (IOError, ValueError):
+            return {'status': 'failed', 'error': "Analysis ended with exit code %s" % self._process.returncode}
+        finally:
+            self._remove_output()
+
+    def stop(self):
+        if self.running():
+            self._process.terminate()
+            self._process.wait()
+        self._remove_output()
+
+    def _remove_output(self):
+        if self._output_file and os.path.exists(self._output_file):
+            os.remove(self._output_file)
+        self._output_file = None
+
+
+def _write_temporary_file(content, suffix):
+    handle, file_name = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(handle, 'w') as temporary_file:
+        temporary_file.write(content)
+    return file_name
+
+
+def _analyze_in_worker(filename, config):
+    # exceptions do not travel well between processes - so the error goes back as result
+    try:
+        result = analyze_file(filename, config)
+        result['status'] = 'done'
+    except Exception as e:
+        _logger.exception("Unable to analyze %s", filename)
+        result = {'status': 'failed', 'error': str(e)}
+    return result
+
+
+class AnalysisError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+def main(argv=None):
+    usage = "usage: print_analyzer.py [--config=printer_config.json] [--layers] [--output=analysis.json] file.gcode"
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "c:lo:h", ["config=", "layers", "output=", "help"])
+    except getopt.error, msg:
+        print >> sys.stderr, msg
+        print >> sys.stderr, usage
+        return 2
+    config_file = None
+    print_layers = False
+    output = None
+    for opt, value in opts:
+        if opt in ("-h", "--help"):
+            print usage
+            return 0
+        elif opt in ("-c", "--config"):
+            config_file = value
+        elif opt in ("-l", "--layers"):
+            print_layers = True
+        elif opt in ("-o", "--output"):
+            output = value
+    if len(args) != 1:
+        print >> sys.stderr, usage
+        return 2
+    if config_file:
+        with open(config_file) as json_file:
+            config = json.load(json_file)
+    else:
+        config = json_config_file.read()
+    logging.basicConfig(level=logging.WARN)
+    if output:
+        # that is how the AnalysisService gets its results
+        with open(output, 'w') as output_file:
+            json.dump(_analyze_in_worker(args[0], config), output_file)
+        return 0
+    result = analyze_file(args[0], config)
+    print "print time:        %s" % format_duration(result['duration'])
+    print "accelerating:      %.1f%%" % (result['acceleration_share'] * 100.0)
+    print "blocks:            %d from %d lines" % (result['blocks'], result['lines'])
+    print "layers:            %d" % len(result['layers'])
+    print "max speed:         %.1f mm/s" % result['max_speed']
+    print "extrusion:         %.1f mm" % result['extrusion']
+    print "planned in:        %.2f s (%.0f blocks/s)" % (result['analysis_time'], result.get('blocks_per_second', 0))
+    if print_layers:
+        for index, layer in enumerate(result['layers']):
+            print "layer %4d at %7.3f mm: %s" % (index, layer['z'], format_duration(layer['duration']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,4 @@
 # coding=utf-8
-from Adafruit_BBIO import PWM
 from Queue import Queue, Empty
 from collections import deque
 from copy import deepcopy
@@ -10,12 +9,16 @@ from threading import Thread
 from numpy import sign
 import time
 import beagle_bone_pins
-from heater import PwmHeater, Thermometer, PID, OnOffHeater
+from hardware import PWM, pin_of
+from heater import PwmHeater, Thermometer, PID, OnOffHeater, AnalogSampler, HeaterScheduler
 
 from machine import Machine, MAXIMUM_FREQUENCY_ACCELERATION, MAXIMUM_FREQUENCY_BOW
 from helpers import convert_mm_to_steps, find_shortest_vector, calculate_relative_vector, \
-    convert_velocity_clock_ref_to_realtime_ref, convert_acceleration_clock_ref_to_realtime_ref
+    convert_velocity_clock_ref_to_realtime_ref, convert_acceleration_clock_ref_to_realtime_ref, compile_step_conversion
 from LEDS import LedManager
+from segment_coalescer import SegmentCoalescer
+from arcs import linearize_arc
+import tracing
 
 __author__ = 'marcus'
 _logger = logging.getLogger(__name__)
@@ -28,6 +31,11 @@ _axis_config = {
 }
 # order of the axis
 _axis_names = ('x', 'y', 'z')
+# the axis converted to steps for each move
+_step_axis_names = ('x', 'y', 'z', 'e')
+# and the keys of their step speeds: (nominal, entry, exit, acceleration) per axis
+_step_speed_keys = tuple(('nominal_speed_' + axis_name, 'entry_speed_' + axis_name, 'exit_speed_' + axis_name,
+                          'acceleration_' + axis_name) for axis_name in _step_axis_names)
 
 
 class Printer(Thread):
@@ -50,16 +58,33 @@ class Printer(Thread):
         self._print_queue = None
         self.print_queue_min_length = print_queue_min_length
         self.print_queue_max_length = print_queue_max_length
+        # the settings of the segment coalescer - None to plan every move as it is
+        self.segment_coalescing = None
+        # and how arcs get split into moves
+        self.arc_settings = {}
+        # the settings of the planner process - None to plan in the print thread
+        self.planner_process = None
         self._default_homing_retraction = None
         self._x_step_conversion = None
         self._y_step_conversion = None
+        self._step_conversion = None
 
         self._homing_timeout = 10000
         self._print_queue_wait_time = 0.1
         self.homed = False
 
         self.led_manager = LedManager()
-
+        # follows the moves through parsing, planning & execution if enabled
+        self.tracer = tracing.Tracer()
+        # and keeps some moves for a closer look - instead of logging each of them
+        self.move_sampler = tracing.MoveSampler()
+        # all heaters read their temperature from here
+        self.analog_sampler = AnalogSampler()
+        # and all heaters are controlled from here
+        self.heater_scheduler = HeaterScheduler()
+
+        # the simulated printers of a farm do not share their pins - None for the pins of the cape
+        self.pin_namespace = None
         # todo why didn't this work as global constant?? - should be confugired anyway
         self._FAN_OUTPUT = beagle_bone_pins.pwm_config[2]['out']
 
@@ -73,6 +98,8 @@ class Printer(Thread):
             self.running = False
         if self.isAlive():
             self.join()
+        self.heater_scheduler.stop()
+        self.analog_sampler.stop()
         self.machine.disconnect()
 
     def axis_names(self):
@@ -92,8 +119,24 @@ class Printer(Thread):
         self._default_homing_retraction = printer_config['home-retract']
         self.default_speed = printer_config['default-speed']
 
+        if 'tracing' in printer_config:
+            self.tracer.enabled = printer_config['tracing']
+        if 'move-sampling' in printer_config:
+            self.move_sampler.interval = printer_config['move-sampling']
+        self.segment_coalescing = read_segment_coalescing_settings(printer_config)
+        self.arc_settings = read_arc_settings(printer_config)
+        self.planner_process = read_planner_process_settings(printer_config)
+
+        if 'analog-sampler' in printer_config:
+            sampler_config = printer_config['analog-sampler']
+            if 'sample-delay' in sampler_config:
+                self.analog_sampler.sample_delay = sampler_config['sample-delay']
+            if 'oversampling' in sampler_config:
+                self.analog_sampler.oversampling = sampler_config['oversampling']
+
         # todo this is the fan and should be configured
-        PWM.start(self._FAN_OUTPUT, printer_config['fan-duty-cycle'], printer_config['fan-frequency'], 0)
+        PWM.start(pin_of(self.pin_namespace, self._FAN_OUTPUT), printer_config['fan-duty-cycle'],
+                  printer_config['fan-frequency'], 0)
 
         if 'heated-bed' in printer_config:
             bed_heater_config = printer_config['heated-bed']
@@ -111,14 +154,23 @@ class Printer(Thread):
             self._configure_axis(axis, config[config_name])
         self._postconfig()
 
-    def connect(self):
+    def connect(self, serial_reactor=None, serial_recorder=None):
         _logger.debug("Connecting printer")
-        self.machine.connect()
+        self.machine.connect(serial_reactor=serial_reactor, serial_recorder=serial_recorder)
+
 
+    def create_print_queue(self):
+        coalescer = None
+        if self.segment_coalescing is not None:
+            coalescer = SegmentCoalescer(**self.segment_coalescing)
+        return PrintQueue(axis_config=self.axis, min_length=self.print_queue_min_length,
+                          max_length=self.print_queue_max_length, default_target_speed=self.default_speed,
+                          movement_compiler=self.compile_movement, coalescer=coalescer,
+                          arc_settings=self.arc_settings)
 
-    def start_print(self):
-        self._print_queue = PrintQueue(axis_config=self.axis, min_length=self.print_queue_min_length,
-                                       max_length=self.print_queue_max_length, default_target_speed=self.default_speed)
+    def start_print(self, print_queue=None):
+        # the moves come from the given queue - or get planned here
+        self._print_queue = print_queue or self.create_print_queue()
         self.machine.start_motion()
         self.printing = True
         self.led_manager.light(1, True)
@@ -255,15 +307,43 @@ class Printer(Thread):
             self._print_queue.plan_new_movement(position)#old: self._print_queue.add_movement(position)
             self.finish_print()
 
+    # G2/G3 - the arc ends at the x/y/z/e position around the center given by i/j or the radius r
+    def arc_to(self, position, clockwise):
+        position['type'] = 'move'
+        if self.printing:
+            self._print_queue.plan_arc(position, clockwise)
+        else:
+            self.start_print()
+            if not 'target_speed' in position:
+                position['target_speed'] = self.default_speed
+            self._print_queue.plan_arc(position, clockwise)
+            self.finish_print()
+
     def execute_movement(self, movement):
+        debug = _logger.isEnabledFor(logging.DEBUG)
         if movement['type'] == 'move':
-            _logger.debug("Execute: Entered to type 'move'")
-            step_pos, step_speed_vector = self._add_movement_calculations(movement)
-            x_move_config, y_move_config, z_move_config, e_move_config = self._generate_move_config(movement,
-                                                                                        step_pos,step_speed_vector)
-            self._move(movement, step_pos, x_move_config, y_move_config, z_move_config, e_move_config)
+            if debug:
+                _logger.debug("Execute: Entered to type 'move'")
+            trace = movement.get('trace')
+            if trace:
+                trace.stamp(tracing.DEQUEUED)
+            if not 'move_command' in movement:
+                # it did not come through the print queue
+                self.compile_movement(movement)
+            # we update our position
+            # todo isn't there a speedier way
+            for axis_name in self.axis:
+                self.axis_position[axis_name] = movement[axis_name]
+            if movement['move_command']:
+                # we move only if there is something to move …
+                self.machine.send_move_command(movement['move_command'], trace=trace)
+            if trace:
+                self.tracer.record(trace)
+            if self.move_sampler.sample():
+                self.move_sampler.record(self._sample_movement(movement))
         elif movement['type'] == 'set_position':
-            _logger.debug("Execute: Entered to type 'set_position'")
+            if debug:
+                _logger.debug("Execute: Entered to type 'set_position'")
             for axis_name in self.axis:
                 set_pos_name = "s%s" % axis_name
                 if set_pos_name in movement:
@@ -279,12 +359,23 @@ class Printer(Thread):
                             self.machine.set_pos(motor, step_position)
 
 
+    def compile_movement(self, movement):
+        # turns a planned move into the command for the machine - called when it leaves the planning window
+        if movement['type'] == 'move':
+            step_pos, step_speed_vector = self._add_movement_calculations(movement)
+            x_move_config, y_move_config, z_move_config, e_move_config = self._generate_move_config(movement,
+                                                                                        step_pos,step_speed_vector)
+            move_commands = self._create_move_commands(movement, step_pos, x_move_config, y_move_config,
+                                                       z_move_config, e_move_config)
+            movement['move_commands'] = move_commands
+            movement['move_command'] = self.machine.create_move_command(move_commands)
+
     def set_fan(self, value):
         if value < 0:
             value = 0
         elif value > 1:
             value = 1
-        PWM.set_duty_cycle(self._FAN_OUTPUT, value * 100.0)
+        PWM.set_duty_cycle(pin_of(self.pin_namespace, self._FAN_OUTPUT), value * 100.0)
 
     def run(self):
         self.led_manager.light(0, True)
@@ -296,8 +387,8 @@ class Printer(Thread):
                     #  = self._print_queue.next_movement(self._print_queue_wait_time)
                     self.execute_movement(movement)
                 except Empty:
-                    _logger.debug("Print Queue did not return a value - this can be pretty normal. Queue: %s Ex: %s",
-                                  len(self._print_queue.planning_queue),self._print_queue.execution_queue.qsize())
+                    _logger.debug("Print Queue did not return a value - this can be pretty normal: %s",
+                                  self._print_queue)
             else:
                 time.sleep(0.1)
         self.led_manager.light(0, False)
@@ -467,13 +558,17 @@ class Printer(Thread):
         output_number = heater_config['output'] - 1
         if output_number < 0 or output_number >= len(beagle_bone_pins.pwm_config):
             raise PrinterError("PWM pins can only be between 1 and %s" % len(beagle_bone_pins.pwm_config))
-        output = beagle_bone_pins.pwm_config[output_number]['out']
+        output = pin_of(self.pin_namespace, beagle_bone_pins.pwm_config[output_number]['out'])
         thermometer = Thermometer(themistor_type=heater_config['sensor-type'],
-                                  analog_input=beagle_bone_pins.pwm_config[output_number]['temp'])
+                                  analog_input=pin_of(self.pin_namespace,
+                                                      beagle_bone_pins.pwm_config[output_number]['temp']),
+                                  sampler=self.analog_sampler)
         if 'current_input' in beagle_bone_pins.pwm_config[output_number]:
             current_pin = beagle_bone_pins.pwm_config[output_number]['current_input']
         else:
             current_pin = None
+        # how often the heater is controlled - None for the default
+        readout_delay = heater_config.get('readout-delay')
         type = heater_config['type']
         if type == 'PID':
             # do we have a maximum duty cycle??
@@ -486,12 +581,14 @@ class Printer(Thread):
                                  Integrator_max=heater_config['max-duty-cycle'])
             heater = PwmHeater(thermometer=thermometer, pid_controller=pid_controller,
                                output=output, maximum_duty_cycle=max_duty_cycle,
-                               current_measurement=current_pin, machine=self.machine)
+                               current_measurement=current_pin, machine=self.machine,
+                               scheduler=self.heater_scheduler, readout_delay=readout_delay)
         elif type == "2 Point":
             hysteresis = heater_config['hysteresis']
             heater = OnOffHeater(thermometer=thermometer, output=output, active_high=True,
                                  hysteresis=hysteresis,
-                                 current_measurement=current_pin, machine=self.machine)
+                                 current_measurement=current_pin, machine=self.machine,
+                                 scheduler=self.heater_scheduler, readout_delay=readout_delay)
         else:
             raise PrinterError("Unkown heater type %s" % type)
         return heater
@@ -502,6 +599,8 @@ class Printer(Thread):
         self._y_step_conversion = float(self.axis['y']['steps_per_mm']) / float(self.axis['x']['steps_per_mm'])
         self._e_x_step_conversion = float(self.axis['e']['steps_per_mm']) / float(self.axis['x']['steps_per_mm'])
         self._e_y_step_conversion = float(self.axis['e']['steps_per_mm']) / float(self.axis['y']['steps_per_mm'])
+        # and all the conversions of every move in one place
+        self._step_conversion = compile_step_conversion(self.axis, _step_axis_names)
 
         self._extract_homing_information()
 
@@ -519,50 +618,44 @@ class Printer(Thread):
 
 
     def _add_movement_calculations(self, movement):
-        step_pos = {
-            'x': convert_mm_to_steps(movement['x'], self.axis['x']['steps_per_mm']),
-            'y': convert_mm_to_steps(movement['y'], self.axis['y']['steps_per_mm']),
-            'z': convert_mm_to_steps(movement['z'], self.axis['z']['steps_per_mm']),
-            'e': convert_mm_to_steps(movement['e'], self.axis['e']['steps_per_mm'])
-        }
+        debug = _logger.isEnabledFor(logging.DEBUG)
+        steps_per_mm = self._step_conversion.steps_per_mm
+        step_pos = dict(zip(_step_axis_names, [float(movement[axis_name]) * factor
+                                               for axis_name, factor in zip(_step_axis_names, steps_per_mm)]))
         movement['entry_speed'] = sqrt(movement['entry_speed_sqr'])
         movement['nominal_speed'] = sqrt(movement['nominal_speed_sqr'])
         movement['exit_speed'] = sqrt(movement['exit_speed_sqr'])
-        _logger.debug("Execute - add calculations: entry(%s) nominal(%s) exit(%s)",movement['entry_speed'],
-                      movement['nominal_speed'],movement['exit_speed'])
-        for axis in _axis_config:
-            if ('delta_' + axis) in movement:
-                _logger.debug("Execute - add calculations: delta %s %s", axis, movement['delta_' + axis])
-        relative_move_vector = movement['relative_move_vector']
-        z_speed = min(abs(relative_move_vector['v'] * relative_move_vector['z']), self.axis['z']['max_speed'])
-        e_speed = min(abs(relative_move_vector['v'] * relative_move_vector['e']), self.axis['e']['max_speed'])
-        step_speed_vector = {
-            # todo - this can be clock signal referenced - convert acc. to  axis['clock-referenced']
-            'nominal_speed_x':max(convert_mm_to_steps(abs(movement['nominal_speed']),self.axis['x']['steps_per_mm']),1),
-            'nominal_speed_y':max(convert_mm_to_steps(abs(movement['nominal_speed']),self.axis['y']['steps_per_mm']),1),
-            'nominal_speed_z':max(convert_mm_to_steps(abs(movement['nominal_speed']),self.axis['z']['steps_per_mm']),1),#todo
-            'nominal_speed_e':max(convert_mm_to_steps(abs(movement['nominal_speed']),self.axis['e']['steps_per_mm']),1),
-            'entry_speed_x':max(convert_mm_to_steps(abs(movement['entry_speed']),self.axis['x']['steps_per_mm']),1),
-            'entry_speed_y':max(convert_mm_to_steps(abs(movement['entry_speed']),self.axis['y']['steps_per_mm']),1),
-            'entry_speed_z':max(convert_mm_to_steps(abs(movement['entry_speed']), self.axis['z']['steps_per_mm']),1),#todo
-            'entry_speed_e':max(convert_mm_to_steps(abs(movement['entry_speed']), self.axis['e']['steps_per_mm']),1),
-            'exit_speed_x':max(convert_mm_to_steps(abs(movement['exit_speed']),self.axis['x']['steps_per_mm']),1),
-            'exit_speed_y':max(convert_mm_to_steps(abs(movement['exit_speed']),self.axis['y']['steps_per_mm']),1),
-            'exit_speed_z':max(convert_mm_to_steps(abs(movement['exit_speed']), self.axis['z']['steps_per_mm']),1),#todo
-            'exit_speed_e':max(convert_mm_to_steps(abs(movement['exit_speed']), self.axis['e']['steps_per_mm']),1),
-            'acceleration_x':max(convert_mm_to_steps(abs(movement['acceleration']),self.axis['x']['steps_per_mm']),1),
-            'acceleration_y':max(convert_mm_to_steps(abs(movement['acceleration']),self.axis['y']['steps_per_mm']),1),
-            'acceleration_z':max(convert_mm_to_steps(abs(movement['acceleration']), self.axis['z']['steps_per_mm']),1),
-            'acceleration_e':max(convert_mm_to_steps(abs(movement['acceleration']), self.axis['e']['steps_per_mm']),1)
-        }
-        #Keep entry and exit speeds low, to cause no errors in arduino
-        for axis in _axis_config:
-            step_speed_vector['entry_speed_'+axis] = min(step_speed_vector['entry_speed_'+axis],
-                                                         (step_speed_vector['nominal_speed_'+axis]/2))
-            step_speed_vector['exit_speed_'+axis] = min(step_speed_vector['exit_speed_'+axis],
-                                                        (step_speed_vector['nominal_speed_'+axis]/2))
+        if debug:
+            _logger.debug("Execute - add calculations: entry(%s) nominal(%s) exit(%s)",movement['entry_speed'],
+                          movement['nominal_speed'],movement['exit_speed'])
+            for axis in _axis_config:
+                if ('delta_' + axis) in movement:
+                    _logger.debug("Execute - add calculations: delta %s %s", axis, movement['delta_' + axis])
+        # todo - this can be clock signal referenced - see convert_velocity_clock_ref_to_realtime_ref
+        nominal_speed = abs(movement['nominal_speed'])
+        entry_speed = abs(movement['entry_speed'])
+        exit_speed = abs(movement['exit_speed'])
+        acceleration = abs(movement['acceleration'])
+        step_speed_vector = {}
+        for (nominal_key, entry_key, exit_key, acceleration_key), factor in zip(_step_speed_keys, steps_per_mm):
+            nominal_step_speed = max(nominal_speed * factor, 1)
+            step_speed_vector[nominal_key] = nominal_step_speed
+            #Keep entry and exit speeds low, to cause no errors in arduino
+            step_speed_vector[entry_key] = min(max(entry_speed * factor, 1), nominal_step_speed / 2)
+            step_speed_vector[exit_key] = min(max(exit_speed * factor, 1), nominal_step_speed / 2)
+            step_speed_vector[acceleration_key] = max(acceleration * factor, 1)
         return step_pos, step_speed_vector
 
+    def _sample_movement(self, movement):
+        sample = {
+            'time': time.time(),
+            # the planner process only passes the command on
+            'commands': deepcopy(movement.get('move_commands'))
+        }
+        for key in ('x', 'y', 'z', 'e', 'millimeters', 'acceleration', 'entry_speed', 'nominal_speed', 'exit_speed'):
+            sample[key] = movement[key]
+        return sample
+
     def _generate_move_config(self, movement, step_pos, step_speed_vector):
         def _axis_movement_template(axis):
             return {
@@ -638,16 +731,19 @@ class Printer(Thread):
             debug_axis += "e_axis "
         else:
             e_move_config = None
-        _logger.debug(debug_axis)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug(debug_axis)
         return x_move_config, y_move_config, z_move_config, e_move_config
 
-    def _move(self, movement, step_pos, x_move_config, y_move_config, z_move_config, e_move_config):
+    def _create_move_commands(self, movement, step_pos, x_move_config, y_move_config, z_move_config, e_move_config):
+        debug = _logger.isEnabledFor(logging.DEBUG)
         move_vector = movement['relative_move_vector']
         move_commands = []
 
         if x_move_config and not y_move_config and not z_move_config:
             # move x motor
-            _logger.debug("Execute - move: X axis to %s", step_pos['x'])
+            if debug:
+                _logger.debug("Execute - move: X axis to %s", step_pos['x'])
 
             move_commands = [
                 x_move_config
@@ -655,7 +751,8 @@ class Printer(Thread):
 
         elif y_move_config and not x_move_config and not z_move_config:
             # move y motor to position
-            _logger.debug("Execute - move: Y axis to %s", step_pos['y'])
+            if debug:
+                _logger.debug("Execute - move: Y axis to %s", step_pos['y'])
 
             move_commands = [
                 y_move_config
@@ -663,7 +760,8 @@ class Printer(Thread):
 
         elif z_move_config and not x_move_config and not y_move_config:
             # move y motor to position
-            _logger.debug("Execute - move: Z axis to %s", step_pos['z'])
+            if debug:
+                _logger.debug("Execute - move: Z axis to %s", step_pos['z'])
 
             move_commands = [
                 z_move_config
@@ -673,9 +771,10 @@ class Printer(Thread):
             # ok we have to see which axis has bigger movement
             if abs(movement['delta_x']) > abs(movement['delta_y']):
                 y_factor = abs(move_vector['y'] / move_vector['x'] * self._y_step_conversion)
-                _logger.debug(
-                    "Execute - move: X axis to %s gearing Y by %s to %s"
-                    , step_pos['x'], y_factor, step_pos['y'])
+                if debug:
+                    _logger.debug(
+                        "Execute - move: X axis to %s gearing Y by %s to %s"
+                        , step_pos['x'], y_factor, step_pos['y'])
 
                 y_move_config['entry_speed'] = x_move_config['entry_speed'] * y_factor
                 y_move_config['nominal_speed'] = x_move_config['nominal_speed'] * y_factor
@@ -689,9 +788,10 @@ class Printer(Thread):
 
             else:
                 x_factor = abs(move_vector['x'] / move_vector['y'] * self._x_step_conversion)
-                _logger.debug(
-                    "Execute - move: Y axis to %s gearing X by %s  to %s"
-                    , step_pos['x'], x_factor, step_pos['y'])
+                if debug:
+                    _logger.debug(
+                        "Execute - move: Y axis to %s gearing X by %s  to %s"
+                        , step_pos['x'], x_factor, step_pos['y'])
 
                 x_move_config['entry_speed'] = y_move_config['entry_speed'] * x_factor
                 x_move_config['nominal_speed'] = y_move_config['nominal_speed'] * x_factor
@@ -716,26 +816,88 @@ class Printer(Thread):
                 e_move_config['exit_speed'] = y_move_config['exit_speed'] * factor
                 e_move_config['acceleration'] = factor * y_move_config['acceleration']
             move_commands.append(e_move_config)
-            _logger.debug("Execute - move: also e")
+            if debug:
+                _logger.debug("Execute - move: also e")
+
+        return move_commands
+
+
+def read_segment_coalescing_settings(printer_config):
+    # either true for the default tolerances or the tolerances to use - None if segments are not merged
+    coalescing_config = printer_config.get('segment-coalescing')
+    if not coalescing_config:
+        return None
+    if coalescing_config is True:
+        coalescing_config = {}
+    settings = {}
+    for config_key, argument in (('angular-tolerance', 'angular_tolerance'),
+                                 ('chordal-tolerance', 'chordal_tolerance'),
+                                 ('extrusion-tolerance', 'extrusion_tolerance'),
+                                 ('max-segments', 'max_segments')):
+        if config_key in coalescing_config:
+            settings[argument] = coalescing_config[config_key]
+    return settings
+
+
+def read_planner_process_settings(printer_config):
+    # either true for the default ring size or the settings to use - None if the print thread plans
+    process_config = printer_config.get('planner-process')
+    if not process_config:
+        return None
+    if process_config is True:
+        process_config = {}
+    settings = {}
+    if 'ring-size' in process_config:
+        settings['ring_size'] = process_config['ring-size']
+    return settings
+
+
+def read_axis_limits(config):
+    # the speed & acceleration limits of each axis and its end stops - all the planner needs to know about them
+    axis_limits = {}
+    for axis_name, config_name in _axis_config.iteritems():
+        end_stops_config = config[config_name].get('end-stops', {})
+        end_stops = dict((end_stop_pos, {'polarity': end_stops_config[end_stop_pos]['polarity']})
+                         for end_stop_pos in ('left', 'right') if end_stop_pos in end_stops_config)
+        axis_limits[axis_name] = {
+            'name': axis_name,
+            'max_speed': config[config_name]['max-speed'],
+            'max_acceleration': config[config_name]['max-acceleration'],
+            'end-stops': end_stops,
+            'homeable': bool(end_stops)
+        }
+    return axis_limits
 
-        # we update our position
-        # todo isn't there a speedier way
-        for axis_name in self.axis:
-            self.axis_position[axis_name] = movement[axis_name]
 
-        if move_commands:
-            # we move only if there is something to move …
-            self.machine.move_to(move_commands)
+def read_arc_settings(printer_config):
+    settings = {}
+    if 'arcs' in printer_config:
+        arc_config = printer_config['arcs']
+        for config_key, argument in (('chordal-tolerance', 'chordal_tolerance'),
+                                     ('moves-per-second', 'moves_per_second'),
+                                     ('min-segment-length', 'min_segment_length')):
+            if config_key in arc_config:
+                settings[argument] = arc_config[config_key]
+    return settings
 
 
 class PrintQueue():
-    def __init__(self, axis_config, min_length, max_length, default_target_speed=None, led_manager=None):
+    def __init__(self, axis_config, min_length, max_length, default_target_speed=None, led_manager=None,
+                 movement_compiler=None, coalescer=None, arc_settings=None):
         self.axis = axis_config
+        # prepares the movements for the machine before they get executed
+        self.movement_compiler = movement_compiler
+        # merges short collinear moves before they get planned - if configured
+        self.coalescer = coalescer
+        # how G2/G3 arcs are split into moves
+        self.arc_settings = arc_settings or {}
         self.planning_queue = deque()
         self.queue_size = min_length - 1  # since we got one extra
         self.execution_queue = Queue(maxsize=(max_length - min_length))
         self.last_planned = 0
         self.planner = Planner()
+        # where the last move wanted to go - arcs start there
+        self.target_position = dict(self.planner.get_position())
         self.default_target_speed = default_target_speed
         self.led_manager = led_manager
         #todo move these parameters to configuration file
@@ -758,22 +920,49 @@ class PrintQueue():
             self.last_planned -= 1
         return movement
 
+    def plan_arc(self, target_position, clockwise, timeout=None):
+        feed_rate = target_position.get('target_speed', self.planner.get_previous_feed_rate())
+        moves = linearize_arc(self.target_position, target_position, clockwise, feed_rate=feed_rate,
+                              **self.arc_settings)
+        if 'trace' in target_position:
+            moves[0]['trace'] = target_position['trace']
+        for move in moves:
+            self.plan_new_movement(move, timeout)
+        # the segments of small arcs may have been slowed down - the moves after the arc are not
+        self.planner.set_previous_feed_rate(feed_rate)
+
     def plan_new_movement(self, target_position, timeout=None):
+        if target_position['type'] in ('move', 'set_position'):
+            for axis_name in _axis_config:
+                if axis_name in target_position:
+                    self.target_position[axis_name] = target_position[axis_name]
+        if self.coalescer:
+            for position in self.coalescer.add(target_position, self.planner.get_position()):
+                self._plan_movement(position, timeout)
+        else:
+            self._plan_movement(target_position, timeout)
+
+    def _plan_movement(self, target_position, timeout=None):
+        debug = _logger.isEnabledFor(logging.DEBUG)
         if 'type' in target_position:
-            _logger.debug("Planner: Begin movement (%s)", target_position['type'])
+            if debug:
+                _logger.debug("Planner: Begin movement (%s)", target_position['type'])
         else:
             _logger.error("Planner: Movement with no type")
         movement = self._extract_movement_values(target_position)
         #Compute speed, unit vector and other parameters of the movement
         unit_vec = movement['relative_move_vector']
         if target_position['type'] == 'move':
-            _logger.debug("Planner: Plan movement. Type: Move")
+            if debug:
+                _logger.debug("Planner: Plan movement. Type: Move")
             if movement['target_speed'] < self.MINIMUM_FEED_RATE:#todo or could exist a movement with 0 feed_rate?
                 movement['target_speed'] = self.MINIMUM_FEED_RATE
-                _logger.debug("Planner: target speed set to minimum")
+                if debug:
+                    _logger.debug("Planner: target speed set to minimum")
             self.planner.set_previous_feed_rate(movement['target_speed'])
             if movement['distance_event_count'] == 0.0 or movement['millimeters'] == 0.0 or 'invalid_movement' in movement:
-                _logger.debug("Planner: Invalid movement. Not planned")
+                if debug:
+                    _logger.debug("Planner: Invalid movement. Not planned")
                 return
             for axis in _axis_names:
                 planner_previous_unit_vec = self.planner.get_previous_unit_vec()
@@ -794,8 +983,9 @@ class PrintQueue():
                     inverted_unit_vec_axis = 1.0 / abs(unit_vec['e'])
                 movement['acceleration'] = min(movement['acceleration'],
                                                self.axis['e']['max_acceleration']*inverted_unit_vec_axis)
-            _logger.debug("Planner: target_speed(%s) acceleration(%s) junction_cos (%s)",movement['target_speed'],
-                          movement['acceleration'],movement['junction_cos_theta'])
+            if debug:
+                _logger.debug("Planner: target_speed(%s) acceleration(%s) junction_cos (%s)",movement['target_speed'],
+                              movement['acceleration'],movement['junction_cos_theta'])
             if self.is_planning_queue_empty():
                 movement['max_junction_speed_sqr'] = 0.0
             else:
@@ -809,9 +999,10 @@ class PrintQueue():
             movement['nominal_speed_sqr']=movement['target_speed']*movement['target_speed']
             movement['max_entry_speed_sqr'] = min(movement['max_junction_speed_sqr'],min(movement['nominal_speed_sqr'],
                                                   self.planner.get_previous_nominal_speed_sqr()))
-            _logger.debug("Planner: max entry speed (%s) max junction speed (%s) and nominal speed (%s) calculated",
-                          movement['max_entry_speed_sqr'],movement['max_junction_speed_sqr'],
-                          movement['nominal_speed_sqr'])
+            if debug:
+                _logger.debug("Planner: max entry speed (%s) max junction speed (%s) and nominal speed (%s) calculated",
+                              movement['max_entry_speed_sqr'],movement['max_junction_speed_sqr'],
+                              movement['nominal_speed_sqr'])
             unit_vec['v']=movement['target_speed']/movement['millimeters']#only computed in T-Bone, not grbl
             movement['relative_move_vector'] = unit_vec
             #Save movement data in Planner -> will be previous movement info for the next one
@@ -822,24 +1013,37 @@ class PrintQueue():
                 position[axis] = movement[axis]
             self.planner.set_position(position)
         elif target_position['type'] == 'set_position':
-            _logger.debug("Planner: Plan movement. Type: Set Position")
+            if debug:
+                _logger.debug("Planner: Plan movement. Type: Set Position")
             movement['target_speed'] = 0.0
             movement['acceleration'] = 0.0
             movement['entry_speed_sqr'] = 0.0
             movement['nominal_speed_sqr'] = 0.0
             movement['max_junction_speed_sqr'] = 0.0
             movement['max_entry_speed_sqr'] = 0.0
+            # the next moves start from the set position
+            position = {}
+            for axis in _axis_config.keys():
+                position[axis] = movement[axis]
+            self.planner.set_position(position)
 
         #If there are enough planned movements, move one to execution queue
         if len(self.planning_queue) > self.queue_size:
             self._push_from_planning_to_execution(timeout)
-            _logger.debug("Planner: planning queue big enough. push to execution")
+            if debug:
+                _logger.debug("Planner: planning queue big enough. push to execution")
         #Add new movement to planning queue
         self.add_movement_to_planning_queue(movement)
-        _logger.debug("Planner: movement added to planning queue (%s) (%s in execution)",len(self.planning_queue),
-                      self.execution_queue.qsize())
+        if debug:
+            _logger.debug("Planner: movement added to planning queue (%s) (%s in execution)",len(self.planning_queue),
+                          self.execution_queue.qsize())
         #Recalculate the plan using the new movement
         self._recalculate_move_speeds()
+        if 'trace' in movement:
+            movement['trace'].stamp(tracing.PLANNED)
+
+    def __str__(self):
+        return "%s planned, %s to execute" % (len(self.planning_queue), self.execution_queue.qsize())
 
     def is_planning_queue_empty(self):
         if len(self.planning_queue) == 0:
@@ -851,6 +1055,15 @@ class PrintQueue():
         return self.execution_queue.get(timeout=timeout)
 
     def finish(self, timeout=None):
+        self.flush(timeout)
+        while not self.execution_queue.empty():
+            pass
+
+    def flush(self, timeout=None):
+        # pushes everything to the execution queue - the last move stops all axis
+        if self.coalescer:
+            for position in self.coalescer.flush():
+                self._plan_movement(position, timeout)
         if not self.is_planning_queue_empty():
             self.planning_queue[-1]['x_stop'] = True
             self.planning_queue[-1]['y_stop'] = True
@@ -858,26 +1071,33 @@ class PrintQueue():
             _logger.debug("Finish: adding axis stop")
         while len(self.planning_queue) > 0:
             self._push_from_planning_to_execution(timeout)
-        while not self.execution_queue.empty():
-            pass
 
     def _push_from_planning_to_execution(self, timeout):
         executed_move = self.get_movement_from_planning_queue()
         #todo calculate parameters of the old interface from the new one
+        if self.movement_compiler:
+            self.movement_compiler(executed_move)
+        if 'trace' in executed_move:
+            executed_move['trace'].stamp(tracing.QUEUED)
 
         self.execution_queue.put(executed_move, timeout=timeout)
 
     def _extract_movement_values(self, target_position):
+        debug = _logger.isEnabledFor(logging.DEBUG)
         movement = {'type':target_position['type'], 'millimeters': 0.0, 'acceleration': float("inf"),
                     'junction_cos_theta': 0.0, 'distance_event_count':0.0, 'entry_speed_sqr':0.0}
+        if 'trace' in target_position:
+            movement['trace'] = target_position['trace']
         #test: reduced speed
         reduction_factor = 1
         if 'target_speed' in target_position:
             movement['target_speed'] = target_position['target_speed'] / reduction_factor
-            _logger.debug("Planner - Extract Movement: Target Speed 1 %s", movement['target_speed'])
+            if debug:
+                _logger.debug("Planner - Extract Movement: Target Speed 1 %s", movement['target_speed'])
         else:
             movement['target_speed'] = self.planner.get_previous_feed_rate()
-            _logger.debug("Planner - Extract Movement: Target Speed 2 %s", movement['target_speed'])
+            if debug:
+                _logger.debug("Planner - Extract Movement: Target Speed 2 %s", movement['target_speed'])
         delta = {}
         unit_vec = {}
         planner_position = self.planner.get_position()
@@ -886,26 +1106,29 @@ class PrintQueue():
                 if axis_i in target_position:
                     movement[axis_i] = target_position[axis_i]
                     delta[axis_i] = target_position[axis_i] - planner_position[axis_i]
-                    if axis_i in ["x","y"]:
+                    if debug and axis_i in ["x","y"]:
                         _logger.debug("Planner - Extract Movement: %s target(%s) last(%s) difference(%s)",
                                       axis_i,target_position[axis_i],planner_position[axis_i],delta[axis_i])
                 else:
                     movement[axis_i] = planner_position[axis_i]
                     delta[axis_i] = 0.0
-                _logger.debug("Planner - Extract Movement: axis %s target %s, delta %s",axis_i,
-                              movement[axis_i],delta[axis_i])
+                if debug:
+                    _logger.debug("Planner - Extract Movement: axis %s target %s, delta %s",axis_i,
+                                  movement[axis_i],delta[axis_i])
                 movement['distance_event_count'] = max(movement['distance_event_count'],movement[axis_i])
                 unit_vec[axis_i] = delta[axis_i]
                 movement['delta_'+axis_i] = delta[axis_i]
                 movement['millimeters'] += delta[axis_i]*delta[axis_i]
             if movement['millimeters'] == 0:
-                _logger.debug("Planner - Extract Movement: Movement with no displacement!")
+                if debug:
+                    _logger.debug("Planner - Extract Movement: Movement with no displacement!")
                 movement['invalid_movement'] = True
             else:
                 movement['millimeters'] = sqrt(movement['millimeters'])
                 for axis_i in _axis_config.keys():
                     unit_vec[axis_i] /= movement['millimeters']#make unitary: divide by total length
-            _logger.debug("Planner - Extract Movement: total mm (%s)",movement['millimeters'])
+            if debug:
+                _logger.debug("Planner - Extract Movement: total mm (%s)",movement['millimeters'])
             movement['relative_move_vector'] = unit_vec
             return movement
         elif target_position['type'] == 'set_position':
@@ -920,27 +1143,32 @@ class PrintQueue():
                 if not axis_name == 'type':
                     movement['s%s' % axis_name] = value
                     movement[axis_name] = value
-                    _logger.debug("Planner - Extract Movement: set axis(%s) to (%s)", axis_name,value)
+                    if debug:
+                        _logger.debug("Planner - Extract Movement: set axis(%s) to (%s)", axis_name,value)
             return movement
 
     def _recalculate_move_speeds(self):
+        debug = _logger.isEnabledFor(logging.DEBUG)
         if self.led_manager:
             self.led_manager.light(2, True)
 
         current_id = len(self.planning_queue) - 1
         if current_id == self.last_planned:
             return
-        _logger.debug("Planner - Recalculate: At least 2 movements in queue. Current id (%s), last planned (%s)",
-                      current_id, self.last_planned)
+        if debug:
+            _logger.debug("Planner - Recalculate: At least 2 movements in queue. Current id (%s), last planned (%s)",
+                          current_id, self.last_planned)
         self.planning_queue[current_id]['entry_speed_sqr'] = min(self.planning_queue[current_id]['max_entry_speed_sqr'],
                     2*self.planning_queue[current_id]['acceleration']*self.planning_queue[current_id]['millimeters'])
-        _logger.debug("Planner - Recalculate: entry_speed_sqr[%s] is (%s)",current_id,
-                      self.planning_queue[current_id]['entry_speed_sqr'])
+        if debug:
+            _logger.debug("Planner - Recalculate: entry_speed_sqr[%s] is (%s)",current_id,
+                          self.planning_queue[current_id]['entry_speed_sqr'])
         #Reverse order calculation
         current_id -= 1
         while current_id != self.last_planned:
             next_id = current_id + 1
-            _logger.debug("Planner - Recalculate: Reverse order between current(%s) and next(%s)",current_id,next_id)
+            if debug:
+                _logger.debug("Planner - Recalculate: Reverse order between current(%s) and next(%s)",current_id,next_id)
             if self.planning_queue[current_id]['entry_speed_sqr'] != \
                     self.planning_queue[current_id]['max_entry_speed_sqr']:
                 entry_speed_sqr = self.planning_queue[next_id]['entry_speed_sqr'] + \
@@ -951,8 +1179,9 @@ class PrintQueue():
                 else:
                     self.planning_queue[current_id]['entry_speed_sqr'] = \
                         self.planning_queue[current_id]['max_entry_speed_sqr']
-            _logger.debug("Planner - Recalculate: Reverse order, entry_speed of current (%s)",
-                          self.planning_queue[current_id]['entry_speed_sqr'])
+            if debug:
+                _logger.debug("Planner - Recalculate: Reverse order, entry_speed of current (%s)",
+                              self.planning_queue[current_id]['entry_speed_sqr'])
             current_id -= 1
         #Forward order calculation
         next_id = self.last_planned
@@ -962,28 +1191,37 @@ class PrintQueue():
             #If next movement doesn't have displacement in one axis, previous one has "stop" parameter
             factor = {}
             if self.planning_queue[next_id]["delta_y"] == 0:
-                _logger.debug("Planner - Recalculate: Forward. factor y fixed")
+                if debug:
+                    _logger.debug("Planner - Recalculate: Forward. factor y fixed")
                 factor["y"] = 5000.0
             else:
-                _logger.debug("Planner - Recalculate: Forward. factor x calc")
+                if debug:
+                    _logger.debug("Planner - Recalculate: Forward. factor x calc")
                 factor["y"] = abs(self.planning_queue[next_id]["delta_x"] / self.planning_queue[next_id]["delta_y"])
-                _logger.debug("Planner - Recalculate: Forward. factor y %s",factor["y"])
+                if debug:
+                    _logger.debug("Planner - Recalculate: Forward. factor y %s",factor["y"])
             if self.planning_queue[next_id]["delta_x"] == 0:
                 factor["x"] = 5000.0
-                _logger.debug("Planner - Recalculate: Forward. factor x fixed")
+                if debug:
+                    _logger.debug("Planner - Recalculate: Forward. factor x fixed")
             else:
-                _logger.debug("Planner - Recalculate: Forward. factor x calc")
+                if debug:
+                    _logger.debug("Planner - Recalculate: Forward. factor x calc")
                 factor["x"] = abs(self.planning_queue[next_id]["delta_y"] / self.planning_queue[next_id]["delta_x"])
-                _logger.debug("Planner - Recalculate: Forward. factor x %s",factor["x"])
+                if debug:
+                    _logger.debug("Planner - Recalculate: Forward. factor x %s",factor["x"])
             for axis in ["x", "y"]:
                 #if factor[axis] > 500.0:
                 self.planning_queue[current_id][axis+"_stop"] = True
-                _logger.debug("Planner - Recalculate: Forward. Adding stop to axis %s",axis)
+                if debug:
+                    _logger.debug("Planner - Recalculate: Forward. Adding stop to axis %s",axis)
             #If x and y will stop, e will as well
             if "x_stop" in self.planning_queue[current_id] and "y_stop" in self.planning_queue[current_id]:
                 self.planning_queue[current_id]["e_stop"] = True
-                _logger.debug("Planner - Recalculate: Forward. Adding stop to axis e")
-            _logger.debug("Planner - Recalculate: Forward order between current(%s) and next(%s)",current_id,next_id)
+                if debug:
+                    _logger.debug("Planner - Recalculate: Forward. Adding stop to axis e")
+            if debug:
+                _logger.debug("Planner - Recalculate: Forward order between current(%s) and next(%s)",current_id,next_id)
             if self.planning_queue[current_id]['entry_speed_sqr'] < self.planning_queue[next_id]['entry_speed_sqr']:
                 entry_speed_sqr = self.planning_queue[current_id]['entry_speed_sqr'] + \
                                       2*self.planning_queue[current_id]['acceleration']*\
@@ -993,8 +1231,9 @@ class PrintQueue():
                     self.last_planned = next_id
             if self.planning_queue[next_id]['entry_speed_sqr'] == self.planning_queue[next_id]['max_entry_speed_sqr']:
                 self.last_planned = next_id
-            _logger.debug("Planner - Recalculate: Forward order, entry_speed of next (%s)",
-                          self.planning_queue[next_id]['entry_speed_sqr'])
+            if debug:
+                _logger.debug("Planner - Recalculate: Forward order, entry_speed of next (%s)",
+                              self.planning_queue[next_id]['entry_speed_sqr'])
         if self.led_manager:
             self.led_manager.light(2, False)
 
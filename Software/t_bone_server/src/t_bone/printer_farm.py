@@ -0,0 +1,393 @@
+# coding=utf-8
+"""
+Many printers driven by one server.
+
+The printers of a farm are listed in the 'farm' entry of the config - each with its name, serial port and reset pin:
+
+    "farm": {
+        "printers": [
+            {"name": "left", "serial-port": "/dev/ttyUSB0", "reset-pin": null},
+            {"name": "right", "serial-port": "/dev/ttyUSB1", "reset-pin": null, "config": {...}}
+        ]
+    }
+
+Each printer has its own machine connection, print queue, job queue and scheduler - nothing is shared but the process.
+With "serial-reactor" in the printer config the serial lines of all printers are watched by one thread.
+A printer uses the config of the farm unless it brings its own. The heaters are driven by the pins of this host, so the
+printers must not use the same heater outputs or thermometers - on real hardware only one printer can go without its own
+config then. With simulated hardware every printer talks to its own firmware simulator and has its own simulated pins,
+so a farm of dozens of printers runs on any machine. What driving them costs - threads, file descriptors,
+CPU time and memory per printer - is measured by:
+
+    PYTHONPATH=src python -m t_bone.printer_farm --printers=24 --moves=500 [--serial-reactor]
+"""
+from collections import OrderedDict
+from copy import deepcopy
+import getopt
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import beagle_bone_pins
+from benchmark import BENCHMARK_CONFIG, CORPORA
+from firmware_simulator import FirmwareSimulator
+from gcode_index import GCodeIndexer
+import hardware
+from job_queue import JobQueue, JobScheduler, DONE, FAILED, CANCELLED
+from printer import Printer
+from serial_reactor import read_serial_reactor
+from serial_recorder import read_serial_recorder
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+_default_printers = 8
+_default_moves = 500
+_default_corpus = 'straight-infill'
+_idle_wait_time = 0.1
+_page_size = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_farm_config(config, shared_heaters=False):
+    """
+    Returns the list of printers of the farm - or None if the config is for a single printer.
+    shared_heaters: if the printers may use the same heater pins - simulated ones each get pins of their own
+    """
+    if not config or 'farm' not in config:
+        return None
+    printers = config['farm'].get('printers')
+    if not printers:
+        raise FarmError("A farm needs printers")
+    names = set()
+    for printer_config in printers:
+        if 'name' not in printer_config:
+            raise FarmError("Each printer of the farm needs a name")
+        if printer_config['name'] in names:
+            raise FarmError("There are two printers called %s" % printer_config['name'])
+        names.add(printer_config['name'])
+    if not shared_heaters:
+        _check_heater_pins(config, printers)
+    return printers
+
+
+def _printer_config_of(config, printer_config):
+    # the config of the printer - or the one of the farm
+    if 'config' in printer_config:
+        return deepcopy(printer_config['config'])
+    config = deepcopy(config)
+    del config['farm']
+    return config
+
+
+def _check_heater_pins(config, printers):
+    users = {}
+    for printer_config in printers:
+        for pin in _heater_pins(_printer_config_of(config, printer_config)):
+            if pin in users:
+                raise FarmError("The printers %s and %s both use the heater pin %s - each printer needs its own "
+                                "heater outputs in its config" % (users[pin], printer_config['name'], pin))
+            users[pin] = printer_config['name']
+
+
+def _heater_pins(config):
+    # the output and thermometer pins of the heaters
+    heater_configs = []
+    if 'heated-bed' in config.get('printer', {}):
+        heater_configs.append(config['printer']['heated-bed'])
+    if 'heater' in config.get('extruder', {}):
+        heater_configs.append(config['extruder']['heater'])
+    pins = []
+    for heater_config in heater_configs:
+        output_number = heater_config.get('output', 0) - 1
+        if 0 <= output_number < len(beagle_bone_pins.pwm_config):
+            pins.append(beagle_bone_pins.pwm_config[output_number]['out'])
+            pins.append(beagle_bone_pins.pwm_config[output_number]['temp'])
+    return pins
+
+
+class FarmPrinter(object):
+    def __init__(self, name, printer, job_queue, job_scheduler, firmware_simulator=None):
+        self.name = name
+        self.printer = printer
+        self.job_queue = job_queue
+        self.job_scheduler = job_scheduler
+        self.firmware_simulator = firmware_simulator
+
+    def status(self):
+        # a snapshot of what the printer is up to
+        printer = self.printer
+        status = {
+            'name': self.name,
+            'ready': printer.ready,
+            'printing': printer.printing,
+            'job': self.job_scheduler.current_job,
+            'extruder_temperature': printer.extruder_heater.temperature if printer.extruder_heater else None,
+            'extruder_set_temperature':
+                printer.extruder_heater.get_set_temperature() if printer.extruder_heater else None
+        }
+        if printer.heated_bed:
+            status['bed_temperature'] = printer.heated_bed.temperature
+            status['bed_set_temperature'] = printer.heated_bed.get_set_temperature()
+        connection = printer.machine.machine_connection
+        if connection:
+            status['queue_length'] = connection.internal_queue_length
+            status['max_queue_length'] = connection.internal_queue_max_length
+        print_thread = self.job_scheduler.print_thread
+        if print_thread and print_thread.printing:
+            status['lines_printed'] = print_thread.lines_printed
+            status['lines_printed_percent'] = print_thread.progress() * 100
+        return status
+
+    def stop(self):
+        self.job_scheduler.stop()
+        self.printer.stop()
+        if self.firmware_simulator:
+            self.firmware_simulator.stop()
+
+
+class PrinterFarm(object):
+    def __init__(self, config, job_file_pattern=None, indexer=None, upload_manager=None, simulator_speedup=1.0):
+        """
+        job_file_pattern: where the jobs of each printer are stored, e.g. '/var/print_jobs_%s.json'
+        """
+        self.config = config
+        self.job_file_pattern = job_file_pattern
+        self.indexer = indexer
+        self.upload_manager = upload_manager
+        self.simulator_speedup = simulator_speedup
+        self.printers = OrderedDict()
+        # the printers which did not come up and why
+        self.errors = {}
+        self._printer_configs = read_farm_config(config, shared_heaters=hardware.is_simulated())
+        if not self._printer_configs:
+            raise FarmError("There is no farm in the config")
+
+    def start(self):
+        # connecting takes a while (resetting a T-Bone takes 16 seconds) - so they all do it at the same time
+        farm_printers = [self._create_printer(printer_config) for printer_config in self._printer_configs]
+        connect_threads = []
+        for farm_printer, printer_config in zip(farm_printers, self._printer_configs):
+            connect_thread = threading.Thread(target=self._connect, args=(farm_printer, printer_config))
+            connect_thread.start()
+            connect_threads.append(connect_thread)
+        for connect_thread in connect_threads:
+            connect_thread.join()
+        for farm_printer in farm_printers:
+            if farm_printer.name in self.errors:
+                farm_printer.stop()
+            else:
+                farm_printer.job_scheduler.start()
+                self.printers[farm_printer.name] = farm_printer
+        _logger.info("Started %s of %s printers", len(self.printers), len(farm_printers))
+
+    def printer(self, name):
+        if name not in self.printers:
+            raise FarmError("There is no printer %s" % name)
+        return self.printers[name]
+
+    def status(self):
+        return [farm_printer.status() for farm_printer in self.printers.itervalues()]
+
+    def stop(self):
+        # each one waits for its serial line to close - so they better wait together
+        stop_threads = [threading.Thread(target=farm_printer.stop) for farm_printer in self.printers.itervalues()]
+        for stop_thread in stop_threads:
+            stop_thread.start()
+        for stop_thread in stop_threads:
+            stop_thread.join()
+        self.printers.clear()
+
+    def _create_printer(self, printer_config):
+        name = printer_config['name']
+        firmware_simulator = None
+        if hardware.is_simulated():
+            # it emulates the serial line too - so each printer gets no more moves through than a real one
+            firmware_simulator = FirmwareSimulator(speedup=self.simulator_speedup)
+            serial_port = firmware_simulator.serial_port
+            reset_pin = None
+        else:
+            serial_port = printer_config['serial-port']
+            reset_pin = printer_config.get('reset-pin')
+        printer = Printer(serial_port=serial_port, reset_pin=reset_pin)
+        if hardware.is_simulated():
+            printer.pin_namespace = name
+        printer.prepared_file = None
+        job_file = self.job_file_pattern % name if self.job_file_pattern else None
+        job_queue = JobQueue(job_file)
+        job_scheduler = JobScheduler(printer, job_queue, indexer=self.indexer, upload_manager=self.upload_manager)
+        return FarmPrinter(name, printer, job_queue, job_scheduler, firmware_simulator=firmware_simulator)
+
+    def _connect(self, farm_printer, printer_config):
+        config = _printer_config_of(self.config, printer_config)
+        try:
+            farm_printer.printer.connect(serial_reactor=read_serial_reactor(config),
+                                         serial_recorder=read_serial_recorder(config, name=farm_printer.name))
+            farm_printer.printer.configure(config)
+        except Exception as e:
+            _logger.exception("Unable to start printer %s", farm_printer.name)
+            self.errors[farm_printer.name] = str(e)
+
+
+def resource_usage():
+    """
+    What the process uses right now - CPU times in seconds, memory in kilobytes.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result = {
+        'threads': threading.active_count(),
+        'cpu_time': usage.ru_utime + usage.ru_stime,
+        'peak_memory': usage.ru_maxrss
+    }
+    # linux tells us more
+    if os.path.exists('/proc/self/fd'):
+        result['file_descriptors'] = len(os.listdir('/proc/self/fd'))
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as statm:
+            result['memory'] = int(statm.read().split()[1]) * _page_size / 1024
+    return result
+
+
+def measure_farm(printers=_default_printers, moves=_default_moves, corpus=_default_corpus, speedup=1000.0,
+                 timeout=600.0, serial_reactor=False):
+    """
+    Starts a farm of simulated printers, prints the corpus on each of them and reports what it cost.
+    """
+    hardware.select_backend(hardware.SIMULATED)
+    config = deepcopy(BENCHMARK_CONFIG)
+    config['farm'] = {'printers': [{'name': 'printer-%s' % number} for number in range(printers)]}
+    if serial_reactor:
+        config['printer']['serial-reactor'] = True
+    directory = tempfile.mkdtemp()
+    indexer = GCodeIndexer()
+    farm = PrinterFarm(config, indexer=indexer, simulator_speedup=speedup)
+    try:
+        before = resource_usage()
+        start = time.time()
+        farm.start()
+        started = resource_usage()
+        startup_time = time.time() - start
+
+        gcode_file_name = os.path.join(directory, corpus + '.gcode')
+        with open(gcode_file_name, 'w') as gcode_file:
+            gcode_file.write("\n".join(CORPORA[corpus](moves)))
+        jobs = [(farm_printer, farm_printer.job_queue.enqueue(gcode_file_name)['id'])
+                for farm_printer in farm.printers.itervalues()]
+        start = time.time()
+        cpu_time_before = started['cpu_time']
+        while not all(farm_printer.job_queue.job(job_id)['state'] in (DONE, FAILED, CANCELLED)
+                      for farm_printer, job_id in jobs):
+            if time.time() - start > timeout:
+                raise FarmError("The printers did not finish within %s seconds" % timeout)
+            time.sleep(_idle_wait_time)
+        print_time = time.time() - start
+        printed = resource_usage()
+        failed = [farm_printer.name for farm_printer, job_id in jobs
+                  if not farm_printer.job_queue.job(job_id)['state'] == DONE]
+        running_printers = len(farm.printers)
+        moves_printed = sum(farm_printer.firmware_simulator.moves_received for farm_printer in farm.printers.values())
+    finally:
+        farm.stop()
+        indexer.stop()
+        shutil.rmtree(directory)
+
+    def per_printer(key, usage):
+        if key not in usage or key not in before or not running_printers:
+            return None
+        return float(usage[key] - before[key]) / running_printers
+
+    return {
+        'printers': running_printers,
+        'failed': failed,
+        'errors': farm.errors,
+        'corpus': corpus,
+        'moves': moves_printed,
+        'startup_time': startup_time,
+        'print_time': print_time,
+        'moves_per_second': moves_printed / print_time if print_time else 0.0,
+        'threads_per_printer': per_printer('threads', started),
+        'file_descriptors_per_printer': per_printer('file_descriptors', started),
+        'memory_per_printer': per_printer('memory', printed),
+        # how much of a CPU each printer needs while printing
+        'cpu_share_per_printer': (printed['cpu_time'] - cpu_time_before) / print_time / running_printers
+        if print_time and running_printers else None,
+        'peak_memory': printed['peak_memory']
+    }
+
+
+def _print_result(result):
+    print "printers:             %d (failed: %s)" % (result['printers'], ", ".join(result['failed']) or "none")
+    print "moves:                %d in %.1f s (%.0f moves/s)" % (
+        result['moves'], result['print_time'], result['moves_per_second'])
+    print "startup:              %.1f s" % result['startup_time']
+    print "threads per printer:  %s" % result['threads_per_printer']
+    print "fds per printer:      %s" % result['file_descriptors_per_printer']
+    print "memory per printer:   %s kB" % result['memory_per_printer']
+    print "cpu per printer:      %.1f%%" % (result['cpu_share_per_printer'] * 100.0)
+    print "peak memory:          %d kB" % result['peak_memory']
+
+
+class FarmError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def main(argv=None):
+    usage = "usage: printer_farm.py [--printers=%s] [--moves=%s] [--corpus=%s] [--speedup=1000] " \
+            "[--serial-reactor] [--output=results.json]" % (_default_printers, _default_moves, _default_corpus)
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "p:n:c:s:o:rh",
+                                   ["printers=", "moves=", "corpus=", "speedup=", "output=", "serial-reactor",
+                                    "help"])
+    except getopt.error, msg:
+        print >> sys.stderr, msg
+        print >> sys.stderr, usage
+        return 2
+    printers = _default_printers
+    moves = _default_moves
+    corpus = _default_corpus
+    speedup = 1000.0
+    output = None
+    serial_reactor = False
+    for opt, value in opts:
+        if opt in ("-h", "--help"):
+            print usage
+            return 0
+        elif opt in ("-p", "--printers"):
+            printers = int(value)
+        elif opt in ("-n", "--moves"):
+            moves = int(value)
+        elif opt in ("-c", "--corpus"):
+            if value not in CORPORA:
+                print >> sys.stderr, "unknown corpus %s" % value
+                return 2
+            corpus = value
+        elif opt in ("-s", "--speedup"):
+            speedup = float(value)
+        elif opt in ("-o", "--output"):
+            output = value
+        elif opt in ("-r", "--serial-reactor"):
+            serial_reactor = True
+    logging.basicConfig(level=logging.WARN)
+    result = measure_farm(printers=printers, moves=moves, corpus=corpus, speedup=speedup,
+                          serial_reactor=serial_reactor)
+    _print_result(result)
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(result, output_file, indent=4, separators=(',', ': '))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,6 +10,93 @@ __author__ = 'marcus'
 _logger = logging.getLogger(__name__)
 
 def convert_ramps_reading(thermistor, thermistor_table, value):
+    return get_lookup_table(thermistor_table, thermistor).convert(value)
+
+
+def get_lookup_table(thermistor_table, thermistor=None):
+    lookup_table = _lookup_tables.get(id(thermistor_table))
+    if lookup_table is None or lookup_table.thermistor_table is not thermistor_table:
+        # not one of our tables - compile it once and keep it
+        lookup_table = compile_ramps_table(thermistor_table, thermistor)
+        _lookup_tables[id(thermistor_table)] = lookup_table
+    return lookup_table
+
+
+def compile_ramps_table(thermistor_table, thermistor=None):
+    return RampsLookupTable(thermistor_table, thermistor)
+
+
+class RampsLookupTable(object):
+    """
+    Dense version of a sparse marlin table.
+
+    For every possible 1024er reading the bracketing table entries are searched once and the linear interpolation
+    is stored as base temperature, base index and slope. A conversion is then a single index plus a multiply and
+    gives exactly the same result as scanning the sparse table.
+    """
+    __slots__ = ('thermistor', 'thermistor_table', '_base_index', '_base_temperature', '_slope')
+
+    def __init__(self, thermistor_table, thermistor=None):
+        self.thermistor = thermistor
+        self.thermistor_table = thermistor_table
+        self._base_index = []
+        self._base_temperature = []
+        self._slope = []
+        for index in range(_TABLE_SIZE):
+            base_index, base_temperature, slope = _find_interpolation(thermistor_table, index)
+            self._base_index.append(base_index)
+            self._base_temperature.append(base_temperature)
+            self._slope.append(slope)
+
+    def convert(self, value):
+        # the tables are from 1024er based arduino
+        comparable_value = value * 1024.0
+        index = int(comparable_value)
+        if 0 <= index < _TABLE_SIZE:
+            base_temperature = self._base_temperature[index]
+            if base_temperature is not None:
+                return base_temperature + self._slope[index] * (comparable_value - self._base_index[index])
+        # out of range or no table entry at all - do it the slow way
+        return _scan_ramps_reading(self.thermistor, self.thermistor_table, value)
+
+
+# the tables cover 0 to 1024 (inclusive)
+_TABLE_SIZE = 1025
+
+
+def _find_interpolation(thermistor_table, index):
+    # same search as in _scan_ramps_reading - but for an exact index
+    upper_index = index
+    upper_temperature = None
+    while upper_index >= 0:
+        if upper_index in thermistor_table:
+            upper_temperature = thermistor_table[upper_index]
+            break
+        upper_index -= 1
+    lower_index = index
+    lower_temperature = None
+    while lower_index <= 1024:
+        if lower_index in thermistor_table:
+            lower_temperature = thermistor_table[lower_index]
+            break
+        lower_index += 1
+
+    if upper_temperature and lower_temperature:
+        value_difference = float(upper_index - lower_index)
+        if value_difference == 0.0:
+            return 0, upper_temperature, 0.0
+        else:
+            temperature_difference = float(upper_temperature - lower_temperature)
+            return lower_index, float(lower_temperature), temperature_difference / value_difference
+    elif lower_temperature is not None:
+        return 0, lower_temperature, 0.0
+    elif upper_temperature is not None:
+        return 0, upper_temperature, 0.0
+    else:
+        return 0, None, 0.0
+
+
+def _scan_ramps_reading(thermistor, thermistor_table, value):
     # the tables are from 1024er based arduino
     comparable_value = value * 1024.0
     #find upper value
@@ -1104,4 +1191,16 @@ thermistor_makers_tool_kapton_bed = {
 # endif
 #endif
 
-#endif   #THERMISTORTABLES_H_
\ No newline at end of file
+#endif   #THERMISTORTABLES_H_
+
+# compile all the tables once at import time
+_lookup_tables = {}
+for _thermistor_table in (bed_thermistor_100k, bed_thermistor_200k, mendel_parts_thermistor, thermistor_10k,
+                          thermistor_parcan_100k, j_head_thermistor, thermistor_epcos_100k,
+                          thermistor_epcos_B57560G104F, thermistor_honeywell_100k,
+                          thermistor_honeywell_135_104_LAF_J01, thermistor_vishay_NTCS0603E3104FXT,
+                          thermistor_ge_sensing, thermistor_rs_198961, thermistor_ultimaker_v2,
+                          thermistor_epcos_100k_sanguinololu, thermistor_atc_semitek_200k,
+                          thermistor_atc_semitek_100k, thermistor_makers_tool_kapton_bed):
+    _lookup_tables[id(_thermistor_table)] = compile_ramps_table(_thermistor_table)
+del _thermistor_table
@@ -1,4 +1,6 @@
 __author__ = 'marcus'
+from bisect import bisect_left
+from math import log
 import numpy as np
 
 # taken from https://bitbucket.org/intelligentagent/redeem/src/e8f467317baa740d389479a45ce4be400edaa574/software/Thermistor.py?at=master
@@ -7,10 +9,18 @@ def convert_reading(temp_table, reading):
     return resistance_to_degrees(temp_table=temp_table, resistor_val=resistance)
 
 
+def convert_readings(temp_table, readings):
+    # converts a whole bunch of adc readings at once
+    resistances = voltages_to_resistances(np.asarray(readings, dtype=float) * 1.8)
+    return resistances_to_degrees(temp_table=temp_table, resistor_vals=resistances)
+
+
 def resistance_to_degrees(temp_table, resistor_val):
-    idx = (abs(temp_table[1] - resistor_val)).argmin()
+    return get_lookup_table(temp_table).resistance_to_degrees(resistor_val)
 
-    return temp_table[0][idx]
+
+def resistances_to_degrees(temp_table, resistor_vals):
+    return get_lookup_table(temp_table).resistances_to_degrees(resistor_vals)
 
 
 def voltage_to_resistance(v_sense):
@@ -18,6 +28,70 @@ def voltage_to_resistance(v_sense):
         return 10000000.0
     return 4700.0 / ((1.8 / v_sense) - 1.0)
 
+
+def voltages_to_resistances(v_senses):
+    v_senses = np.asarray(v_senses, dtype=float)
+    with np.errstate(divide='ignore'):
+        resistances = 4700.0 / ((1.8 / v_senses) - 1.0)
+    return np.where(v_senses == 0, 10000000.0, resistances)
+
+
+def get_lookup_table(temp_table):
+    lookup_table = _lookup_tables.get(id(temp_table))
+    if lookup_table is None or lookup_table.temp_table is not temp_table:
+        lookup_table = ResistanceLookupTable(temp_table)
+        _lookup_tables[id(temp_table)] = lookup_table
+    return lookup_table
+
+
+class ResistanceLookupTable(object):
+    """
+    The temperature table sorted by ascending resistance, ready for a binary search.
+
+    The resistance of a ntc is roughly exponential to the temperature - so we interpolate linear in the log
+    resistance between the two bracketing table entries. Outside of the table we stick to the last entry.
+    """
+
+    def __init__(self, temp_table):
+        self.temp_table = temp_table
+        # the resistance column is sorted descending
+        self._temperatures_array = np.array(temp_table[0][::-1], dtype=float)
+        self._resistances_array = np.array(temp_table[1][::-1], dtype=float)
+        self._log_resistances_array = np.log(self._resistances_array)
+        # plain lists are much faster than numpy for a single value
+        self._temperatures = self._temperatures_array.tolist()
+        self._resistances = self._resistances_array.tolist()
+        self._log_resistances = self._log_resistances_array.tolist()
+        self._length = len(self._resistances)
+
+    def convert_reading(self, reading):
+        return self.resistance_to_degrees(voltage_to_resistance(reading * 1.8))
+
+    def resistance_to_degrees(self, resistor_val):
+        upper = bisect_left(self._resistances, resistor_val)
+        if upper == 0:
+            return self._temperatures[0]
+        if upper == self._length:
+            return self._temperatures[-1]
+        lower = upper - 1
+        log_lower = self._log_resistances[lower]
+        fraction = (log(resistor_val) - log_lower) / (self._log_resistances[upper] - log_lower)
+        temperature_lower = self._temperatures[lower]
+        return temperature_lower + fraction * (self._temperatures[upper] - temperature_lower)
+
+    def resistances_to_degrees(self, resistor_vals):
+        resistor_vals = np.asarray(resistor_vals, dtype=float)
+        found = np.searchsorted(self._resistances_array, resistor_vals)
+        upper = np.clip(found, 1, self._length - 1)
+        lower = upper - 1
+        log_lower = self._log_resistances_array[lower]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = (np.log(resistor_vals) - log_lower) / (self._log_resistances_array[upper] - log_lower)
+        fraction = np.where(found == 0, 0.0, fraction)
+        fraction = np.where(found == self._length, 1.0, fraction)
+        temperatures_lower = self._temperatures_array[lower]
+        return temperatures_lower + fraction * (self._temperatures_array[upper] - temperatures_lower)
+
 # Charts for different thermistors.
 temp_chart = {}
 # This conversion table has been found in the datasheet for B57560G104F and is the one sold for MakerBot Plastruder MK4
@@ -892,4 +966,10 @@ temp_chart["B57561G0103F000"] = [
 #rearrange
 temp_table= {}
 for name, table in temp_chart.iteritems():
-    temp_table[name]=np.array(table).transpose()
\ No newline at end of file
+    temp_table[name]=np.array(table).transpose()
+
+# and prepare the binary search once
+_lookup_tables = {}
+for _table in temp_table.itervalues():
+    _lookup_tables[id(_table)] = ResistanceLookupTable(_table)
+del _table
@@ -0,0 +1,132 @@
+# coding=utf-8
+"""
+Merges runs of short, nearly collinear moves before they get planned.
+
+Curved perimeters and faceted surfaces come out of the slicer as long runs of tiny G1 segments. Each of them costs a
+full planning step and a command to the T-Bone. The SegmentCoalescer collects consecutive moves into one as long as
+
+ - the direction changes less than the angular tolerance from segment to segment,
+ - no point of the run is further than the chordal tolerance from the straight line which replaces it,
+ - all segments have the same feed rate and extrude the same amount per millimeter.
+
+So the merged path never deviates more than the chordal tolerance from the original one.
+"""
+import logging
+from math import cos, radians, sqrt
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+_default_angular_tolerance = 2.0  # degrees
+_default_chordal_tolerance = 0.01  # mm
+_default_extrusion_tolerance = 0.02  # relative difference of the extrusion per mm
+_default_max_segments = 32
+# the axis which make up the path - the extruder just follows
+_path_axis_names = ('x', 'y', 'z')
+_axis_names = ('x', 'y', 'z', 'e')
+
+
+class SegmentCoalescer(object):
+    def __init__(self, angular_tolerance=_default_angular_tolerance, chordal_tolerance=_default_chordal_tolerance,
+                 extrusion_tolerance=_default_extrusion_tolerance, max_segments=_default_max_segments):
+        self._min_cos_angle = cos(radians(angular_tolerance))
+        self.chordal_tolerance = chordal_tolerance
+        self.extrusion_tolerance = extrusion_tolerance
+        self.max_segments = max_segments
+        self.moves_received = 0
+        self.moves_emitted = 0
+        # the run of moves we are collecting
+        self._run_target = None
+        self._run_start = None
+        self._run_end = None
+        self._run_points = []
+        self._run_direction = None
+        self._run_extrusion = None
+
+    def add(self, target_position, position):
+        """
+        Takes the next target position and returns the list of positions which are ready to be planned.
+        position is where the planner currently is - the start of a new run.
+        """
+        if not target_position.get('type') == 'move':
+            planned = self.flush()
+            planned.append(target_position)
+            return planned
+        self.moves_received += 1
+        start = self._run_end if self._run_target else position
+        end = dict((axis_name, target_position.get(axis_name, start[axis_name])) for axis_name in _axis_names)
+        delta = [end[axis_name] - start[axis_name] for axis_name in _path_axis_names]
+        length = sqrt(sum(value * value for value in delta))
+        if length == 0:
+            # pure extruder moves (retractions) or nothing at all - those are not merged
+            planned = self.flush()
+            planned.append(self._emit(target_position))
+            return planned
+        direction = [value / length for value in delta]
+        extrusion = (end['e'] - start['e']) / length
+        if self._run_target:
+            if self._can_merge(target_position, end, direction, extrusion):
+                self._run_points.append(self._run_end)
+                self._run_end = end
+                self._run_direction = direction
+                return []
+            planned = self.flush()
+        else:
+            planned = []
+        self._run_target = target_position
+        self._run_start = dict((axis_name, start[axis_name]) for axis_name in _axis_names)
+        self._run_end = end
+        self._run_points = []
+        self._run_direction = direction
+        self._run_extrusion = extrusion
+        return planned
+
+    def flush(self):
+        # returns the collected run - if there is any
+        if not self._run_target:
+            return []
+        target_position = dict(self._run_target)
+        target_position.update(self._run_end)
+        self._run_target = None
+        self._run_points = []
+        return [self._emit(target_position)]
+
+    def _emit(self, target_position):
+        self.moves_emitted += 1
+        return target_position
+
+    def _can_merge(self, target_position, end, direction, extrusion):
+        if len(self._run_points) + 1 >= self.max_segments:
+            return False
+        if 'target_speed' in target_position and \
+                not target_position['target_speed'] == self._run_target.get('target_speed'):
+            return False
+        cos_angle = sum(a * b for a, b in zip(direction, self._run_direction))
+        if cos_angle < self._min_cos_angle:
+            return False
+        if not self._same_extrusion(extrusion):
+            return False
+        # every point we leave out must stay close to the new line
+        for point in self._run_points + [self._run_end]:
+            if _distance_to_line(point, self._run_start, end) > self.chordal_tolerance:
+                return False
+        return True
+
+    def _same_extrusion(self, extrusion):
+        run_extrusion = self._run_extrusion
+        if run_extrusion == 0 or extrusion == 0:
+            return run_extrusion == extrusion
+        return abs(extrusion - run_extrusion) <= self.extrusion_tolerance * abs(run_extrusion)
+
+
+def _distance_to_line(point, start, end):
+    # distance of the point from the line segment start-end
+    line = [end[axis_name] - start[axis_name] for axis_name in _path_axis_names]
+    offset = [point[axis_name] - start[axis_name] for axis_name in _path_axis_names]
+    length_sqr = sum(value * value for value in line)
+    if length_sqr == 0:
+        return sqrt(sum(value * value for value in offset))
+    factor = sum(a * b for a, b in zip(offset, line)) / length_sqr
+    factor = max(0.0, min(1.0, factor))
+    return sqrt(sum((o - factor * l) ** 2 for o, l in zip(offset, line)))
@@ -0,0 +1,373 @@
+# coding=utf-8
+"""
+One thread for the serial lines of all printers.
+
+The _MachineConnection of a machine has a listening thread of its own and holds a lock for a whole round trip. The
+SerialReactor instead watches the non blocking file descriptors of all serial lines in one select loop. It splits
+what comes in at the ';' as it arrives and hands each reply to the CommandFuture of the command it answers.
+Heartbeats (-128) and wait replies (-1) never get to a command - a heartbeat just tells us the machine is alive, a wait
+gives the command more time.
+
+A ReactorConnection looks just like a _MachineConnection to the Machine - send_command blocks until the reply is
+there. Any thread may send: the commands wait in line and are written by the reactor as soon as the machine is ready
+for them. Or they can be submitted and the future be looked at later.
+
+    reactor = shared_reactor()
+    machine.connect(serial_reactor=reactor)
+"""
+from collections import deque
+import errno
+import fcntl
+import logging
+import os
+import select
+import threading
+from threading import Thread
+import time
+
+from machine import MachineCommand, MachineError, encode_command, OUT, IN
+import tracing
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+_default_timeout = 120
+# the arduino reads one command at a time - its serial buffer is tiny
+_default_max_in_flight = 1
+_read_size = 4096
+# the reactor looks at the timeouts at least that often
+_max_select_time = 1.0
+_heartbeat_command = -128
+_wait_command = -1
+
+_shared_reactor = None
+_shared_reactor_lock = threading.Lock()
+
+
+def shared_reactor():
+    # all printers of the process share one reactor
+    global _shared_reactor
+    with _shared_reactor_lock:
+        if not _shared_reactor or not _shared_reactor.isAlive():
+            _shared_reactor = SerialReactor()
+            _shared_reactor.start()
+        return _shared_reactor
+
+
+def read_serial_reactor(config):
+    # the reactor to connect the printer with - None for a listening thread of its own
+    if config and config.get('printer', {}).get('serial-reactor'):
+        return shared_reactor()
+    return None
+
+
+class CommandFuture(object):
+    """
+    The reply to a command - once it is there.
+    """
+
+    def __init__(self, command, timeout=_default_timeout, trace=None):
+        self.command = command
+        self.timeout = timeout
+        self.trace = trace
+        # set by the reactor once the command is written
+        self.deadline = None
+        self._done = threading.Event()
+        self._reply = None
+        self._error = None
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """
+        Waits for the reply - the reactor takes care of the timeout of the command itself.
+        """
+        if not self._done.wait(timeout):
+            raise MachineError("No reply to %s yet" % self.command)
+        if self._error:
+            raise self._error
+        return self._reply
+
+    def set_result(self, reply):
+        self._reply = reply
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._done.set()
+
+
+class ReactorConnection(object):
+    """
+    A serial line watched by the reactor - with the interface of the _MachineConnection.
+    """
+
+    def __init__(self, machine_serial, reactor, timeout=_default_timeout, max_in_flight=_default_max_in_flight,
+                 recorder=None):
+        self.machine_serial = machine_serial
+        self.reactor = reactor
+        self.recorder = recorder
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.fd = machine_serial.fileno()
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.last_heartbeat = None
+        self.internal_queue_length = 0
+        self.internal_queue_max_length = 1
+        # how often the machine told us to wait
+        self.wait_replies = 0
+        self.broken = None
+        self._lock = threading.Lock()
+        # not written yet
+        self._waiting = deque()
+        # written - the replies come in this order
+        self._in_flight = deque()
+        self._output = ''
+        self._input = ''
+        self._ready = threading.Event()
+        self._closed = threading.Event()
+        reactor.register(self)
+        # everything before the first heartbeat is from before our time
+        if not self._ready.wait(timeout):
+            self.stop()
+            raise MachineError("Machine does not seem to be ready")
+
+    def submit(self, command, timeout=None, trace=None):
+        future = CommandFuture(command, timeout or self.timeout, trace)
+        with self._lock:
+            if self.broken:
+                raise self.broken
+            self._waiting.append(future)
+        self.reactor.wake()
+        return future
+
+    def send_command(self, command, timeout=None, trace=None):
+        return self.submit(command, timeout, trace).result()
+
+    def last_heart_beat(self):
+        if self.last_heartbeat:
+            return time.time() - self.last_heartbeat
+        else:
+            return None
+
+    def stop(self):
+        self.reactor.unregister(self)
+        self._closed.wait(self.timeout)
+        self._fail(MachineError("The connection is closed"))
+        self.machine_serial.close()
+        if self.recorder:
+            self.recorder.stop()
+
+    # the rest is called by the reactor
+    def wants_to_write(self):
+        with self._lock:
+            return bool(self._output) or (bool(self._waiting) and len(self._in_flight) < self.max_in_flight)
+
+    def next_deadline(self):
+        with self._lock:
+            if self._in_flight:
+                return self._in_flight[0].deadline
+            return None
+
+    def handle_write(self, now):
+        with self._lock:
+            while self._waiting and len(self._in_flight) < self.max_in_flight:
+                future = self._waiting.popleft()
+                future.deadline = now + future.timeout
+                self._in_flight.append(future)
+                line = encode_command(future.command)
+                self._output += line
+                if self.recorder:
+                    self.recorder.record(OUT, line.rstrip(';\n'))
+                if future.trace:
+                    future.trace.stamp(tracing.WRITTEN)
+            output = self._output
+        if not output:
+            return
+        try:
+            written = os.write(self.fd, output)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self._fail(MachineError("Unable to write to the machine: %s" % e))
+            return
+        with self._lock:
+            self._output = self._output[written:]
+
+    def handle_read(self, now):
+        try:
+            data = os.read(self.fd, _read_size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self._fail(MachineError("Unable to read from the machine: %s" % e))
+            # there is nothing more to watch
+            self.reactor.unregister(self)
+            return
+        if not data:
+            self._fail(MachineError("The machine closed the connection"))
+            self.reactor.unregister(self)
+            return
+        self._input += data
+        while ';' in self._input:
+            frame, self._input = self._input.split(';', 1)
+            frame = frame.strip()
+            if frame:
+                if self.recorder:
+                    self.recorder.record(IN, frame)
+                self._handle_frame(MachineCommand(frame), now)
+
+    def check_timeout(self, now):
+        deadline = self.next_deadline()
+        if deadline is not None and deadline < now:
+            # just like the listening thread - we give up on the machine
+            self._fail(MachineError("Machine does not listen!"))
+
+    def closed(self):
+        self._closed.set()
+
+    def _handle_frame(self, reply, now):
+        if reply.command_number == _heartbeat_command:
+            self.last_heartbeat = now
+            if reply.arguments and len(reply.arguments) == 2:
+                self.internal_queue_length = reply.arguments[0]
+                self.internal_queue_max_length = reply.arguments[1]
+            else:
+                _logger.warn("did not understand status command %s", reply)
+            self._ready.set()
+        elif not self._ready.isSet():
+            pass
+        elif reply.command_number == _wait_command:
+            # the machine is still busy with it
+            with self._lock:
+                self.wait_replies += 1
+                if self._in_flight:
+                    future = self._in_flight[0]
+                    future.deadline = now + future.timeout
+        else:
+            with self._lock:
+                future = self._in_flight.popleft() if self._in_flight else None
+            if not future:
+                _logger.warn("Received %s without a command waiting for it", reply)
+                return
+            if future.trace:
+                future.trace.stamp(tracing.ACKNOWLEDGED)
+            future.set_result(reply)
+
+    def _fail(self, error):
+        with self._lock:
+            if not self.broken:
+                self.broken = error
+            futures = list(self._in_flight) + list(self._waiting)
+            self._in_flight.clear()
+            self._waiting.clear()
+        for future in futures:
+            future.set_error(error)
+
+
+class SerialReactor(Thread):
+    """
+    Watches the serial lines of all connections in one select loop.
+    """
+
+    def __init__(self):
+        super(SerialReactor, self).__init__(name="serial reactor")
+        self.daemon = True
+        self.running = True
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._removed = []
+        # writing to it wakes up the select
+        self._wake_read, self._wake_write = os.pipe()
+        for fd in (self._wake_read, self._wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def connect(self, machine_serial, timeout=_default_timeout, recorder=None):
+        return ReactorConnection(machine_serial, self, timeout=timeout, recorder=recorder)
+
+    def register(self, connection):
+        with self._lock:
+            self._connections[connection.fd] = connection
+        self.wake()
+
+    def unregister(self, connection):
+        # the connection is closed once the reactor let go of it
+        with self._lock:
+            if self._connections.get(connection.fd) is connection:
+                del self._connections[connection.fd]
+                self._removed.append(connection)
+            else:
+                connection.closed()
+        self.wake()
+        if not self.isAlive():
+            self._release()
+
+    def wake(self):
+        try:
+            os.write(self._wake_write, 'x')
+        except OSError as e:
+            # it is awake already - or stopped
+            if e.errno not in (errno.EAGAIN, errno.EBADF):
+                raise
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.isAlive():
+            self.join()
+        for connection in self._connections.values():
+            connection.closed()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def run(self):
+        while self.running:
+            try:
+                self._run_once()
+            except Exception:
+                _logger.exception("Unexpected error in the serial reactor")
+        self._release()
+
+    def _run_once(self):
+        self._release()
+        with self._lock:
+            connections = self._connections.values()
+        readers = [self._wake_read] + [connection.fd for connection in connections]
+        writers = [connection.fd for connection in connections if connection.wants_to_write()]
+        now = time.time()
+        select_time = _max_select_time
+        for connection in connections:
+            deadline = connection.next_deadline()
+            if deadline is not None:
+                select_time = max(0.0, min(select_time, deadline - now))
+        try:
+            readable, writable, _ = select.select(readers, writers, [], select_time)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        now = time.time()
+        if self._wake_read in readable:
+            try:
+                os.read(self._wake_read, _read_size)
+            except OSError as e:
+                if not e.errno == errno.EAGAIN:
+                    raise
+        by_fd = dict((connection.fd, connection) for connection in connections)
+        for fd in readable:
+            if fd in by_fd:
+                by_fd[fd].handle_read(now)
+        for fd in writable:
+            by_fd[fd].handle_write(now)
+        for connection in connections:
+            connection.check_timeout(now)
+
+    def _release(self):
+        with self._lock:
+            removed = self._removed
+            self._removed = []
+        for connection in removed:
+            connection.closed()
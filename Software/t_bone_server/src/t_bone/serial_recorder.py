@@ -0,0 +1,428 @@
+# coding=utf-8
+"""
+Records the traffic on the serial line of a machine - and plays it back.
+
+A SerialRecorder writes every frame which goes to the machine and every frame which comes back with a monotonic
+timestamp to a compact binary file. Recording a frame just copies it into a preallocated buffer - a writer thread
+writes the full buffers to the file. If the writer cannot keep up frames are dropped and counted, but the serial line
+never waits for the file. The recording is switched on in the printer config:
+
+    "serial-recording": {"file": "/var/log/t_bone_serial.rec"}
+
+A recording can be played back in two ways:
+
+    - a RecordedMachine plays the machine: it answers whatever the host sends with the replies of the recording, at
+      the same pace. So a stall of the machine can be reproduced with the real host stack.
+    - the RecordingReplayer plays the host: it sends the recorded commands through a machine connection - to a
+      RecordedMachine or the firmware simulator - and measures how long each round trip takes.
+
+    PYTHONPATH=src python -m t_bone.serial_recorder --target=simulator /var/log/t_bone_serial.rec
+    PYTHONPATH=src python -m t_bone.serial_recorder --dump /var/log/t_bone_serial.rec
+"""
+import getopt
+import json
+import logging
+import os
+from Queue import Queue, Empty
+import pty
+import re
+import struct
+import sys
+import threading
+from threading import Thread
+import time
+import tty
+
+from machine import MachineCommand, OUT, IN
+from serial_reactor import shared_reactor
+from tracing import monotonic
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+_magic = 'TBSR'
+_version = 1
+# magic, version & the wall clock at the start of the recording
+_file_header = struct.Struct('<4sHd')
+# direction, microseconds since the start of the recording, length of the frame
+_record_header = struct.Struct('<BQH')
+_default_buffer_size = 64 * 1024
+_default_buffer_count = 4
+# the writer writes at least that often
+_flush_interval = 1.0
+_stop_wait_time = 5
+# out of band replies - they do not answer a command
+_heartbeat_command = -128
+_wait_command = -1
+# after the end of the recording the machine just idles - like the firmware it says so every second
+_idle_heartbeat_interval = 1.0
+_idle_heartbeat = '-128,0,1'
+_integer_pattern = re.compile('^-?\d+$')
+
+
+class SerialRecorder(object):
+    def __init__(self, file_name, buffer_size=_default_buffer_size, buffer_count=_default_buffer_count):
+        self.file_name = file_name
+        self.buffer_size = buffer_size
+        self.frames_recorded = 0
+        self.frames_dropped = 0
+        self._lock = threading.Lock()
+        self._free_buffers = Queue()
+        for _ in range(buffer_count - 1):
+            self._free_buffers.put(bytearray(buffer_size))
+        self._buffer = bytearray(buffer_size)
+        self._filled = 0
+        self._full_buffers = Queue()
+        self._file = open(file_name, 'wb')
+        self._file.write(_file_header.pack(_magic, _version, time.time()))
+        self._start = monotonic()
+        self._running = True
+        self._writer_thread = Thread(target=self._write, name="serial recorder")
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    def record(self, direction, frame):
+        # this runs on the serial line - so it must be quick
+        length = _record_header.size + len(frame)
+        with self._lock:
+            if self._buffer is None or self._filled + length > self.buffer_size:
+                self._hand_over()
+            if self._buffer is None or length > self.buffer_size:
+                self.frames_dropped += 1
+                return
+            microseconds = int((monotonic() - self._start) * 1000000)
+            _record_header.pack_into(self._buffer, self._filled, direction, microseconds, len(frame))
+            start = self._filled + _record_header.size
+            self._buffer[start:start + len(frame)] = frame
+            self._filled += length
+            self.frames_recorded += 1
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        with self._lock:
+            self._hand_over()
+        self._full_buffers.put(None)
+        self._writer_thread.join(_stop_wait_time)
+        if self.frames_dropped:
+            _logger.warn("Dropped %s of %s frames recording to %s", self.frames_dropped,
+                         self.frames_dropped + self.frames_recorded, self.file_name)
+
+    def _hand_over(self):
+        # the writer gets the buffer - and we take the next free one, if there is one
+        if self._buffer is not None and self._filled:
+            self._full_buffers.put((self._buffer, self._filled))
+            self._buffer = None
+        if self._buffer is None:
+            try:
+                self._buffer = self._free_buffers.get_nowait()
+                self._filled = 0
+            except Empty:
+                pass
+
+    def _write(self):
+        while True:
+            try:
+                full_buffer = self._full_buffers.get(timeout=_flush_interval)
+            except Empty:
+                # nothing got full for a while - we write what is there
+                with self._lock:
+                    self._hand_over()
+                continue
+            if full_buffer is None:
+                break
+            data, length = full_buffer
+            try:
+                self._file.write(buffer(data, 0, length))
+                self._file.flush()
+            except (IOError, OSError) as e:
+                _logger.error("Unable to write to %s: %s", self.file_name, e)
+            self._free_buffers.put(data)
+        self._file.close()
+
+
+def read_serial_recorder(config, name=None):
+    """
+    The recorder for the serial line of the printer - or None if nothing gets recorded.
+    name: of the printer, if there are more printers they need a file each
+    """
+    recording_config = config.get('printer', {}).get('serial-recording') if config else None
+    if not recording_config:
+        return None
+    file_name = recording_config['file']
+    if name:
+        root, extension = os.path.splitext(file_name)
+        file_name = "%s_%s%s" % (root, name, extension)
+    return SerialRecorder(file_name, buffer_size=recording_config.get('buffer-size', _default_buffer_size))
+
+
+def read_recording(file_name):
+    """
+    Returns the frames of the recording - as tuples of direction, seconds since the start and frame.
+    """
+    with open(file_name, 'rb') as recording_file:
+        data = recording_file.read()
+    if len(data) < _file_header.size:
+        raise RecordingError("%s is no recording" % file_name)
+    magic, version, _ = _file_header.unpack_from(data)
+    if not magic == _magic or not version == _version:
+        raise RecordingError("%s is no recording of version %s" % (file_name, _version))
+    frames = []
+    offset = _file_header.size
+    while offset + _record_header.size <= len(data):
+        direction, microseconds, length = _record_header.unpack_from(data, offset)
+        offset += _record_header.size
+        frames.append((direction, microseconds / 1000000.0, data[offset:offset + length]))
+        offset += length
+    return frames
+
+
+def command_from_frame(frame):
+    """
+    The command which is encoded to exactly the frame again.
+    """
+    parts = frame.split(',')
+    command = MachineCommand()
+    command.command_number = int(parts[0])
+    if len(parts) > 1:
+        command.arguments = [int(part) if _integer_pattern.match(part) else float(part) for part in parts[1:]]
+    return command
+
+
+def _replies(frames):
+    # the commands and the reply to each of them from the recording
+    commands = []
+    for direction, timestamp, frame in frames:
+        if direction == OUT:
+            commands.append([timestamp, frame, None])
+        elif commands and commands[-1][2] is None:
+            command_number = MachineCommand(frame).command_number
+            if command_number not in (_heartbeat_command, _wait_command):
+                commands[-1][2] = frame
+    return commands
+
+
+class RecordedMachine(object):
+    """
+    Plays the machine of a recording on a pseudo terminal - the replies of the recording go back at the same pace.
+    After the recording it keeps sending the last heartbeat until it is stopped.
+    """
+
+    def __init__(self, file_name, speedup=1.0):
+        self.frames = read_recording(file_name)
+        self.speedup = float(speedup)
+        self.master_fd, self._slave_fd = pty.openpty()
+        tty.setraw(self._slave_fd)
+        self.serial_port = os.ttyname(self._slave_fd)
+        # the commands which were not the recorded ones
+        self.mismatches = 0
+        self.frames_received = 0
+        self.finished = False
+        self.running = True
+        self._playing_thread = Thread(target=self._play)
+        self._playing_thread.daemon = True
+        self._playing_thread.start()
+
+    def stop(self):
+        self.running = False
+        try:
+            os.close(self._slave_fd)
+            os.close(self.master_fd)
+        except OSError:
+            pass
+
+    def _play(self):
+        remainder = ''
+        # like the noise on the line after a reset - the connection sucks it empty before it listens
+        try:
+            os.write(self.master_fd, ';\r\n')
+        except OSError:
+            return
+        # the replies are sent relative to the command they follow
+        reference = monotonic()
+        reference_timestamp = 0.0
+        heartbeat = _idle_heartbeat
+        for direction, timestamp, frame in self.frames:
+            if not self.running:
+                return
+            if direction == IN:
+                if MachineCommand(frame).command_number == _heartbeat_command:
+                    heartbeat = frame
+                delay = (timestamp - reference_timestamp) / self.speedup - (monotonic() - reference)
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    os.write(self.master_fd, frame + ';\r\n')
+                except OSError:
+                    return
+            else:
+                while ';' not in remainder:
+                    try:
+                        data = os.read(self.master_fd, 1024)
+                    except OSError:
+                        return
+                    if not data:
+                        return
+                    remainder += data
+                received, remainder = remainder.split(';', 1)
+                reference = monotonic()
+                reference_timestamp = timestamp
+                self.frames_received += 1
+                if not received.strip() == frame:
+                    _logger.warn("Expected %s but received %s", frame, received.strip())
+                    self.mismatches += 1
+        self.finished = True
+        while self.running:
+            time.sleep(_idle_heartbeat_interval)
+            try:
+                os.write(self.master_fd, heartbeat + ';\r\n')
+            except OSError:
+                return
+
+
+class RecordingReplayer(object):
+    """
+    Sends the commands of a recording through a machine connection.
+    """
+
+    def __init__(self, file_name, speedup=None):
+        """
+        speedup: keeps the pace of the recording that many times faster - None to send as fast as possible
+        """
+        self.file_name = file_name
+        self.speedup = speedup
+        self.commands = _replies(read_recording(file_name))
+
+    def replay(self, machine_connection, skip=1):
+        """
+        skip: the commands already sent - like the init command of the connection
+        """
+        latencies = []
+        mismatches = 0
+        start = monotonic()
+        first_timestamp = self.commands[skip][0] if len(self.commands) > skip else 0.0
+        for timestamp, frame, recorded_reply in self.commands[skip:]:
+            if self.speedup:
+                delay = (timestamp - first_timestamp) / self.speedup - (monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            sent = monotonic()
+            reply = machine_connection.send_command(command_from_frame(frame))
+            latencies.append(monotonic() - sent)
+            if recorded_reply is not None and \
+                    not reply.command_number == MachineCommand(recorded_reply).command_number:
+                mismatches += 1
+        duration = monotonic() - start
+        latencies.sort()
+        result = {
+            'commands': len(latencies),
+            'mismatched_replies': mismatches,
+            'duration': duration,
+            'recorded_duration': self.commands[-1][0] - first_timestamp if len(self.commands) > skip else 0.0,
+            'commands_per_second': len(latencies) / duration if duration else 0.0,
+            'mean_latency': sum(latencies) / len(latencies) if latencies else 0.0,
+            'median_latency': latencies[len(latencies) / 2] if latencies else 0.0,
+            'max_latency': latencies[-1] if latencies else 0.0
+        }
+        _logger.info("Replayed %s: %s", self.file_name, result)
+        return result
+
+
+def replay(file_name, target='recording', speedup=None, serial_reactor=None):
+    """
+    Connects a machine to the target - the recorded machine or the firmware simulator - and replays the recording.
+    """
+    # here to keep the simulator out of the server
+    from firmware_simulator import FirmwareSimulator
+    from machine import Machine
+
+    replayer = RecordingReplayer(file_name, speedup=speedup)
+    if target == 'recording':
+        simulated_machine = RecordedMachine(file_name, speedup=speedup or 1.0)
+    elif target == 'simulator':
+        simulated_machine = FirmwareSimulator(speedup=speedup or 1.0)
+    else:
+        raise RecordingError("Cannot replay to %s" % target)
+    machine = Machine(serial_port=simulated_machine.serial_port)
+    try:
+        machine.connect(serial_reactor=serial_reactor)
+        result = replayer.replay(machine.machine_connection)
+        result['target'] = target
+        if target == 'recording':
+            result['mismatched_commands'] = simulated_machine.mismatches
+        return result
+    finally:
+        machine.disconnect()
+        simulated_machine.stop()
+
+
+def _print_result(result):
+    print "target:               %s" % result['target']
+    print "commands:             %d in %.2f s (recorded: %.2f s)" % (
+        result['commands'], result['duration'], result['recorded_duration'])
+    print "mismatched replies:   %d" % result['mismatched_replies']
+    if 'mismatched_commands' in result:
+        print "mismatched commands:  %d" % result['mismatched_commands']
+    print "latency:              %.2f ms mean, %.2f ms median, %.2f ms max" % (
+        result['mean_latency'] * 1000.0, result['median_latency'] * 1000.0, result['max_latency'] * 1000.0)
+
+
+class RecordingError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def main(argv=None):
+    usage = "usage: serial_recorder.py [--target=recording|simulator] [--speedup=1.0] [--serial-reactor] [--dump] " \
+            "[--output=results.json] recording.rec"
+    if argv is None:
+        argv = sys.argv
+    try:
+        opts, args = getopt.getopt(argv[1:], "t:s:rdo:h",
+                                   ["target=", "speedup=", "serial-reactor", "dump", "output=", "help"])
+    except getopt.error, msg:
+        print >> sys.stderr, msg
+        print >> sys.stderr, usage
+        return 2
+    target = 'recording'
+    speedup = None
+    serial_reactor = None
+    dump = False
+    output = None
+    for opt, value in opts:
+        if opt in ("-h", "--help"):
+            print usage
+            return 0
+        elif opt in ("-t", "--target"):
+            target = value
+        elif opt in ("-s", "--speedup"):
+            speedup = float(value)
+        elif opt in ("-r", "--serial-reactor"):
+            serial_reactor = shared_reactor()
+        elif opt in ("-d", "--dump"):
+            dump = True
+        elif opt in ("-o", "--output"):
+            output = value
+    if not len(args) == 1:
+        print >> sys.stderr, usage
+        return 2
+    logging.basicConfig(level=logging.WARN)
+    if dump:
+        for direction, timestamp, frame in read_recording(args[0]):
+            print "%10.6f %s %s" % (timestamp, '>' if direction == OUT else '<', frame)
+        return 0
+    result = replay(args[0], target=target, speedup=speedup, serial_reactor=serial_reactor)
+    _print_result(result)
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(result, output_file, indent=4, separators=(',', ': '))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,31 +1,74 @@
-from dircache import listdir
-import fnmatch
 from genericpath import isfile
 import json
 import logging
 import os
 import threading
 
-from flask import Flask, render_template, request, redirect
+from flask import Flask, Request, render_template, request, redirect
 import flask
+from werkzeug.exceptions import Conflict
 from werkzeug.utils import secure_filename
 import beaglebone_helpers
-from gcode_interpreter import GCodePrintThread
+import hardware
+from log_handler import AsyncRotatingFileHandler
+from job_queue import JobQueue, JobScheduler, JobError
+from printer_farm import PrinterFarm, FarmError, read_farm_config
+from gcode_index import GCodeIndexer
+from upload import UploadManager, Upload, UploadError
+from print_analyzer import AnalysisService, format_duration
+from upload_directory import UploadDirectory
+from serial_reactor import read_serial_reactor
+from serial_recorder import read_serial_recorder
 from t_bone import json_config_file
 
 T_BONE_LOG_FILE = '/var/log/t_bone.log'
+T_BONE_TRACE_FILE = '/var/log/t_bone_trace.json'
 
 _logger = logging.getLogger(__name__)
 # this is THE printer - just a dictionary with anything
 _printer = None
-_print_thread = None
+# the jobs for the printer and who prints them
+_job_queue = None
+_job_scheduler = None
+# if there is more than one printer - the first one is THE printer then
+_printer_farm = None
+# estimates the print times of the uploaded files
+_analysis_service = None
+# and indexes them once they are uploaded
+_gcode_indexer = GCodeIndexer()
+# writes the uploads directly to the upload folder
+_upload_manager = None
+# knows what is in the upload folder
+_upload_directory = None
+_files_per_page = 50
 _printer_busy = False
 _printer_busy_lock = threading.RLock()
+
+
+class _StreamingUploadRequest(Request):
+    # uploaded g code files are not spooled to a temporary file but go straight to the upload folder
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename and beaglebone_helpers.allowed_file(filename):
+            # the length of the file if the client tells us - otherwise the length of the request is close enough
+            try:
+                upload = get_upload_manager().start(secure_filename(filename),
+                                                    expected_size=content_length or total_content_length)
+            except UploadError as e:
+                raise Conflict(str(e))
+            if not hasattr(self, 'uploads'):
+                self.uploads = []
+            self.uploads.append(upload)
+            return upload
+        return Request._get_file_stream(self, total_content_length, content_type, filename, content_length)
+
+
 app = Flask(__name__,
             static_folder='static',
             static_url_path='')
+app.request_class = _StreamingUploadRequest
 UPLOAD_FOLDER = '/var/print_uploads'
 MAX_CONTENT_LENGTH = 2 * 1024 * 1024 * 1024
+JOB_FILE = '/var/print_jobs.json'
 
 axis_directions = {
     'x': {
@@ -71,36 +114,237 @@ def print_page():
     if request.method == 'POST':
         if request.files and 'uploadfile' in request.files:
             file = request.files['uploadfile']
-            if file and beaglebone_helpers.allowed_file(file.filename):
+            if file and isinstance(file.stream, Upload):
+                # it got streamed to the upload folder already
+                try:
+                    get_upload_manager().finish(file.stream)
+                except (IOError, OSError) as e:
+                    _logger.warn("unable to save file %s: %s", file.stream.path, e)
+            elif file and beaglebone_helpers.allowed_file(file.filename):
                 filename = secure_filename(file.filename)
                 upload_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
                 try:
                     _logger.info("Saving file %s to %s", filename, upload_path)
                     file.save(upload_path)
+                    get_upload_directory().invalidate(upload_path)
+                    _gcode_indexer.request(upload_path)
                 except:
                     _logger.warn("unable to save file %s to %s", filename, upload_path)
         elif 'printfile' in request.form:
             filename = request.form['printfile']
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            if isfile(file_path) and beaglebone_helpers.allowed_file(filename):
-                _printer.prepared_file = file_path
-                _logger.info("Printing %s", _printer.prepared_file)
-                global _print_thread
-                _print_thread = GCodePrintThread(_printer.prepared_file, _printer, None)
-                _print_thread.start()
+            upload = get_upload_manager().uploads.get(file_path)
+            if upload:
+                # we do not have to wait for the rest of the file
+                start_print(file_path)
+            elif isfile(file_path) and beaglebone_helpers.allowed_file(filename):
+                try:
+                    start_layer = _read_start_layer(file_path, request.form.get('startlayer'))
+                except ValueError:
+                    return "unable to start at layer %s" % request.form['startlayer'], 400
+                start_print(file_path, start_layer=start_layer)
 
     template_dictionary = templating_defaults()
-    files = [f for f in listdir(app.config['UPLOAD_FOLDER'])
-             if isfile(app.config['UPLOAD_FOLDER'] + "/" + f) and fnmatch.fnmatch(f, '*.gcode')]
-    #todo would like to http://stackoverflow.com/questions/6591931/getting-file-size-in-python
-    #http://stackoverflow.com/questions/1094841/reusable-library-to-get-human-readable-version-of-file-size
-    #http://stackoverflow.com/questions/237079/how-to-get-file-creation-modification-date-times-in-python
+    try:
+        page = int(request.args.get('page', 0))
+    except ValueError:
+        return "there is no page %s" % request.args['page'], 400
+    files, total = get_upload_directory().files(offset=page * _files_per_page, limit=_files_per_page)
+    # the files still being uploaded can be printed as well
+    listed = set(entry['name'] for entry in files)
+    files.extend({'name': upload.filename, 'size': upload.bytes_written, 'uploading': True}
+                 for upload in get_upload_manager().uploads.values() if upload.filename not in listed)
     template_dictionary['files'] = files
+    template_dictionary['page'] = page
+    template_dictionary['pages'] = (total + _files_per_page - 1) // _files_per_page
+    template_dictionary['jobs'] = get_job_queue().jobs()
     if _printer.prepared_file:
         template_dictionary['print_file'] = _printer.prepared_file.rsplit('/', 1)[1]
     return render_template("print.html", **template_dictionary)
 
 
+@app.route('/upload/<filename>', methods=['PUT'])
+def upload_file(filename):
+    # the whole request is the file - e.g. curl -T print.gcode http://t-bone/upload/print.gcode
+    filename = secure_filename(filename)
+    if not beaglebone_helpers.allowed_file(filename):
+        return "only g code can be uploaded", 400
+    upload_manager = get_upload_manager()
+    try:
+        upload = upload_manager.start(filename, expected_size=request.content_length)
+    except UploadError as e:
+        return str(e), 409
+    if request.args.get('print'):
+        # curl -T print.gcode http://t-bone/upload/print.gcode?print=yes starts printing while uploading
+        if not _printer:
+            upload_manager.abort(upload)
+            return "there is no printer", 400
+        start_print(upload.path)
+    try:
+        upload.copy_from(request.stream, request.content_length)
+        content_hash = upload_manager.finish(upload)
+    except:
+        upload_manager.abort(upload)
+        raise
+    return flask.jsonify({'file': filename, 'size': upload.bytes_written, 'sha1': content_hash})
+
+
+@app.route('/files')
+def list_files():
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', _files_per_page))
+        files, total = get_upload_directory().files(offset=offset, limit=limit,
+                                                    sort=request.args.get('sort', 'name'))
+    except ValueError as e:
+        return str(e), 400
+    return flask.jsonify({'files': files, 'total': total, 'offset': offset})
+
+
+@app.teardown_request
+def abort_unfinished_uploads(exception=None):
+    # if the request broke down during the upload we do not want to keep half a file
+    for upload in getattr(request, 'uploads', []):
+        if not upload.finished:
+            get_upload_manager().abort(upload)
+
+
+def start_print(file_path, start_layer=None):
+    # the scheduler prints it once the jobs before it are done
+    return get_job_queue().enqueue(file_path, start_layer=start_layer)
+
+
+@app.route('/jobs', methods=['GET', 'POST'])
+def jobs():
+    return _handle_jobs(get_job_queue())
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET', 'PUT', 'DELETE'])
+def job(job_id):
+    return _handle_job(get_job_queue(), _job_scheduler, job_id)
+
+
+@app.route('/printers')
+def printers():
+    if not _printer_farm:
+        return flask.jsonify({'printers': [], 'errors': {}})
+    return flask.jsonify({'printers': _printer_farm.status(), 'errors': _printer_farm.errors})
+
+
+@app.route('/printers/<name>/status')
+def printer_status(name):
+    try:
+        return flask.jsonify(_get_farm_printer(name).status())
+    except FarmError as e:
+        return str(e), 404
+
+
+@app.route('/printers/<name>/jobs', methods=['GET', 'POST'])
+def printer_jobs(name):
+    try:
+        farm_printer = _get_farm_printer(name)
+    except FarmError as e:
+        return str(e), 404
+    return _handle_jobs(farm_printer.job_queue)
+
+
+@app.route('/printers/<name>/jobs/<int:job_id>', methods=['GET', 'PUT', 'DELETE'])
+def printer_job(name, job_id):
+    try:
+        farm_printer = _get_farm_printer(name)
+    except FarmError as e:
+        return str(e), 404
+    return _handle_job(farm_printer.job_queue, farm_printer.job_scheduler, job_id)
+
+
+def _get_farm_printer(name):
+    if not _printer_farm:
+        raise FarmError("There is no printer farm")
+    return _printer_farm.printer(name)
+
+
+def _handle_jobs(job_queue):
+    if request.method == 'POST':
+        arguments = request.json or request.form
+        filename = secure_filename(arguments.get('file', ''))
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        if not beaglebone_helpers.allowed_file(filename) or not (
+                isfile(file_path) or file_path in get_upload_manager().uploads):
+            return "there is no file %s" % filename, 404
+        try:
+            start_layer = _read_start_layer(file_path, arguments.get('startlayer'))
+        except ValueError:
+            return "unable to start at layer %s" % arguments['startlayer'], 400
+        job = job_queue.enqueue(file_path, start_layer=start_layer)
+        return flask.jsonify(job), 201
+    return flask.jsonify({'jobs': job_queue.jobs()})
+
+
+def _read_start_layer(file_path, start_layer):
+    # the layer has to be in the index of the file - which does not exist before the upload is finished
+    if start_layer is None or start_layer == '':
+        return None
+    start_layer = int(start_layer)
+    index = _gcode_indexer.index(file_path)
+    if not index or start_layer < 0 or start_layer >= len(index.layers):
+        raise ValueError("There is no layer %s in %s" % (start_layer, file_path))
+    return start_layer
+
+
+def _handle_job(job_queue, job_scheduler, job_id):
+    try:
+        if request.method == 'PUT':
+            # reorder - position 0 is the next job
+            arguments = request.json or request.form
+            return flask.jsonify(job_queue.move(job_id, int(arguments['position'])))
+        if request.method == 'DELETE':
+            if job_scheduler:
+                return flask.jsonify(job_scheduler.cancel(job_id))
+            return flask.jsonify(job_queue.cancel(job_id))
+    except (JobError, KeyError, ValueError) as e:
+        return str(e), 400
+    job = job_queue.job(job_id)
+    if not job:
+        return "there is no job %s" % job_id, 404
+    return flask.jsonify(job)
+
+
+def get_job_queue():
+    global _job_queue
+    if not _job_queue:
+        _job_queue = JobQueue(app.config.get('JOB_FILE'))
+    return _job_queue
+
+
+def get_upload_directory():
+    global _upload_directory
+    if not _upload_directory:
+        _upload_directory = UploadDirectory(app.config['UPLOAD_FOLDER'])
+    return _upload_directory
+
+
+@app.template_filter('file_size')
+def format_file_size(size):
+    if size < 1024:
+        return "%d bytes" % size
+    for unit in ('KB', 'MB', 'GB'):
+        size /= 1024.0
+        if size < 1024 or unit == 'GB':
+            return "%.1f %s" % (size, unit)
+
+
+@app.template_filter('print_time')
+def format_print_time(seconds):
+    return format_duration(seconds)
+
+
+def get_upload_manager():
+    global _upload_manager
+    if not _upload_manager:
+        _upload_manager = UploadManager(app.config['UPLOAD_FOLDER'])
+    return _upload_manager
+
+
 @app.route('/control', methods=['GET', 'POST'])
 def control():
     if request.method == 'POST':
@@ -225,46 +469,134 @@ def status():
         base_status['bed-temperature'] = "%0.1f" % _printer.heated_bed.temperature
         base_status['bed-set-temperature'] = "%0.1f" % _printer.heated_bed.get_set_temperature()
 
+    print_thread = None
+    if _job_scheduler:
+        print_thread = _job_scheduler.print_thread
+        base_status['job'] = _job_scheduler.current_job
+        if not _job_scheduler.isAlive():
+            logging.warning("job scheduler stopped")
     if _printer.printing:
-        if not _print_thread.isAlive():
+        if print_thread and not print_thread.isAlive():
             logging.warning("Gcode thread stopped")
         if not _printer.isAlive():
             logging.warning("printer thread stopped")
 
-    global _print_thread
-    if _print_thread and _print_thread.printing:
-        base_status['lines_to_print'] = _print_thread.lines_to_print
-        base_status['lines_printed'] = _print_thread.lines_printed
-        base_status['lines_printed_percent'] = float(_print_thread.lines_printed) / float(
-            _print_thread.lines_to_print) * 100
+    if print_thread and print_thread.printing:
+        base_status['lines_to_print'] = print_thread.lines_to_print
+        base_status['lines_printed'] = print_thread.lines_printed
+        base_status['lines_printed_percent'] = print_thread.progress() * 100
     return flask.jsonify(
         base_status
     )
     pass
 
 
+@app.route('/trace')
+def trace():
+    if not _printer:
+        return "there is no printer", 400
+    return flask.jsonify(_printer.tracer.snapshot())
+
+
+@app.route('/trace/samples')
+def trace_samples():
+    if not _printer:
+        return "there is no printer", 400
+    return flask.jsonify({'samples': _printer.move_sampler.samples()})
+
+
+@app.route('/trace/<action>', methods=['POST'])
+def trace_action(action):
+    if not _printer:
+        return "there is no printer", 400
+    tracer = _printer.tracer
+    if 'start' == action:
+        tracer.enabled = True
+    elif 'stop' == action:
+        tracer.enabled = False
+    elif 'reset' == action:
+        tracer.reset()
+    elif 'dump' == action:
+        tracer.dump(T_BONE_TRACE_FILE)
+        return T_BONE_TRACE_FILE
+    else:
+        return "unknown trace action", 400
+    return "ok"
+
+
+@app.route('/analyze/<filename>')
+def analyze(filename):
+    if not _analysis_service:
+        return "there is no printer", 400
+    filename = secure_filename(filename)
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if not isfile(file_path) or not beaglebone_helpers.allowed_file(filename):
+        return "unknown file", 404
+    analysis = _analysis_service.analysis(file_path)
+    if analysis['status'] == 'running':
+        # come back later
+        return flask.jsonify(analysis), 202
+    return flask.jsonify(analysis)
+
+
 @app.route('/restart')
 def restart_printer():
-    if _printer:
-        _printer.stop()
+    stop_printers()
     create_printer()
     return redirect("/", 302)
 
 
 def create_printer():
-    global _printer, config
+    global _printer, config, _analysis_service, _job_queue, _job_scheduler, _printer_farm
+    config = json_config_file.read()
+    hardware.configure(config)
+    if _analysis_service:
+        _analysis_service.stop()
+    _analysis_service = AnalysisService(config)
+    if read_farm_config(config, shared_heaters=hardware.is_simulated()):
+        job_file_pattern = None
+        if app.config.get('JOB_FILE'):
+            job_file_pattern = os.path.splitext(app.config['JOB_FILE'])[0] + '_%s.json'
+        _printer_farm = PrinterFarm(config, job_file_pattern=job_file_pattern, indexer=_gcode_indexer,
+                                    upload_manager=get_upload_manager())
+        _printer_farm.start()
+        if not _printer_farm.printers:
+            raise FarmError("None of the printers started: %s" % _printer_farm.errors)
+        first_printer = _printer_farm.printers.values()[0]
+        _printer = first_printer.printer
+        _job_queue = first_printer.job_queue
+        _job_scheduler = first_printer.job_scheduler
+        return
+    if _printer_farm:
+        # the jobs of the farm stay with the farm
+        _job_queue = None
+        _printer_farm = None
     _printer = beaglebone_helpers.create_printer()
     _printer.prepared_file = None
 
-    config = json_config_file.read()
-    _printer.connect()
+    _printer.connect(serial_reactor=read_serial_reactor(config), serial_recorder=read_serial_recorder(config))
     _printer.configure(config)
+    _job_scheduler = JobScheduler(_printer, get_job_queue(), indexer=_gcode_indexer,
+                                  upload_manager=get_upload_manager())
+    _job_scheduler.start()
+
+
+def stop_printers():
+    if _printer_farm:
+        _printer_farm.stop()
+        return
+    if _job_scheduler:
+        _job_scheduler.stop()
+    if _printer:
+        _printer.stop()
 
 
 if __name__ == '__main__':
-    #configure the overall logging
-    logging.basicConfig(filename=T_BONE_LOG_FILE, level=logging.DEBUG,
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    #configure the overall logging - the printer threads only hand the records to the log writer thread
+    log_handler = AsyncRotatingFileHandler(T_BONE_LOG_FILE)
+    log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logging.getLogger().addHandler(log_handler)
+    logging.getLogger().setLevel(logging.DEBUG)
     #Comment following lines in order to enable logging (/var/log/t_bone.log)
     logging.disable(logging.DEBUG)
     logging.disable(logging.INFO)
@@ -274,20 +606,25 @@ if __name__ == '__main__':
     try:
         if not os.path.exists(UPLOAD_FOLDER):
             os.mkdir(UPLOAD_FOLDER)
-        if not _printer:
-            create_printer()
-        logging.info('configured, starting web interface')
         #this has to be configured somewhere (json??)
         app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
         app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+        app.config['JOB_FILE'] = JOB_FILE
+        if not _printer:
+            create_printer()
+        logging.info('configured, starting web interface')
         app.run(
             host='0.0.0.0',
 	    port=80,
             debug=True,
-            use_reloader=False
+            use_reloader=False,
+            # we have to be able to start the print while the upload is still running
+            threaded=True
         )
     except KeyboardInterrupt:
-        _printer.stop()
+        stop_printers()
+        if _analysis_service:
+            _analysis_service.stop()
         logging.warning('Printer stopped due to KeyboardInterrupt exception')
     finally:
         #reset the printer
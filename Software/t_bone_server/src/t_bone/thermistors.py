@@ -5,39 +5,47 @@ from t_bone import replicape_thermistors
 
 _logger = logging.getLogger(__name__)
 
+# maps the thermistor name to a function converting the adc reading (0 to 1) to degrees
+_converters = {}
+
+
+def register_thermistor(thermistor, converter):
+    if thermistor in _converters:
+        _logger.warn("Replacing converter for thermistor %s", thermistor)
+    _converters[thermistor] = converter
+
+
+def register_ramps_thermistor(thermistor, thermistor_table):
+    register_thermistor(thermistor, ramps_thermistors.get_lookup_table(thermistor_table, thermistor).convert)
+
+
+def register_replicape_thermistor(thermistor, temp_table):
+    register_thermistor(thermistor, replicape_thermistors.get_lookup_table(temp_table).convert_reading)
+
+
+def get_converter(thermistor):
+    if thermistor not in _converters:
+        raise Exception("Unknown Thermistor " + str(thermistor))
+    return _converters[thermistor]
 
 
 def get_thermistor_reading(thermistor, value):
-    #find the thermistor
-    thermistor_table = None
-    if thermistor == "100k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.bed_thermistor_100k, value)
-    elif thermistor == "200k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.bed_thermistor_200k, value)
-    elif thermistor == "mendel-parts":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.mendel_parts_thermistor, value)
-    elif thermistor == "10k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_10k, value)
-    elif thermistor == "parcan-100k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_parcan_100k, value)
-    elif thermistor == "epcos-100k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_epcos_100k, value)
-    elif thermistor == "epcos-B57560G104F":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_epcos_B57560G104F, value)
-    elif thermistor == "j-head":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.j_head_thermistor, value)
-    elif thermistor == "honeywell-100k":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_honeywell_100k, value)
-    elif thermistor == "honeywell-135_104_LAF_J01":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_honeywell_135_104_LAF_J01, value)
-    elif thermistor == "vishay-NTCS0603E3104FXT":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_vishay_NTCS0603E3104FXT, value)
-    elif thermistor == "ge-sensing":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_ge_sensing, value)
-    elif thermistor == "rs-198961":
-        return ramps_thermistors.convert_ramps_reading(thermistor, ramps_thermistors.thermistor_rs_198961, value)
-    elif thermistor == "B57560G104F":
-        return replicape_thermistors.convert_reading(replicape_thermistors.temp_table["B57560G104F"], value)
-    if not thermistor:
-        raise Exception("Unknown Thermistor" + thermistor)
+    return get_converter(thermistor)(value)
+
 
+register_ramps_thermistor("100k", ramps_thermistors.bed_thermistor_100k)
+register_ramps_thermistor("200k", ramps_thermistors.bed_thermistor_200k)
+register_ramps_thermistor("mendel-parts", ramps_thermistors.mendel_parts_thermistor)
+register_ramps_thermistor("10k", ramps_thermistors.thermistor_10k)
+register_ramps_thermistor("parcan-100k", ramps_thermistors.thermistor_parcan_100k)
+register_ramps_thermistor("epcos-100k", ramps_thermistors.thermistor_epcos_100k)
+register_ramps_thermistor("epcos-B57560G104F", ramps_thermistors.thermistor_epcos_B57560G104F)
+register_ramps_thermistor("j-head", ramps_thermistors.j_head_thermistor)
+register_ramps_thermistor("honeywell-100k", ramps_thermistors.thermistor_honeywell_100k)
+register_ramps_thermistor("honeywell-135_104_LAF_J01", ramps_thermistors.thermistor_honeywell_135_104_LAF_J01)
+register_ramps_thermistor("vishay-NTCS0603E3104FXT", ramps_thermistors.thermistor_vishay_NTCS0603E3104FXT)
+register_ramps_thermistor("ge-sensing", ramps_thermistors.thermistor_ge_sensing)
+register_ramps_thermistor("rs-198961", ramps_thermistors.thermistor_rs_198961)
+for _thermistor, _temp_table in replicape_thermistors.temp_table.iteritems():
+    register_replicape_thermistor(_thermistor, _temp_table)
+del _thermistor, _temp_table
@@ -0,0 +1,245 @@
+# coding=utf-8
+"""
+Follows moves from the G-code line to the acknowledgement of the T-Bone.
+
+A traced move carries a Trace, which gets a monotonic timestamp at every stage boundary: the line was received,
+decoded, planned, pushed to the execution queue, taken from it, written to the serial port and acknowledged. When the
+move is done the Tracer adds the time spent in each stage to a latency histogram and keeps the raw timestamps of the
+last moves in a fixed ring buffer. A MoveSampler keeps the details of every n-th move.
+
+Tracing is off by default - then starting a trace just returns None and nothing gets stamped.
+"""
+from collections import deque
+import ctypes
+import ctypes.util
+import json
+import logging
+import threading
+import time
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+# the stage boundaries of a move
+RECEIVED = 0
+DECODED = 1
+PLANNED = 2
+QUEUED = 3
+DEQUEUED = 4
+WRITTEN = 5
+ACKNOWLEDGED = 6
+BOUNDARY_NAMES = ('received', 'decoded', 'planned', 'queued', 'dequeued', 'written', 'acknowledged')
+
+# the stages are the time between two boundaries
+STAGES = (
+    ('decode', RECEIVED, DECODED),
+    ('plan', DECODED, PLANNED),
+    ('planning-window', PLANNED, QUEUED),
+    ('execution-queue', QUEUED, DEQUEUED),
+    ('serial-write', DEQUEUED, WRITTEN),
+    ('acknowledge', WRITTEN, ACKNOWLEDGED),
+    ('total', RECEIVED, ACKNOWLEDGED)
+)
+
+_default_ring_size = 1024
+_default_sampling_interval = 100
+_default_sample_ring_size = 256
+_default_precision_bits = 5  # 32 linear sub buckets per power of two - about 3% resolution
+_default_highest_latency = 60.0  # seconds
+_clock_monotonic = 1  # from linux/time.h
+
+
+def _create_monotonic_clock():
+    # python 2 has no time.monotonic - so we ask the C library directly
+    class _Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        library = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = library.clock_gettime
+    except (OSError, AttributeError):
+        _logger.warn("No monotonic clock available, tracing with the wall clock")
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        # clock_gettime is thread safe - a timespec per call saves a lock on every stamp
+        timespec = _Timespec()
+        clock_gettime(_clock_monotonic, ctypes.byref(timespec))
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+    return monotonic
+
+
+monotonic = _create_monotonic_clock()
+
+
+class Trace(object):
+    __slots__ = ('timestamps',)
+
+    def __init__(self):
+        self.timestamps = [None] * len(BOUNDARY_NAMES)
+
+    def stamp(self, boundary):
+        self.timestamps[boundary] = monotonic()
+
+
+class LatencyHistogram(object):
+    """
+    A HDR style histogram of latencies in microseconds.
+
+    Values below 2^precision_bits microseconds get a bucket of their own, above every power of two is split in
+    2^(precision_bits-1) linear buckets. So the relative error stays the same from microseconds up to a minute in a
+    few hundred fixed buckets.
+    """
+
+    def __init__(self, highest_latency=_default_highest_latency, precision_bits=_default_precision_bits):
+        self._precision_bits = precision_bits
+        self._sub_buckets = 1 << precision_bits
+        self._half_sub_buckets = self._sub_buckets >> 1
+        self._highest_value = int(highest_latency * 1000000)
+        self.counts = [0] * (self._index(self._highest_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, latency):
+        value = int(round(latency * 1000000))
+        if value < 0:
+            value = 0
+        elif value > self._highest_value:
+            value = self._highest_value
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        if not self.count:
+            return None
+        wanted = self.count * percentile / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return min(self._highest_equivalent_value(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        result = {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': float(self.total) / self.count if self.count else None
+        }
+        for percentile in (50, 90, 99, 99.9):
+            result['p%s' % percentile] = self.percentile(percentile)
+        # for offline analysis - the lowest value of each used bucket and its count
+        result['buckets'] = [[self._lowest_equivalent_value(index), count]
+                             for index, count in enumerate(self.counts) if count]
+        return result
+
+    def _index(self, value):
+        if value < self._sub_buckets:
+            return value
+        shift = value.bit_length() - self._precision_bits
+        return self._sub_buckets + (shift - 1) * self._half_sub_buckets + (value >> shift) - self._half_sub_buckets
+
+    def _lowest_equivalent_value(self, index):
+        if index < self._sub_buckets:
+            return index
+        shift, sub_bucket = divmod(index - self._sub_buckets, self._half_sub_buckets)
+        return (sub_bucket + self._half_sub_buckets) << (shift + 1)
+
+    def _highest_equivalent_value(self, index):
+        return self._lowest_equivalent_value(index + 1) - 1
+
+
+class Tracer(object):
+    def __init__(self, ring_size=_default_ring_size, enabled=False):
+        self.enabled = enabled
+        self.ring_size = ring_size
+        self._lock = threading.Lock()
+        self.reset()
+
+    def start(self):
+        if not self.enabled:
+            return None
+        trace = Trace()
+        trace.stamp(RECEIVED)
+        return trace
+
+    def record(self, trace):
+        # called by the printer thread once the move is acknowledged
+        timestamps = trace.timestamps
+        with self._lock:
+            for histogram, (name, start, end) in zip(self._histograms, STAGES):
+                if timestamps[start] is not None and timestamps[end] is not None:
+                    histogram.record(timestamps[end] - timestamps[start])
+            self._ring[self._ring_position] = timestamps
+            self._ring_position = (self._ring_position + 1) % self.ring_size
+            self.traces_recorded += 1
+
+    def reset(self):
+        with self._lock:
+            self._histograms = [LatencyHistogram() for stage in STAGES]
+            self._ring = [None] * self.ring_size
+            self._ring_position = 0
+            self.traces_recorded = 0
+
+    def snapshot(self, include_traces=False):
+        with self._lock:
+            result = {
+                'enabled': self.enabled,
+                'unit': 'microseconds',
+                'traces_recorded': self.traces_recorded,
+                'stages': dict((name, histogram.to_dict())
+                               for histogram, (name, start, end) in zip(self._histograms, STAGES))
+            }
+            if include_traces:
+                # oldest first
+                ring = self._ring[self._ring_position:] + self._ring[:self._ring_position]
+                result['boundaries'] = BOUNDARY_NAMES
+                result['traces'] = [timestamps for timestamps in ring if timestamps]
+        return result
+
+    def dump(self, filename):
+        snapshot = self.snapshot(include_traces=True)
+        with open(filename, 'w') as dump_file:
+            json.dump(snapshot, dump_file, indent=1)
+        _logger.info("Dumped %s traces to %s", snapshot['traces_recorded'], filename)
+
+
+class MoveSampler(object):
+    """
+    Keeps one move in every n in a ring buffer - so there is always something to look at without logging every move.
+    """
+
+    def __init__(self, interval=_default_sampling_interval, ring_size=_default_sample_ring_size):
+        # an interval of 0 switches sampling off
+        self.interval = interval
+        self._count = 0
+        self._samples = deque(maxlen=ring_size)
+
+    def sample(self):
+        # is the next move one to record?
+        if not self.interval:
+            return False
+        self._count += 1
+        if self._count < self.interval:
+            return False
+        self._count = 0
+        return True
+
+    def record(self, sample):
+        self._samples.append(sample)
+
+    def samples(self):
+        # oldest first
+        return list(self._samples)
+
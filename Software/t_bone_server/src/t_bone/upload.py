@@ -0,0 +1,247 @@
+# coding=utf-8
+"""
+Uploads which go straight to the upload folder.
+
+An Upload is written to a .part file next to its final place in chunks of fixed size. While the data comes in it gets
+hashed and indexed, so once the last chunk is written the file just needs to be renamed and the index written - no
+temporary file, no copy, no second pass over the data. If the same content was uploaded before the new name becomes a
+hard link to the old file.
+
+An UploadReader follows an upload while it is still written - so a print can start before the upload is finished. It
+never reads further than what has been written to the file and knows when the upload ended or broke off.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+from gcode_index import GCodeIndexBuilder, read_index, write_index, INDEX_SUFFIX
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+PARTIAL_SUFFIX = '.part'
+_default_chunk_size = 64 * 1024
+# how long a reader waits for new data before it looks again
+_reader_wait_time = 1.0
+
+
+class Upload(object):
+    """
+    A file being uploaded. It behaves like a writable file - so werkzeug can stream the request into it.
+    """
+
+    def __init__(self, directory, filename, chunk_size=_default_chunk_size, expected_size=None):
+        self.filename = filename
+        self.path = os.path.join(directory, filename)
+        self.partial_path = self.path + PARTIAL_SUFFIX
+        self.chunk_size = chunk_size
+        # if the client told us
+        self.expected_size = expected_size
+        self.hash = hashlib.sha1()
+        self.index_builder = GCodeIndexBuilder()
+        # how much really is in the file - readers never read further
+        self.bytes_written = 0
+        self.finished = False
+        self.aborted = False
+        self._data_written = threading.Condition()
+        self._buffer = []
+        self._buffered = 0
+        self._file = open(self.partial_path, 'w+b')
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffered:
+            return
+        chunk = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._file.write(chunk)
+        self._file.flush()
+        self.hash.update(chunk)
+        self.index_builder.feed(chunk)
+        with self._data_written:
+            self.bytes_written += len(chunk)
+            self._data_written.notify_all()
+
+    def wait_for_data(self, offset):
+        """
+        Waits until there is more than offset bytes in the file or the upload ended.
+        Returns the bytes in the file and if the upload is finished.
+        """
+        with self._data_written:
+            while self.bytes_written <= offset and not self.finished and not self.aborted:
+                self._data_written.wait(_reader_wait_time)
+            if self.aborted:
+                raise UploadError("The upload of %s broke off" % self.filename)
+            return self.bytes_written, self.finished
+
+    def end(self, aborted=False):
+        # tells the readers that there is nothing more to come
+        with self._data_written:
+            if aborted:
+                self.aborted = True
+            else:
+                self.finished = True
+            self._data_written.notify_all()
+
+    # werkzeug wants to read the upload as well
+    def seek(self, offset, whence=0):
+        self.flush()
+        self._file.seek(offset, whence)
+
+    def tell(self):
+        self.flush()
+        return self._file.tell()
+
+    def read(self, size=-1):
+        self.flush()
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        self.flush()
+        return self._file.readline(size)
+
+    def sync(self):
+        # everything on the disk
+        self.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def copy_from(self, stream, length=None):
+        # reads the whole stream in chunks
+        remaining = length
+        while remaining is None or remaining > 0:
+            if remaining is None:
+                data = stream.read(self.chunk_size)
+            else:
+                data = stream.read(min(self.chunk_size, remaining))
+                remaining -= len(data)
+            if not data:
+                break
+            self.write(data)
+
+
+class UploadManager(object):
+    def __init__(self, directory, chunk_size=_default_chunk_size):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.uploads = {}
+        self._lock = threading.Lock()
+        # content hash to file - read from the indexes when we need them first
+        self._hashes = None
+
+    def start(self, filename, expected_size=None):
+        with self._lock:
+            # two uploads would write to the same .part file
+            if os.path.join(self.directory, filename) in self.uploads:
+                raise UploadError("%s is already being uploaded" % filename)
+            upload = Upload(self.directory, filename, chunk_size=self.chunk_size, expected_size=expected_size)
+            self.uploads[upload.path] = upload
+        _logger.info("Receiving %s", upload.path)
+        return upload
+
+    def finish(self, upload):
+        """
+        Makes the upload a proper file in the upload folder and returns its content hash.
+        """
+        upload.sync()
+        upload.close()
+        content_hash = upload.hash.hexdigest()
+        with self._lock:
+            self._load_hashes()
+            duplicate = self._hashes.get(content_hash)
+            if duplicate and not duplicate == upload.path and self._has_content(duplicate, content_hash):
+                # we got that already - so we just give it another name
+                _logger.info("%s is the same as %s", upload.path, duplicate)
+                os.remove(upload.partial_path)
+                if os.path.exists(upload.path):
+                    os.remove(upload.path)
+                os.link(duplicate, upload.path)
+            else:
+                os.rename(upload.partial_path, upload.path)
+                self._hashes[content_hash] = upload.path
+            index_dict = upload.index_builder.finish()
+            index_dict['sha1'] = content_hash
+            write_index(upload.path, index_dict)
+            upload.end()
+            del self.uploads[upload.path]
+        _logger.info("Received %s with %s bytes", upload.path, upload.bytes_written)
+        return content_hash
+
+    def abort(self, upload):
+        _logger.warn("Upload of %s failed", upload.path)
+        upload.end(aborted=True)
+        upload.close()
+        with self._lock:
+            if os.path.exists(upload.partial_path):
+                os.remove(upload.partial_path)
+            self.uploads.pop(upload.path, None)
+
+    def _has_content(self, path, content_hash):
+        if not os.path.exists(path):
+            return False
+        index = read_index(path)
+        return index is not None and index.sha1 == content_hash
+
+    def _load_hashes(self):
+        if self._hashes is not None:
+            return
+        self._hashes = {}
+        for index_file_name in os.listdir(self.directory):
+            if index_file_name.endswith(INDEX_SUFFIX):
+                path = os.path.join(self.directory, index_file_name[:-len(INDEX_SUFFIX)])
+                if os.path.exists(path):
+                    index = read_index(path)
+                    if index and index.sha1:
+                        self._hashes[index.sha1] = path
+
+
+class UploadReader(object):
+    """
+    Iterates over the lines of an upload - waiting for them if they are not there yet.
+    """
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.offset = 0
+        try:
+            self._file = open(upload.partial_path, 'rb')
+        except IOError:
+            # it is already finished and renamed
+            self._file = open(upload.path, 'rb')
+
+    def __iter__(self):
+        remainder = ''
+        while True:
+            bytes_written, finished = self.upload.wait_for_data(self.offset)
+            if bytes_written > self.offset:
+                data = self._file.read(bytes_written - self.offset)
+                self.offset += len(data)
+                lines = (remainder + data).split('\n')
+                remainder = lines.pop()
+                for line in lines:
+                    yield line + '\n'
+            elif finished:
+                if remainder:
+                    yield remainder
+                return
+
+    def close(self):
+        self._file.close()
+
+
+class UploadError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
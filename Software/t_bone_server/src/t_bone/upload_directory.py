@@ -0,0 +1,166 @@
+# coding=utf-8
+"""
+A listing of the upload folder which does not look at every file for every request.
+
+The listing is kept in memory and in a small index file. It only gets rebuilt if the mtime of the folder changed - and
+then only the files which changed get read again. Next to size and mtime it knows the content hash and number of lines
+from the g code index and the print time from the analysis - if they are there already.
+"""
+import fnmatch
+import json
+import logging
+import os
+import stat
+import threading
+
+from gcode_index import INDEX_SUFFIX, read_index
+from print_analyzer import ANALYSIS_SUFFIX
+
+__author__ = 'marcus'
+
+_logger = logging.getLogger(__name__)
+
+# the index lives in its own folder - writing it must not change the mtime of the upload folder
+LISTING_FOLDER = '.listing'
+_listing_file_name = 'listing.json'
+_listing_version = 1
+_default_pattern = '*.gcode'
+
+
+class UploadDirectory(object):
+    def __init__(self, directory, pattern=_default_pattern):
+        self.directory = directory
+        self.pattern = pattern
+        self._listing_path = os.path.join(directory, LISTING_FOLDER, _listing_file_name)
+        self._lock = threading.Lock()
+        # the mtime of the folder the listing is for
+        self._mtime = None
+        self._entries = {}
+        self._sorted_entries = {}
+        self._load()
+
+    def files(self, offset=0, limit=None, sort='name'):
+        """
+        Returns a page of the files and how many files there are.
+        sort: 'name' or 'mtime' - the newest first
+        """
+        if sort not in ('name', 'mtime'):
+            raise ValueError("Cannot sort by %s" % sort)
+        with self._lock:
+            self._refresh()
+            entries = self._sorted(sort)
+        if limit is None:
+            page = entries[offset:]
+        else:
+            page = entries[offset:offset + limit]
+        return [dict(entry) for entry in page], len(entries)
+
+    def invalidate(self, path=None):
+        # for changes the folder does not notice - like overwriting a file
+        with self._lock:
+            self._mtime = None
+            if path:
+                self._entries.pop(os.path.basename(path), None)
+
+    def _refresh(self):
+        mtime = os.stat(self.directory).st_mtime
+        if mtime == self._mtime:
+            return
+        names = set(os.listdir(self.directory))
+        entries = {}
+        for name in names:
+            if not fnmatch.fnmatch(name, self.pattern):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                # it is gone already
+                continue
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+            entry = self._entries.get(name)
+            if entry and entry['size'] == file_stat.st_size and entry['mtime'] == file_stat.st_mtime:
+                entry = dict(entry)
+            else:
+                entry = {
+                    'name': name,
+                    'size': file_stat.st_size,
+                    'mtime': file_stat.st_mtime,
+                    'sha1': None,
+                    'lines': None,
+                    'print_time': None
+                }
+            # the index and the analysis come later - we take them once they are there
+            if entry['lines'] is None and name + INDEX_SUFFIX in names:
+                index = read_index(path)
+                if index:
+                    entry['sha1'] = index.sha1
+                    entry['lines'] = index.line_count
+            if entry['print_time'] is None and name + ANALYSIS_SUFFIX in names:
+                entry['print_time'] = _read_print_time(path, file_stat)
+            entries[name] = entry
+        changed = not entries == self._entries
+        self._entries = entries
+        self._sorted_entries = {}
+        self._mtime = mtime
+        if changed:
+            self._save()
+
+    def _sorted(self, sort):
+        if sort not in self._sorted_entries:
+            if sort == 'mtime':
+                entries = sorted(self._entries.values(), key=lambda entry: entry['mtime'], reverse=True)
+            else:
+                entries = sorted(self._entries.values(), key=lambda entry: entry['name'])
+            self._sorted_entries[sort] = entries
+        return self._sorted_entries[sort]
+
+    def _load(self):
+        listing_folder = os.path.dirname(self._listing_path)
+        if not os.path.exists(listing_folder):
+            # before anything is listed - creating it changes the mtime of the upload folder
+            try:
+                os.mkdir(listing_folder)
+            except OSError as e:
+                _logger.warn("Unable to create %s: %s", listing_folder, e)
+            return
+        if not os.path.exists(self._listing_path):
+            return
+        try:
+            with open(self._listing_path) as listing_file:
+                listing = json.load(listing_file)
+        except (IOError, ValueError) as e:
+            _logger.warn("Unable to read listing %s: %s", self._listing_path, e)
+            return
+        if not listing.get('version') == _listing_version:
+            return
+        self._entries = listing['files']
+        self._mtime = listing['mtime']
+
+    def _save(self):
+        listing = {
+            'version': _listing_version,
+            'mtime': self._mtime,
+            'files': self._entries
+        }
+        try:
+            temporary_file_name = self._listing_path + '.tmp'
+            with open(temporary_file_name, 'w') as listing_file:
+                json.dump(listing, listing_file)
+            os.rename(temporary_file_name, self._listing_path)
+        except (IOError, OSError) as e:
+            _logger.warn("Unable to write listing %s: %s", self._listing_path, e)
+
+
+def _read_print_time(path, file_stat):
+    try:
+        with open(path + ANALYSIS_SUFFIX) as analysis_file:
+            result = json.load(analysis_file)
+    except (IOError, ValueError):
+        return None
+    # the analysis has to be for this very file
+    signature = result.get('signature') or []
+    if not result.get('status') == 'done' or not signature[:2] == [file_stat.st_size, file_stat.st_mtime]:
+        return None
+    return result.get('duration')
@@ -2,10 +2,50 @@
 __author__ = 'marcus'
 import unittest
 import gcode_tests
+import thermistor_tests
+import heater_tests
+import firmware_simulator_tests
+import hardware_tests
+import benchmark_tests
+import printer_tests
+import tracing_tests
+import log_handler_tests
+import helpers_tests
+import segment_coalescer_tests
+import arcs_tests
+import print_analyzer_tests
+import gcode_index_tests
+import upload_tests
+import upload_directory_tests
+import job_queue_tests
+import printer_farm_tests
+import planner_process_tests
+import serial_reactor_tests
+import serial_recorder_tests
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(gcode_tests.suite())
+    suite.addTest(thermistor_tests.suite())
+    suite.addTest(heater_tests.suite())
+    suite.addTest(firmware_simulator_tests.suite())
+    suite.addTest(hardware_tests.suite())
+    suite.addTest(benchmark_tests.suite())
+    suite.addTest(printer_tests.suite())
+    suite.addTest(tracing_tests.suite())
+    suite.addTest(log_handler_tests.suite())
+    suite.addTest(helpers_tests.suite())
+    suite.addTest(segment_coalescer_tests.suite())
+    suite.addTest(arcs_tests.suite())
+    suite.addTest(print_analyzer_tests.suite())
+    suite.addTest(gcode_index_tests.suite())
+    suite.addTest(upload_tests.suite())
+    suite.addTest(upload_directory_tests.suite())
+    suite.addTest(job_queue_tests.suite())
+    suite.addTest(printer_farm_tests.suite())
+    suite.addTest(planner_process_tests.suite())
+    suite.addTest(serial_reactor_tests.suite())
+    suite.addTest(serial_recorder_tests.suite())
     return suite
 
 if __name__ == '__main__':
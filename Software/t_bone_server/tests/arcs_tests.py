@@ -0,0 +1,96 @@
+from math import sqrt
+from t_bone.arcs import linearize_arc, segment_length_for, ArcError
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+_start = {'x': 10.0, 'y': 0.0, 'z': 0.2, 'e': 1.0}
+
+
+def _radius(move, center_x=0.0, center_y=0.0):
+    return sqrt((move['x'] - center_x) ** 2 + (move['y'] - center_y) ** 2)
+
+
+class ArcTest(unittest.TestCase):
+
+    def testQuarterCircle(self):
+        # counter clockwise around the origin from (10,0) to (0,10)
+        moves = linearize_arc(_start, {'x': 0.0, 'y': 10.0, 'i': -10.0, 'j': 0.0, 'e': 2.0, 'target_speed': 20.0},
+                              clockwise=False, chordal_tolerance=0.01, moves_per_second=None)
+        assert_that(len(moves), greater_than(10))
+        for move in moves:
+            assert_that(move['type'], equal_to('move'))
+            assert_that(_radius(move), close_to(10.0, 0.0001))
+            assert_that(move['x'], greater_than_or_equal_to(-0.0001))
+            assert_that(move['y'], greater_than(0))
+            assert_that(move['z'], equal_to(0.2))
+            assert_that(move['target_speed'], equal_to(20.0))
+        assert_that(moves[-1]['x'], equal_to(0.0))
+        assert_that(moves[-1]['y'], equal_to(10.0))
+        assert_that(moves[-1]['e'], equal_to(2.0))
+        # the extrusion follows the angle
+        assert_that(moves[len(moves) // 2 - 1]['e'], close_to(1.5, 0.1))
+
+    def testClockwiseAndFullCircles(self):
+        # clockwise the same end point is three quarters away
+        moves = linearize_arc(_start, {'x': 0.0, 'y': 10.0, 'i': -10.0}, clockwise=True, moves_per_second=None)
+        assert_that(min(move['y'] for move in moves), close_to(-10.0, 0.1))
+        circle = linearize_arc(_start, {'i': -10.0}, clockwise=False, moves_per_second=None)
+        assert_that(len(circle), greater_than(len(moves)))
+        assert_that(min(move['x'] for move in circle), close_to(-10.0, 0.1))
+
+    def testRadius(self):
+        start = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'e': 0.0}
+        radius = 5 * sqrt(2)
+        moves = linearize_arc(start, {'x': 10.0, 'y': 0.0, 'r': radius}, clockwise=True, moves_per_second=None)
+        for move in moves:
+            assert_that(_radius(move, 5.0, -5.0), close_to(radius, 0.0001))
+        # a negative radius takes the long way round
+        moves = linearize_arc(start, {'x': 10.0, 'y': 0.0, 'r': -radius}, clockwise=True, moves_per_second=None)
+        for move in moves:
+            assert_that(_radius(move, 5.0, 5.0), close_to(radius, 0.0001))
+        assert_that(calling(linearize_arc).with_args(start, {'x': 10.0, 'y': 0.0, 'r': 1.0}, True),
+                    raises(ArcError))
+        assert_that(calling(linearize_arc).with_args(start, {'x': 10.0}, True), raises(ArcError))
+
+    def testSmallArcsAtPrintSpeed(self):
+        # the serial line cannot take a move every 0.4 mm at 100 mm/s - but the circle must still be a circle
+        start = {'x': 0.5, 'y': 0.0, 'z': 0.2, 'e': 0.0}
+        for radius in (0.5, 1.0):
+            start['x'] = radius
+            circle = linearize_arc(start, {'i': -radius, 'e': 1.0, 'target_speed': 100.0}, clockwise=False,
+                                   feed_rate=100.0)
+            assert_that(len(circle), greater_than_or_equal_to(8))
+            for move in circle:
+                assert_that(_radius(move), close_to(radius, 0.0001))
+            assert_that(max(move['x'] for move in circle), close_to(radius, 0.0001))
+            assert_that(min(move['x'] for move in circle), close_to(-radius, 0.0001))
+            # and slower - so no more than 30 moves per second
+            chord = sqrt((circle[1]['x'] - circle[0]['x']) ** 2 + (circle[1]['y'] - circle[0]['y']) ** 2)
+            assert_that(circle[0]['target_speed'], less_than(100.0))
+            assert_that(chord / circle[0]['target_speed'], close_to(1 / 30.0, 0.0001))
+        # big arcs keep their speed
+        moves = linearize_arc(_start, {'x': 0.0, 'y': 10.0, 'i': -10.0, 'target_speed': 20.0}, clockwise=False,
+                              feed_rate=20.0)
+        assert_that(moves[0]['target_speed'], equal_to(20.0))
+
+    def testSegmentLength(self):
+        # the chord which stays within the tolerance
+        assert_that(segment_length_for(10.0, None, chordal_tolerance=0.01), close_to(0.894, 0.001))
+        # longer for bigger arcs
+        assert_that(segment_length_for(100.0, None, chordal_tolerance=0.01), greater_than(2.8))
+        # but the serial line must keep up
+        assert_that(segment_length_for(10.0, 60.0, chordal_tolerance=0.01, moves_per_second=30.0), equal_to(2.0))
+        assert_that(segment_length_for(0.01, None, min_segment_length=0.1), equal_to(0.1))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(ArcTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
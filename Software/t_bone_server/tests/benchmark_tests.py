@@ -0,0 +1,49 @@
+from t_bone import benchmark
+from t_bone.gcode_interpreter import decode_gcode_line
+from t_bone.machine import MachineCommand, encode_command
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def testCorporaAreGCode(self):
+        for name, corpus in benchmark.CORPORA.iteritems():
+            lines = corpus(100)
+            assert_that(len(lines), greater_than(90), name)
+            for line in lines:
+                assert_that(decode_gcode_line(line), not_none(), line)
+
+    def testCommandEncoding(self):
+        command = MachineCommand()
+        command.command_number = 10
+        command.arguments = [1, 200, 1.5, 12345678.0]
+        assert_that(encode_command(command), equal_to("10,1,200,1.5,12345678.0;\n"))
+        command.arguments = None
+        assert_that(encode_command(command), equal_to("10;\n"))
+
+    def testFakeMachineBenchmark(self):
+        results = benchmark.run_benchmarks(corpora=['straight-infill', 'z-hops'], moves=60)
+        assert_that(results, has_length(2))
+        for result in results:
+            assert_that(result['moves'], greater_than(50))
+            assert_that(result['moves_per_second'], greater_than(0))
+            assert_that(result['serial_bytes_per_move'], greater_than(20))
+
+    def testEveryCorpusIsExecutedCompletely(self):
+        # the moves of a corpus must not be counted for the next one
+        results = benchmark.run_benchmarks(corpora=['straight-infill'] * 3, moves=60)
+        assert_that(set(result['moves'] for result in results), has_length(1))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(BenchmarkTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,74 @@
+import os
+import time
+from t_bone.firmware_simulator import FirmwareSimulator, trapezoid_duration
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class FirmwareSimulatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = FirmwareSimulator(baud_rate=None, speedup=1000.0)
+        self.serial = os.open(self.simulator.serial_port, os.O_RDWR | os.O_NOCTTY)
+        # the simulator starts with an acknowledgement like a freshly reset arduino
+        assert_that(self._read_reply(), equal_to("0,0"))
+
+    def tearDown(self):
+        os.close(self.serial)
+        self.simulator.stop()
+
+    def _send(self, line):
+        os.write(self.serial, line + ";\n")
+        reply = self._read_reply()
+        while reply.startswith("-128"):
+            reply = self._read_reply()
+        return reply
+
+    def _read_reply(self):
+        buff = ""
+        while not buff.endswith(";"):
+            buff += os.read(self.serial, 1)
+        return buff[:-1].strip()
+
+    def testTrapezoidDuration(self):
+        # accelerate 1s, 1s at full speed, decelerate 1s
+        assert_that(trapezoid_duration(20.0, 0.0, 10.0, 0.0, 10.0), close_to(3.0, 0.0001))
+        # never reaching full speed
+        assert_that(trapezoid_duration(10.0, 0.0, 100.0, 0.0, 10.0), close_to(2.0, 0.0001))
+        # constant speed
+        assert_that(trapezoid_duration(10.0, 10.0, 10.0, 10.0, 10.0), close_to(1.0, 0.0001))
+        assert_that(trapezoid_duration(0, 0.0, 10.0, 0.0, 10.0), equal_to(0.0))
+
+    def testConfiguration(self):
+        assert_that(self._send("9"), equal_to("0,0"))
+        assert_that(self._send("1,1,500"), equal_to("0,0"))
+        assert_that(self._send("1,7,500"), equal_to("-9,-1"))
+        assert_that(self._send("77"), equal_to("-9,U,77"))
+
+    def testMoveQueue(self):
+        assert_that(self._send("11,1,20"), equal_to("0,0"))
+        reply = self._send("10,1,1000,119,1000,1000,0,0,2,500,119,500,500,0,0")
+        assert_that(reply, equal_to("0,2,40,1"))
+        assert_that(self._send("31"), equal_to("31,2,40"))
+        assert_that(self._send("11,-1"), equal_to("0,0"))
+        # 1000 steps at 1000 steps/s with 1000 steps/s^2 take 2s, which are 2ms with a speedup of 1000
+        time.sleep(0.1)
+        assert_that(self.simulator.in_motion(), equal_to(False))
+        assert_that(self._send("31"), equal_to("31,0,40"))
+        assert_that(self._send("30,1"), equal_to("30,1000"))
+        assert_that(self._send("30,2"), equal_to("30,500"))
+
+    def testQueueOverflow(self):
+        assert_that(self._send("11,1,100"), equal_to("0,0"))
+        for i in range(40):
+            self._send("10,1,%s,119,1000,1000,0,0" % ((i + 1) * 1000))
+        assert_that(self._send("10,1,100000,119,1000,1000,0,0"), equal_to("-9,-100"))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(FirmwareSimulatorTest))
+    return suite
@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import time
+from t_bone.gcode_index import GCodeIndexBuilder, GCodeIndex, GCodeIndexer, build_index, write_index, read_index
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+_two_layers = [
+    "; a comment G1 Z10 E100",
+    "G21",
+    "G92 E0",
+    "G1 Z0.200 F600",
+    "G1 X10 Y0 E1 F1200 ; Z5",
+    "G1 X10 Y10 E2",
+    "G1 Z0.600 F600",
+    "G1 X-5 Y0 F6000",
+    "G1 Z0.400 F600",
+    "G1 X20 Y0 E3 F1200",
+    "G92 E0",
+    "G1 X20 Y15 E1",
+    "M107",
+    "M104 S0",
+    "M190 S60",
+    "M109 S210 ; wait for it",
+]
+
+
+class GCodeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testLayersExtrusionAndBoundingBox(self):
+        builder = GCodeIndexBuilder(line_interval=4)
+        text = "\n".join(_two_layers)
+        # the chunks do not care about line breaks
+        for start in range(0, len(text), 7):
+            builder.feed(text[start:start + 7])
+        index = GCodeIndex(builder.finish())
+        assert_that(index.line_count, equal_to(len(_two_layers)))
+        assert_that(index.size, equal_to(len(text)))
+        assert_that(index.extrusion, close_to(4.0, 0.0001))
+        assert_that([layer['z'] for layer in index.layers], contains(0.2, 0.4))
+        assert_that(index.layer(1)['line'], equal_to(8))
+        assert_that(text[index.layer(1)['offset']:].startswith("G1 Z0.400"), equal_to(True))
+        # where the extruder was and how fast it went before the layer
+        assert_that(index.layer(0)['e'], equal_to(0.0))
+        assert_that(index.layer(0)['feed_rate'], none())
+        assert_that(index.layer(1)['e'], equal_to(2.0))
+        assert_that(index.layer(1)['feed_rate'], equal_to(6000.0))
+        # the travel to x -5 is not in the print
+        assert_that(index.bounding_box['min'], contains(10.0, 0.0, 0.2))
+        assert_that(index.bounding_box['max'], contains(20.0, 15.0, 0.4))
+        # switching the heater off is no temperature to heat up to
+        assert_that(index.temperatures, equal_to({'extruder': 210.0, 'bed': 60.0}))
+
+    def testLineOffsets(self):
+        lines = ["G1 X%s Y%s E%s" % (i, i, i) for i in range(2500)]
+        filename = os.path.join(self.directory, "lines.gcode")
+        with open(filename, 'w') as gcode_file:
+            gcode_file.write("\n".join(lines) + "\n")
+        index = GCodeIndex(build_index(filename, line_interval=100, chunk_size=1000))
+        assert_that(index.line_count, equal_to(2500))
+        assert_that(index.line_offsets, has_length(25))
+        with open(filename) as gcode_file:
+            for line_number in (0, 99, 100, 1234, 2499):
+                indexed_line, offset = index.line_offset(line_number)
+                gcode_file.seek(offset)
+                for i in range(line_number - indexed_line):
+                    gcode_file.readline()
+                assert_that(gcode_file.readline().strip(), equal_to(lines[line_number]))
+        assert_that(calling(index.line_offset).with_args(2500), raises(IndexError))
+
+    def testIndexFile(self):
+        filename = os.path.join(self.directory, "print.gcode")
+        with open(filename, 'w') as gcode_file:
+            gcode_file.write("\n".join(_two_layers))
+        assert_that(read_index(filename), none())
+        indexer = GCodeIndexer()
+        try:
+            assert_that(indexer.index(filename), none())
+            while indexer.is_pending(filename):
+                time.sleep(0.01)
+            assert_that(indexer.index(filename).layers, has_length(2))
+        finally:
+            indexer.stop()
+        # a changed file needs a new index
+        with open(filename, 'a') as gcode_file:
+            gcode_file.write("\nG1 X0 Y0 Z1.0 E5\n")
+        assert_that(read_index(filename), none())
+        write_index(filename, build_index(filename))
+        assert_that(read_index(filename).layers, has_length(3))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(GCodeIndexTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
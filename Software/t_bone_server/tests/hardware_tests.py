@@ -0,0 +1,72 @@
+from t_bone import hardware, thermistors
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class SimulatedHardwareTest(unittest.TestCase):
+
+    def testPinsRememberTheirState(self):
+        backend = hardware.SimulatedBackend()
+        backend.GPIO.setup("P8_10", backend.GPIO.OUT)
+        assert_that(backend.GPIO.input("P8_10"), equal_to(backend.GPIO.LOW))
+        backend.GPIO.output("P8_10", backend.GPIO.HIGH)
+        assert_that(backend.GPIO.input("P8_10"), equal_to(backend.GPIO.HIGH))
+        backend.PWM.start("P9_14", 0.0, 1000, 0)
+        backend.PWM.set_duty_cycle("P9_14", 42.0)
+        assert_that(backend.PWM.duty_cycles["P9_14"], equal_to(42.0))
+
+    def testColdHeaterReadsAmbientTemperature(self):
+        backend = hardware.SimulatedBackend()
+        temperature = thermistors.get_thermistor_reading("B57560G104F", backend.ADC.read("P9_39"))
+        assert_that(temperature, close_to(backend.thermal_model.ambient_temperature, 1.0))
+
+    def testPwmOutputHeatsItsInput(self):
+        backend = hardware.SimulatedBackend()
+        model = backend.thermal_model
+        backend.PWM.start("P9_14", 100.0, 1000, 0)
+        model._last_update -= 10
+        model.update()
+        assert_that(model.temperatures["P9_39"], greater_than(model.ambient_temperature + 30))
+        assert_that(model.temperatures["P9_40"], close_to(model.ambient_temperature, 0.1))
+
+    def testGpioOutputHeatsItsInput(self):
+        backend = hardware.SimulatedBackend()
+        model = backend.thermal_model
+        backend.GPIO.setup("P8_19", backend.GPIO.OUT)
+        backend.GPIO.output("P8_19", backend.GPIO.HIGH)
+        model._last_update -= 10000
+        model.update()
+        steady_temperature = model.ambient_temperature + model.heating_rate / model.cooling_rate
+        assert_that(model.temperatures["P9_37"], close_to(steady_temperature, 0.1))
+
+    def testNamespacesHaveTheirOwnHeaters(self):
+        backend = hardware.SimulatedBackend()
+        model = backend.thermal_model
+        backend.PWM.start(hardware.pin_of("left", "P9_14"), 100.0, 1000, 0)
+        for namespace in ("left", "right"):
+            backend.ADC.read(hardware.pin_of(namespace, "P9_39"))
+        model._last_update -= 10
+        model.update()
+        assert_that(model.temperatures["left/P9_39"], greater_than(model.ambient_temperature + 30))
+        assert_that(model.temperatures["right/P9_39"], close_to(model.ambient_temperature, 0.1))
+        assert_that(model.temperatures["P9_39"], close_to(model.ambient_temperature, 0.1))
+
+    def testUnknownHardware(self):
+        try:
+            hardware.select_backend("toaster")
+            self.fail("toaster is not a hardware")
+        except hardware.HardwareError:
+            pass
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(SimulatedHardwareTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,199 @@
+from copy import deepcopy
+import time
+
+from t_bone import hardware, thermistors
+from t_bone.benchmark import CountingConnection, BENCHMARK_CONFIG
+from t_bone.heater import AnalogSampler, Thermometer, SamplerError, HeaterScheduler
+from t_bone.printer import Printer
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+_INPUT = "P9_39"
+_THERMISTOR = "100k"
+
+
+class AnalogSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = hardware.select_backend(hardware.SIMULATED)
+        self.adc = self.backend.ADC
+        self.backend.ADC = _FakeADC()
+        self.sampler = AnalogSampler(sample_delay=0.01, oversampling=1, filter_length=3, max_sample_age=0.1)
+        # the tests sample on their own
+        self.sampler.stop()
+        self.sampler.join(1)
+
+    def tearDown(self):
+        self.backend.ADC = self.adc
+
+    def testMedianFilter(self):
+        self.sampler.add_input(_INPUT)
+        for value in (0.5, 0.9, 0.4):
+            self.backend.ADC.value = value
+            self.sampler._sample(_INPUT)
+        # the spike is filtered away
+        assert_that(self.sampler.read(_INPUT), equal_to(0.5))
+        self.backend.ADC.value = 0.3
+        self.sampler._sample(_INPUT)
+        assert_that(self.sampler.read(_INPUT), equal_to(0.4))
+
+    def testThermometerReadsDirectlyBeforeTheFirstSample(self):
+        thermometer = Thermometer(_THERMISTOR, _INPUT, sampler=self.sampler)
+        assert_that(self.sampler.read(_INPUT), none())
+        self.backend.ADC.value = 0.5
+        assert_that(thermometer.read(), equal_to(thermistors.get_thermistor_reading(_THERMISTOR, 0.5)))
+
+    def testOldSampleIsAnError(self):
+        thermometer = Thermometer(_THERMISTOR, _INPUT, sampler=self.sampler)
+        self.backend.ADC.value = 0.5
+        self.sampler._sample(_INPUT)
+        assert_that(thermometer.read(), equal_to(thermistors.get_thermistor_reading(_THERMISTOR, 0.5)))
+        # the sampler is stopped - just like a dead one
+        time.sleep(0.15)
+        assert_that(calling(thermometer.read), raises(SamplerError))
+
+    def testStaleAfterSeconds(self):
+        sampler = AnalogSampler(sample_delay=0.01)
+        sampler.stop()
+        sampler.join(1)
+        sampler.add_input(_INPUT)
+        sampler._sample(_INPUT)
+        # a stalled interpreter for a few sample delays is no stuck sampler
+        time.sleep(0.2)
+        assert_that(sampler.read(_INPUT), equal_to(0.5))
+
+    def testFailingInputIsAnError(self):
+        thermometer = Thermometer(_THERMISTOR, _INPUT, sampler=self.sampler)
+        self.backend.ADC.value = 0.5
+        self.sampler._sample(_INPUT)
+        self.backend.ADC.value = None
+        self.sampler._sample(_INPUT)
+        # one failed sample is no reason to give up
+        assert_that(thermometer.read(), equal_to(thermistors.get_thermistor_reading(_THERMISTOR, 0.5)))
+        self.sampler._sample(_INPUT)
+        self.sampler._sample(_INPUT)
+        assert_that(calling(thermometer.read), raises(SamplerError))
+        self.backend.ADC.value = 0.4
+        self.sampler._sample(_INPUT)
+        assert_that(thermometer.read(), equal_to(thermistors.get_thermistor_reading(_THERMISTOR, 0.5)))
+
+
+class HeaterSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        hardware.select_backend(hardware.SIMULATED)
+        self.scheduler = HeaterScheduler()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def testEachHeaterAtItsOwnRate(self):
+        fast_heater = _FakeHeater(0.01)
+        slow_heater = _FakeHeater(0.05)
+        self.scheduler.add_heater(fast_heater)
+        self.scheduler.add_heater(slow_heater)
+        time.sleep(0.5)
+        self.scheduler.remove_heater(fast_heater)
+        self.scheduler.remove_heater(slow_heater)
+        assert_that(fast_heater.updates, greater_than(25))
+        assert_that(slow_heater.updates, all_of(greater_than(5), less_than(13)))
+        assert_that(fast_heater.cleaned_up, equal_to(True))
+        # how late the updates were is measured
+        assert_that(fast_heater.max_jitter, all_of(greater_than_or_equal_to(fast_heater.jitter), less_than(0.05)))
+
+    def testCrashedHeaterIsRemoved(self):
+        crashing_heater = _FakeHeater(0.01, crash_after=3)
+        heater = _FakeHeater(0.01)
+        self.scheduler.add_heater(crashing_heater)
+        self.scheduler.add_heater(heater)
+        time.sleep(0.2)
+        assert_that(crashing_heater.updates, equal_to(3))
+        assert_that(crashing_heater.active, equal_to(False))
+        assert_that(crashing_heater.cleaned_up, equal_to(True))
+        # the others keep going
+        updates = heater.updates
+        time.sleep(0.05)
+        assert_that(heater.updates, greater_than(updates))
+        assert_that(heater.active, equal_to(True))
+
+    def testHeaterWithoutTemperatureIsSwitchedOff(self):
+        self.scheduler.stop()
+        self.scheduler = HeaterScheduler(max_sampler_failure_time=0.5)
+        heater = _FakeHeater(0.01, stale_after=3)
+        self.scheduler.add_heater(heater)
+        time.sleep(0.3)
+        # it stays in the schedule - but off
+        assert_that(heater.active, equal_to(True))
+        assert_that(heater.switched_off, greater_than(3))
+        # the temperature is back
+        heater.stale_after = None
+        updates = heater.updates
+        time.sleep(0.1)
+        assert_that(heater.updates, greater_than(updates))
+        # and gone for good
+        heater.stale_after = heater.updates
+        time.sleep(0.8)
+        assert_that(heater.active, equal_to(False))
+        assert_that(heater.cleaned_up, equal_to(True))
+
+    def testReadoutDelayFromTheConfig(self):
+        config = deepcopy(BENCHMARK_CONFIG)
+        config['extruder']['heater']['readout-delay'] = 0.5
+        printer = Printer(serial_port=None, reset_pin=None)
+        try:
+            printer.machine.machine_connection = CountingConnection()
+            printer.configure(config)
+            assert_that(printer.extruder_heater.readout_delay, equal_to(0.5))
+        finally:
+            printer.stop()
+
+
+class _FakeHeater(object):
+    def __init__(self, readout_delay, crash_after=None, stale_after=None):
+        self.readout_delay = readout_delay
+        self.crash_after = crash_after
+        self.stale_after = stale_after
+        self.switched_off = 0
+        self.active = True
+        self.jitter = 0.0
+        self.max_jitter = 0.0
+        self.updates = 0
+        self.cleaned_up = False
+
+    def control(self):
+        if self.updates == self.crash_after:
+            raise Exception("Heater on fire")
+        if self.stale_after is not None and self.updates >= self.stale_after:
+            raise SamplerError("No temperature")
+        self.updates += 1
+
+    def switch_off(self):
+        self.switched_off += 1
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class _FakeADC(object):
+    def __init__(self):
+        # None makes it fail
+        self.value = 0.5
+
+    def read(self, pin):
+        if self.value is None:
+            raise IOError("No ADC at %s" % pin)
+        return self.value
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(AnalogSamplerTest))
+    suite.addTest(loader.loadTestsFromTestCase(HeaterSchedulerTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,42 @@
+from t_bone.helpers import compile_step_conversion, StepConversion
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class StepConversionTest(unittest.TestCase):
+
+    def testAxisAreCompiledInOrder(self):
+        axis_config = {
+            'x': {
+                'steps_per_mm': 80,
+                'max_speed_step': 16000,
+                'max_step_acceleration': 240000,
+                'clock-referenced': False
+            },
+            'z': {
+                'steps_per_mm': 32000,
+                'max_speed_step': 320000,
+                'max_step_acceleration': 3200000,
+                'clock-referenced': True
+            }
+        }
+        conversion = compile_step_conversion(axis_config, ('z', 'x'))
+        assert_that(conversion.axis_names, equal_to(('z', 'x')))
+        assert_that(conversion.steps_per_mm, equal_to((32000.0, 80.0)))
+
+    def testConversionIsImmutable(self):
+        conversion = StepConversion(('x',), (80.0,))
+        self.assertRaises(AttributeError, setattr, conversion, 'steps_per_mm', (100.0,))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(StepConversionTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
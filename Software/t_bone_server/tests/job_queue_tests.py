@@ -0,0 +1,179 @@
+import os
+import shutil
+import tempfile
+from threading import Event
+import time
+from t_bone.gcode_index import GCodeIndexer
+from t_bone.job_queue import JobQueue, JobScheduler, JobError, QUEUED, HEATING, PRINTING, DONE, FAILED, CANCELLED
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.job_file = os.path.join(self.directory, "jobs.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testReorderAndCancel(self):
+        queue = JobQueue(self.job_file)
+        first, second, third = [queue.enqueue("/prints/%s.gcode" % name)['id'] for name in ("a", "b", "c")]
+        queue.move(third, 0)
+        assert_that(queue.next_job()['id'], equal_to(third))
+        queue.move(third, 5)
+        assert_that([job['id'] for job in queue.jobs()], contains(first, second, third))
+        queue.cancel(first)
+        assert_that(queue.next_job()['id'], equal_to(second))
+        assert_that(calling(queue.cancel).with_args(first), raises(JobError))
+        assert_that(calling(queue.move).with_args(first, 0), raises(JobError))
+
+    def testQueueIsStored(self):
+        queue = JobQueue(self.job_file)
+        printing = queue.enqueue("/prints/a.gcode")['id']
+        queued = queue.enqueue("/prints/b.gcode", start_layer=3)['id']
+        queue.update(printing, PRINTING)
+        # the server got restarted
+        queue = JobQueue(self.job_file)
+        assert_that(queue.job(printing)['state'], equal_to(FAILED))
+        assert_that(queue.job(queued)['state'], equal_to(QUEUED))
+        assert_that(queue.job(queued)['start_layer'], equal_to(3))
+        assert_that(queue.enqueue("/prints/c.gcode")['id'], equal_to(3))
+
+
+class JobSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.printer = _FakePrinter()
+        self.queue = JobQueue()
+        self.scheduler = JobScheduler(self.printer, self.queue, indexer=GCodeIndexer())
+
+    def tearDown(self):
+        self.scheduler.indexer.stop()
+        shutil.rmtree(self.directory)
+
+    def testJobsArePrintedOneAfterTheOther(self):
+        first = self.queue.enqueue(self._write("first.gcode", 200))['id']
+        second = self.queue.enqueue(self._write("second.gcode", 220))['id']
+        # it waits for the index to know how hot it has to get
+        self._schedule_until(first, HEATING)
+        assert_that(self.printer.extruder_heater.get_set_temperature(), equal_to(200.0))
+        self.printer.extruder_heater.temperature = 198.0
+        self._schedule_until(first, PRINTING)
+        # the second one gets heated while the first one is finishing
+        self._schedule_until(second, HEATING)
+        assert_that(self.queue.job(first)['state'], equal_to(PRINTING))
+        assert_that(self.printer.extruder_heater.get_set_temperature(), equal_to(220.0))
+        self.printer.finished.set()
+        self._schedule_until(first, DONE)
+        self.printer.extruder_heater.temperature = 220.0
+        self._schedule_until(second, DONE)
+        assert_that(self.printer.moves, has_length(20))
+
+    def testCoolerJobWaitsForTheCurrentOne(self):
+        first = self.queue.enqueue(self._write("first.gcode", 220))['id']
+        second = self.queue.enqueue(self._write("second.gcode", 180))['id']
+        self._schedule_until(first, HEATING)
+        self.printer.extruder_heater.temperature = 220.0
+        self._schedule_until(first, PRINTING)
+        self._schedule_until(second, HEATING)
+        # the first job still prints at its temperature
+        assert_that(self.printer.extruder_heater.get_set_temperature(), equal_to(220.0))
+        self.printer.finished.set()
+        self._schedule_until(first, DONE)
+        assert_that(self.printer.extruder_heater.get_set_temperature(), equal_to(180.0))
+        self._schedule_until(second, DONE)
+
+    def testCancelledJobStopsHeating(self):
+        first = self.queue.enqueue(self._write("first.gcode", 200))['id']
+        self._schedule_until(first, HEATING)
+        self.scheduler.cancel(first)
+        assert_that(self.printer.extruder_heater.get_set_temperature(), equal_to(0.0))
+        # while another job prints it gets its temperature back
+        second = self.queue.enqueue(self._write("second.gcode", 200))['id']
+        third = self.queue.enqueue(self._write("third.gcode", 220))['id']
+        self._schedule_until(second, HEATING)
+        self.printer.extruder_heater.temperature = 200.0
+        self._schedule_until(second, PRINTING)
+        self._schedule_until(third, HEATING)
+        assert_that(self.printer.extruder_heater.get_set_temperature(), equal_to(220.0))
+        self.scheduler.cancel(third)
+        assert_that(self.printer.extruder_heater.get_set_temperature(), equal_to(200.0))
+        self.printer.finished.set()
+        self._schedule_until(second, DONE)
+
+    def testMissingFileFails(self):
+        job = self.queue.enqueue(os.path.join(self.directory, "missing.gcode"))['id']
+        self._schedule_until(job, FAILED)
+        assert_that(self.queue.job(job)['error'], not_none())
+
+    def _schedule_until(self, job_id, state):
+        timeout = time.time() + 5
+        while not self.queue.job(job_id)['state'] == state:
+            assert_that(time.time(), less_than(timeout))
+            self.scheduler.schedule()
+            time.sleep(0.01)
+
+    def _write(self, name, temperature):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as gcode_file:
+            gcode_file.write("M104 S%s\n" % temperature)
+            for x in range(10):
+                gcode_file.write("G1 X%s Y1\n" % x)
+        return filename
+
+
+class _FakeHeater(object):
+    def __init__(self):
+        self.temperature = 20.0
+        self._set_temperature = 0.0
+
+    def set_temperature(self, temperature):
+        self._set_temperature = temperature
+
+    def get_set_temperature(self):
+        return self._set_temperature
+
+    max_temperature = 300.0
+
+
+class _FakeTracer(object):
+    def start(self):
+        return None
+
+
+class _FakePrinter(object):
+    def __init__(self):
+        self.extruder_heater = _FakeHeater()
+        self.heated_bed = None
+        self.planner_process = None
+        self.tracer = _FakeTracer()
+        self.moves = []
+        # the last moves take their time
+        self.finished = Event()
+
+    def start_print(self):
+        pass
+
+    def finish_print(self):
+        self.finished.wait(5)
+
+    def move_to(self, position):
+        self.moves.append(position)
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(JobQueueTest))
+    suite.addTest(loader.loadTestsFromTestCase(JobSchedulerTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,86 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from t_bone.log_handler import AsyncRotatingFileHandler
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class AsyncRotatingFileHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "t_bone.log")
+        self.logger = logging.getLogger("log_handler_test")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        shutil.rmtree(self.directory)
+
+    def _create_handler(self, **kwargs):
+        handler = AsyncRotatingFileHandler(self.filename, **kwargs)
+        handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+        self.logger.addHandler(handler)
+        return handler
+
+    def testRecordsAreWritten(self):
+        handler = self._create_handler()
+        arguments = {'x': 1}
+        self.logger.info("moving to %s", arguments)
+        # the record is formatted when it is logged not when it is written
+        arguments['x'] = 2
+        self.logger.debug("done")
+        handler.close()
+        assert_that(open(self.filename).read(), equal_to("INFO - moving to {'x': 1}\nDEBUG - done\n"))
+
+    def testLogFileIsRotated(self):
+        handler = self._create_handler(max_bytes=1000, backup_count=2)
+        for i in range(100):
+            self.logger.info("line %03d with some text to fill the file", i)
+            handler.flush()
+        handler.close()
+        assert_that(os.path.exists(self.filename + ".1"), equal_to(True))
+        assert_that(os.path.exists(self.filename + ".2"), equal_to(True))
+        assert_that(os.path.exists(self.filename + ".3"), equal_to(False))
+        assert_that(os.path.getsize(self.filename), less_than_or_equal_to(1000))
+        assert_that(open(self.filename).read(), contains_string("line 099"))
+
+    def testDebugRecordsAreDroppedUnderBackpressure(self):
+        handler = self._create_handler(queue_size=20, batch_size=1)
+        write_lines = handler._write_lines
+        disk_is_slow = threading.Event()
+
+        def slow_write_lines(lines):
+            disk_is_slow.wait()
+            write_lines(lines)
+
+        handler._write_lines = slow_write_lines
+        for i in range(15):
+            self.logger.info("info %s", i)
+        self.logger.debug("not written")
+        assert_that(handler.dropped_records, equal_to(1))
+        disk_is_slow.set()
+        handler.close()
+        content = open(self.filename).read()
+        assert_that(content, contains_string("INFO - info 14"))
+        assert_that(content, is_not(contains_string("not written")))
+        assert_that(content, contains_string("Dropped 1 log records"))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(AsyncRotatingFileHandlerTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,212 @@
+from copy import deepcopy
+from Queue import Empty
+import os
+import shutil
+import tempfile
+
+from t_bone import benchmark
+from t_bone import hardware
+from t_bone.benchmark import CountingConnection, BENCHMARK_CONFIG
+from t_bone.gcode_index import GCodeIndex, build_index
+from t_bone.gcode_interpreter import GCodePrintThread
+from t_bone.machine import encode_command
+from t_bone.planner_process import BlockRing, PlannerProcess, PlannerProcessError, encode_text, decode_text, LINE, \
+    create_ring_file
+from t_bone.printer import Printer, PrinterError
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class BlockRingTest(unittest.TestCase):
+
+    def testRingWrapsAround(self):
+        ring = BlockRing(3)
+        for round in range(3):
+            for index in range(3):
+                ring.write(encode_text(LINE, "M104 S%s" % (round * 3 + index)))
+            assert_that(ring.qsize(), equal_to(3))
+            for index in range(3):
+                assert_that(decode_text(ring.read(0)), equal_to("M104 S%s" % (round * 3 + index)))
+            assert_that(calling(ring.read).with_args(0.01), raises(Empty))
+        ring.close()
+
+    def testRingNeedsRoom(self):
+        assert_that(calling(BlockRing).with_args(0), raises(PlannerProcessError))
+
+    def testStoppedRingDoesNotWaitForever(self):
+        ring = BlockRing(1)
+        ring.stopped_write_timeout = 0.05
+        ring.write(encode_text(LINE, "M104 S200"))
+        ring.stop()
+        assert_that(calling(ring.write).with_args(encode_text(LINE, "M104 S0")), raises(PlannerProcessError))
+        ring.close()
+
+    def testRingInAFile(self):
+        path = create_ring_file(4)
+        try:
+            writer = BlockRing(4, path=path)
+            reader = BlockRing(4, path=path)
+            writer.write(encode_text(LINE, "M104 S200"))
+            writer.stop()
+            assert_that(decode_text(reader.read(0)), equal_to("M104 S200"))
+            assert_that(reader.stopped, equal_to(True))
+            writer.close()
+            reader.close()
+        finally:
+            os.remove(path)
+
+
+class PlannerProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        hardware.select_backend(hardware.SIMULATED)
+        self.directory = tempfile.mkdtemp()
+        self.file = os.path.join(self.directory, 'print.gcode')
+        lines = ["M104 S200 ; heat up"] + benchmark.straight_infill(80) + benchmark.arc_moves(20)
+        with open(self.file, 'w') as gcode_file:
+            gcode_file.write('\n'.join(lines) + '\n')
+        self.printers = []
+
+    def tearDown(self):
+        for printer in self.printers:
+            printer.stop()
+        shutil.rmtree(self.directory)
+
+    def testSameCommandsAsInTheThread(self):
+        commands, _ = self._print(planner_process=False)
+        planned_commands, printer = self._print(planner_process=True)
+        assert_that(len(commands), greater_than(80))
+        assert_that(planned_commands, equal_to(commands))
+        assert_that(printer.extruder_heater.get_set_temperature(), equal_to(200))
+
+    def testPrintCanBeStopped(self):
+        printer = self._printer(planner_process=True)
+        print_thread = GCodePrintThread(self.file, printer, None)
+        print_thread.stop()
+        print_thread.start()
+        print_thread.join(10)
+        assert_that(print_thread.isAlive(), equal_to(False))
+        assert_that(print_thread.error, none())
+        assert_that(print_thread.lines_printed, equal_to(0))
+
+    def testWorkerPlansFromTheHomedAxis(self):
+        with open(self.file, 'w') as gcode_file:
+            gcode_file.write("G1 X50 Y50 F6000\nG1 X60 Y50\nG28\nG1 X10 Y0\n")
+        printer = self._printer(planner_process=True)
+        executed = []
+        planner = PlannerProcess(printer, self.file, lambda line, printer: executed.append(line),
+                                 **printer.planner_process)
+        planner.start()
+        try:
+            while True:
+                executed.append(planner.next_movement_to_execute(1))
+        except Empty:
+            pass
+        planner.finish()
+        assert_that(planner.error, none())
+        # the moves before are done before the printer homes
+        assert_that([movement if movement == "G28" else movement['type'] for movement in executed],
+                    contains('move', 'move', "G28", 'set_position', 'move'))
+        assert_that(executed[3], has_entries({'sx': 0.0, 'sy': 0.0, 'sz': 0.0}))
+        assert_that(executed[4]['millimeters'], close_to(10.0, 0.0001))
+        assert_that(os.path.exists(planner.ring.path), equal_to(False))
+
+    def testDeadWorkerEndsTheReading(self):
+        printer = self._printer(planner_process=True)
+        planner = PlannerProcess(printer, self.file, lambda line, printer: None, **printer.planner_process)
+        planner.start()
+        # it does not even get to the file
+        planner._process.kill()
+        planner._process.wait()
+        assert_that(planner.reading_finished, equal_to(True))
+        planner.finish()
+        assert_that(planner.error, contains_string("ended unexpectedly"))
+
+    def testStartAtLayer(self):
+        layers = ["M104 S200", "G21", "G90", "G92 E0"]
+        for layer in range(3):
+            layers.append("G1 Z%.1f F600" % (0.2 * (layer + 1)))
+            for move in range(10):
+                layers.append("G1 X%s Y%s E%s F1800" % (20 + move * 10, 20 + layer * 10, layer * 10 + move + 1))
+        with open(self.file, 'w') as gcode_file:
+            gcode_file.write('\n'.join(layers) + '\n')
+        index = GCodeIndex(build_index(self.file))
+        # the extruder starts where the file left it - and not at 0
+        with open(os.path.join(self.directory, 'rest.gcode'), 'w') as gcode_file:
+            gcode_file.write('\n'.join(["G92 E10", "G1 F1800"] + layers[index.layer(1)['line']:]) + '\n')
+        commands, _ = self._print(planner_process=False, file=gcode_file.name)
+        assert_that(self._print(planner_process=False, index=index, start_layer=1)[0], equal_to(commands))
+        assert_that(self._print(planner_process=True, index=index, start_layer=1)[0], equal_to(commands))
+
+    def testStartAtLayerNeedsHomedAndHeatedPrinter(self):
+        with open(self.file, 'w') as gcode_file:
+            gcode_file.write("M104 S200\nG1 Z0.2\nG1 X10 E1\nG1 Z0.4\nG1 X20 E2\n")
+        index = GCodeIndex(build_index(self.file))
+        printer = self._printer(planner_process=False)
+        assert_that(self._start_error(printer, index), contains_string("homed"))
+        printer.homed = True
+        assert_that(self._start_error(printer, index), contains_string("heated"))
+        self._heat(printer)
+        assert_that(GCodePrintThread(self.file, printer, None, index=index, start_layer=1).start_lines,
+                    contains("G92 E1.0"))
+
+    def _start_error(self, printer, index):
+        try:
+            GCodePrintThread(self.file, printer, None, index=index, start_layer=1)
+        except PrinterError as e:
+            return e.msg
+
+    def _print(self, planner_process, file=None, index=None, start_layer=None):
+        printer = self._printer(planner_process)
+        if start_layer:
+            printer.homed = True
+            self._heat(printer)
+        print_thread = GCodePrintThread(file or self.file, printer, None, index=index, start_layer=start_layer)
+        print_thread.start()
+        print_thread.join(30)
+        assert_that(print_thread.isAlive(), equal_to(False))
+        assert_that(print_thread.error, none())
+        assert_that(print_thread.progress(), equal_to(1.0))
+        return printer.machine.machine_connection.commands, printer
+
+    def _printer(self, planner_process):
+        config = deepcopy(BENCHMARK_CONFIG)
+        if planner_process:
+            config['printer']['planner-process'] = {'ring-size': 16}
+        printer = Printer(serial_port=None, reset_pin=None)
+        self.printers.append(printer)
+        printer.machine.machine_connection = _RecordingConnection()
+        printer.configure(config)
+        return printer
+
+    def _heat(self, printer):
+        # there is no hot end in the simulation
+        heater = printer.extruder_heater
+        heater.control = lambda: None
+        heater.set_temperature(200)
+        heater.temperature = 200
+
+
+class _RecordingConnection(CountingConnection):
+    def __init__(self):
+        super(_RecordingConnection, self).__init__()
+        self.commands = []
+
+    def send_command(self, command, timeout=None, trace=None):
+        if command.command_number == 10:
+            self.commands.append(encode_command(command))
+        return super(_RecordingConnection, self).send_command(command, timeout, trace)
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(BlockRingTest))
+    suite.addTest(loader.loadTestsFromTestCase(PlannerProcessTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
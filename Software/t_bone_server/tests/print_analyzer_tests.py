@@ -0,0 +1,112 @@
+from math import sqrt
+import os
+import shutil
+import tempfile
+import time
+from t_bone.benchmark import BENCHMARK_CONFIG
+from t_bone.firmware_simulator import trapezoid_duration
+from t_bone.helpers import trapezoid_profile
+from t_bone.print_analyzer import PrintAnalyzer, AnalysisService, ANALYSIS_SUFFIX
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+_two_layers = [
+    "G21",
+    "G90",
+    "G92 E0",
+    "G1 Z0.2 F600",
+    "G1 X10 Y0 E1 F1200",
+    "G1 X10 Y10 E2",
+    "G1 Z0.6 F600",
+    "G1 X0 Y0 F6000",
+    "G1 Z0.4 F600",
+    "G1 X10 Y0 E3 F1200",
+    "G1 X10 Y10 E4",
+]
+
+
+class PrintAnalyzerTest(unittest.TestCase):
+
+    def testTrapezoidProfile(self):
+        for profile in ((20.0, 0.0, 10.0, 0.0, 10.0), (10.0, 0.0, 100.0, 0.0, 10.0), (10.0, 2.0, 10.0, 5.0, 10.0)):
+            acceleration_time, cruise_time, deceleration_time, peak_speed = trapezoid_profile(*profile)
+            assert_that(acceleration_time + cruise_time + deceleration_time,
+                        close_to(trapezoid_duration(*profile), 0.0001))
+        # accelerate 1s, 1s at full speed, decelerate 1s
+        assert_that(trapezoid_profile(20.0, 0.0, 10.0, 0.0, 10.0), contains(1.0, 1.0, 1.0, 10.0))
+
+    def testPrintTime(self):
+        # one long straight line - 3s at 60mm/s and a few milliseconds to get there and back
+        result = PrintAnalyzer(BENCHMARK_CONFIG).analyze_lines(["G1 X180 F3600"])
+        assert_that(result['blocks'], equal_to(1))
+        assert_that(result['duration'], close_to(3.0, 0.1))
+        assert_that(result['max_speed'], close_to(60.0, 0.001))
+        assert_that(result['max_axis_speeds']['x'], close_to(60.0, 0.001))
+        assert_that(result['acceleration_share'], greater_than(0))
+        assert_that(result['acceleration_share'], less_than(0.1))
+
+    def testLayers(self):
+        result = PrintAnalyzer(BENCHMARK_CONFIG).analyze_lines(_two_layers)
+        assert_that(result['lines'], equal_to(len(_two_layers)))
+        assert_that(result['extrusion'], close_to(4.0, 0.0001))
+        # the z hop belongs to the first layer
+        assert_that([layer['z'] for layer in result['layers']], contains(0.2, 0.4))
+        assert_that(sum(layer['duration'] for layer in result['layers']), close_to(result['duration'], 0.0001))
+
+    def testMovesAfterHomingStartAtZero(self):
+        result = PrintAnalyzer(BENCHMARK_CONFIG).analyze_lines(["G1 X50 Y50 F6000", "G28", "G1 X10 Y0"])
+        assert_that(result['homings'], equal_to(1))
+        assert_that(result['distance'], close_to(sqrt(50.0 ** 2 + 50.0 ** 2) + 10.0, 0.0001))
+
+    def testAnalysisService(self):
+        directory = tempfile.mkdtemp()
+        service = AnalysisService(BENCHMARK_CONFIG)
+        try:
+            filename = os.path.join(directory, "test.gcode")
+            with open(filename, 'w') as gcode_file:
+                gcode_file.write("\n".join(_two_layers))
+            assert_that(service.analysis(filename)['status'], equal_to('running'))
+            timeout = time.time() + 10
+            while service.analysis(filename)['status'] == 'running' and time.time() < timeout:
+                time.sleep(0.01)
+            analysis = service.analysis(filename)
+            assert_that(analysis['status'], equal_to('done'))
+            assert_that(analysis['layers'], has_length(2))
+            assert_that(os.path.exists(filename + ANALYSIS_SUFFIX), equal_to(True))
+            # a new service finds the result next to the file
+            assert_that(AnalysisService(BENCHMARK_CONFIG).analysis(filename)['status'], equal_to('done'))
+        finally:
+            service.stop()
+            shutil.rmtree(directory)
+
+    def testFailedAnalysis(self):
+        directory = tempfile.mkdtemp()
+        service = AnalysisService(BENCHMARK_CONFIG)
+        try:
+            filename = os.path.join(directory, "broken.gcode")
+            with open(filename, 'w') as gcode_file:
+                # an arc without a center
+                gcode_file.write("G1 X10 Y10 F1200\nG2 X20 Y10\n")
+            timeout = time.time() + 10
+            while service.analysis(filename)['status'] == 'running' and time.time() < timeout:
+                time.sleep(0.01)
+            analysis = service.analysis(filename)
+            assert_that(analysis['status'], equal_to('failed'))
+            assert_that(analysis['error'], contains_string("line 2"))
+            assert_that(os.path.exists(filename + ANALYSIS_SUFFIX), equal_to(False))
+        finally:
+            service.stop()
+            shutil.rmtree(directory)
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(PrintAnalyzerTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,73 @@
+from copy import deepcopy
+from t_bone import hardware
+from t_bone.benchmark import BENCHMARK_CONFIG
+from t_bone.printer_farm import PrinterFarm, FarmError, read_farm_config, measure_farm, resource_usage
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class PrinterFarmTest(unittest.TestCase):
+
+    def testFarmConfig(self):
+        assert_that(read_farm_config(BENCHMARK_CONFIG), none())
+        config = {'farm': {'printers': [{'name': 'left'}, {'name': 'left'}]}}
+        assert_that(calling(read_farm_config).with_args(config), raises(FarmError))
+        config = {'farm': {'printers': [{'serial-port': '/dev/ttyUSB0'}]}}
+        assert_that(calling(read_farm_config).with_args(config), raises(FarmError))
+
+    def testHeaterPinsAreNotShared(self):
+        config = deepcopy(BENCHMARK_CONFIG)
+        config['farm'] = {'printers': [{'name': 'left'}, {'name': 'right'}]}
+        # one printer could use the farm config - but not two
+        assert_that(calling(read_farm_config).with_args(config), raises(FarmError))
+        assert_that(read_farm_config(config, shared_heaters=True), has_length(2))
+        right_config = deepcopy(BENCHMARK_CONFIG)
+        right_config['extruder']['heater']['output'] = 3
+        del right_config['printer']['heated-bed']
+        config['farm']['printers'][1]['config'] = right_config
+        assert_that(read_farm_config(config), has_length(2))
+        right_config['extruder']['heater']['output'] = config['printer']['heated-bed']['output']
+        assert_that(calling(read_farm_config).with_args(config), raises(FarmError))
+
+    def testPrintersAreSeparate(self):
+        hardware.select_backend(hardware.SIMULATED)
+        config = deepcopy(BENCHMARK_CONFIG)
+        config['farm'] = {'printers': [{'name': 'left'}, {'name': 'right'}, {'name': 'broken', 'config': {}}]}
+        farm = PrinterFarm(config, simulator_speedup=1000.0)
+        try:
+            farm.start()
+            # a printer without config does not stop the others
+            assert_that(farm.printers.keys(), contains('left', 'right'))
+            assert_that(farm.errors, has_key('broken'))
+            left = farm.printer('left')
+            right = farm.printer('right')
+            assert_that(left.printer.machine, is_not(same_instance(right.printer.machine)))
+            assert_that(left.firmware_simulator.serial_port, is_not(equal_to(right.firmware_simulator.serial_port)))
+            # the same config - but not the same heater
+            assert_that(left.printer.extruder_heater._output, is_not(equal_to(right.printer.extruder_heater._output)))
+            assert_that([status['name'] for status in farm.status()], contains('left', 'right'))
+            assert_that(left.status()['ready'], equal_to(True))
+            assert_that(calling(farm.printer).with_args('broken'), raises(FarmError))
+        finally:
+            farm.stop()
+
+    def testMeasureFarm(self):
+        result = measure_farm(printers=3, moves=20)
+        assert_that(result['printers'], equal_to(3))
+        assert_that(result['failed'], empty())
+        assert_that(result['moves'], greater_than_or_equal_to(60))
+        assert_that(result['threads_per_printer'], greater_than(0))
+        assert_that(resource_usage(), has_key('cpu_time'))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(PrinterFarmTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,110 @@
+from copy import deepcopy
+
+from t_bone import benchmark
+from t_bone import hardware
+from t_bone.benchmark import CountingConnection, BENCHMARK_CONFIG
+from t_bone.gcode_interpreter import read_gcode_to_printer
+from t_bone.machine import encode_command
+from t_bone.printer import Printer
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class MovementCompilationTest(unittest.TestCase):
+
+    def setUp(self):
+        hardware.select_backend(hardware.SIMULATED)
+        self.printer = Printer(serial_port=None, reset_pin=None)
+        self.connection = _RecordingConnection()
+        self.printer.machine.machine_connection = self.connection
+        self.printer.configure(deepcopy(BENCHMARK_CONFIG))
+
+    def tearDown(self):
+        self.printer.stop()
+
+    def testCompiledCommandIsTheExecutedOne(self):
+        # the commands get compiled when they leave the planning window - they used to be built when executed
+        print_queue = self.printer.create_print_queue()
+        execute_movement = self.printer.execute_movement
+        executed_commands = []
+
+        def execute_movement_as_before(movement):
+            try:
+                if movement['type'] == 'move':
+                    executed_commands.append(self._execution_time_command(movement))
+                execute_movement(movement)
+            finally:
+                print_queue.execution_queue.task_done()
+
+        self.printer.execute_movement = execute_movement_as_before
+        self.printer.start_print(print_queue)
+        for line in benchmark.straight_infill(40) + benchmark.z_hops(20) + benchmark.arc_moves(10):
+            read_gcode_to_printer(line, self.printer)
+        self.printer.finish_print()
+        print_queue.execution_queue.join()
+        assert_that(len(executed_commands), greater_than(60))
+        assert_that(self.connection.commands, equal_to([command for command in executed_commands if command]))
+
+    def testSendingACreatedCommandIsMovingTo(self):
+        motors = [{'motor': 1, 'target': 1000, 'type': 'stop', 'nominal_speed': 1000, 'acceleration': 10000,
+                   'entry_speed': 0, 'exit_speed': 0},
+                  {'motor': 2, 'target': -500, 'type': 'way', 'nominal_speed': 500.5, 'acceleration': 5000,
+                   'entry_speed': 100, 'exit_speed': 200}]
+        machine = self.printer.machine
+        machine.move_to(motors)
+        machine.send_move_command(machine.create_move_command(motors))
+        assert_that(self.connection.commands, has_length(2))
+        assert_that(self.connection.commands[1], equal_to(self.connection.commands[0]))
+        assert_that(machine.create_move_command([]), none())
+
+    def testMovesStartAtTheSetPosition(self):
+        print_queue = self.printer.create_print_queue()
+        print_queue.plan_new_movement({'type': 'set_position', 'e': 10.0})
+        print_queue.plan_new_movement({'type': 'move', 'x': 10.0, 'e': 10.5, 'target_speed': 20.0})
+        assert_that(print_queue.planning_queue[-1]['delta_e'], close_to(0.5, 0.0001))
+        assert_that(print_queue.target_position['e'], equal_to(10.5))
+
+    def testSlowedArcKeepsTheFeedRate(self):
+        print_queue = self.printer.create_print_queue()
+        print_queue.plan_new_movement({'type': 'move', 'x': 1.0, 'y': 0.0, 'target_speed': 100.0})
+        print_queue.plan_arc({'i': -1.0}, clockwise=False)
+        # the segments were slower - the next moves are not
+        assert_that(print_queue.planning_queue[-1]['target_speed'], less_than(100.0))
+        assert_that(print_queue.planner.get_previous_feed_rate(), equal_to(100.0))
+
+    def _execution_time_command(self, movement):
+        # just like execute_movement did it before the commands got compiled by the planner
+        movement = dict((key, value) for key, value in movement.iteritems()
+                        if key not in ('move_command', 'move_commands', 'trace'))
+        printer = self.printer
+        step_pos, step_speed_vector = printer._add_movement_calculations(movement)
+        x_move_config, y_move_config, z_move_config, e_move_config = printer._generate_move_config(
+            movement, step_pos, step_speed_vector)
+        move_commands = printer._create_move_commands(movement, step_pos, x_move_config, y_move_config,
+                                                      z_move_config, e_move_config)
+        command = printer.machine.create_move_command(move_commands)
+        return encode_command(command) if command else None
+
+
+class _RecordingConnection(CountingConnection):
+    def __init__(self):
+        super(_RecordingConnection, self).__init__()
+        self.commands = []
+
+    def send_command(self, command, timeout=None, trace=None):
+        if command.command_number == 10:
+            self.commands.append(encode_command(command))
+        return super(_RecordingConnection, self).send_command(command, timeout, trace)
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(MovementCompilationTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
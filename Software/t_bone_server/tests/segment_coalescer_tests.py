@@ -0,0 +1,83 @@
+from math import cos, sin, radians
+from t_bone.segment_coalescer import SegmentCoalescer
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+_origin = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'e': 0.0}
+
+
+def _move(x, y, e, target_speed=30.0):
+    return {'type': 'move', 'x': x, 'y': y, 'e': e, 'target_speed': target_speed}
+
+
+class SegmentCoalescerTest(unittest.TestCase):
+
+    def _plan(self, coalescer, moves):
+        planned = []
+        position = dict(_origin)
+        for move in moves:
+            for target in coalescer.add(move, position):
+                planned.append(target)
+                for axis_name in ('x', 'y', 'z', 'e'):
+                    if axis_name in target:
+                        position[axis_name] = target[axis_name]
+        planned.extend(coalescer.flush())
+        return planned
+
+    def testStraightLineIsMerged(self):
+        coalescer = SegmentCoalescer()
+        planned = self._plan(coalescer, [_move(i, 0.0, i * 0.05) for i in range(1, 11)])
+        assert_that(planned, has_length(1))
+        assert_that(planned[0]['x'], equal_to(10))
+        assert_that(planned[0]['e'], close_to(0.5, 0.0001))
+        assert_that(coalescer.moves_received, equal_to(10))
+        assert_that(coalescer.moves_emitted, equal_to(1))
+
+    def testCornersSpeedsAndExtrusionAreKept(self):
+        planned = self._plan(SegmentCoalescer(), [_move(1, 0, 0.05), _move(2, 0, 0.1), _move(2, 1, 0.15)])
+        assert_that(planned, has_length(2))
+        planned = self._plan(SegmentCoalescer(), [_move(1, 0, 0.05), _move(2, 0, 0.1, target_speed=60.0)])
+        assert_that(planned, has_length(2))
+        planned = self._plan(SegmentCoalescer(), [_move(1, 0, 0.05), _move(2, 0, 0.2)])
+        assert_that(planned, has_length(2))
+        # a retraction is never merged
+        retraction = {'type': 'move', 'e': -1.0}
+        planned = self._plan(SegmentCoalescer(), [_move(1, 0, 0.05), retraction, _move(2, 0, -0.95)])
+        assert_that(planned, has_length(3))
+        # and neither is a set position
+        planned = self._plan(SegmentCoalescer(), [_move(1, 0, 0.05), {'type': 'set_position', 'e': 0},
+                                                  _move(2, 0, 0.05)])
+        assert_that(planned, has_length(3))
+        assert_that(planned[1]['type'], equal_to('set_position'))
+
+    def testArcDeviationIsBounded(self):
+        # a circle with 20mm radius in 0.5 degree steps
+        radius = 20.0
+        moves = [_move(radius * cos(radians(angle / 2.0)), radius * sin(radians(angle / 2.0)), angle * 0.01)
+                 for angle in range(1, 181)]
+        # we start on the circle
+        moves.insert(0, _move(radius, 0.0, 0.0))
+        chordal_tolerance = 0.01
+        planned = self._plan(SegmentCoalescer(chordal_tolerance=chordal_tolerance), moves)
+        assert_that(len(planned), less_than(len(moves) / 3))
+        assert_that(planned[0]['x'], equal_to(radius))
+        # every end point lies on the circle - and the middle of each chord close to it
+        start = (radius, 0.0)
+        for target in planned:
+            assert_that((target['x'] ** 2 + target['y'] ** 2) ** 0.5, close_to(radius, 0.0001))
+            middle = ((start[0] + target['x']) / 2, (start[1] + target['y']) / 2)
+            assert_that(radius - (middle[0] ** 2 + middle[1] ** 2) ** 0.5, less_than(chordal_tolerance))
+            start = (target['x'], target['y'])
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(SegmentCoalescerTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
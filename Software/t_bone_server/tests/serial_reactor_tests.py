@@ -0,0 +1,117 @@
+import os
+import pty
+import threading
+import time
+import tty
+
+import serial
+
+from t_bone.firmware_simulator import FirmwareSimulator
+from t_bone.machine import Machine, MachineCommand, MachineError
+from t_bone.serial_reactor import SerialReactor
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class SerialReactorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = SerialReactor()
+        self.reactor.start()
+        self.master_fd, slave_fd = pty.openpty()
+        tty.setraw(slave_fd)
+        self.serial_port = os.ttyname(slave_fd)
+        self.serial = serial.Serial(self.serial_port, 38400)
+        os.close(slave_fd)
+        self.connection = None
+
+    def tearDown(self):
+        if self.connection:
+            self.connection.stop()
+        self.reactor.stop()
+        os.close(self.master_fd)
+
+    def testWaitAndHeartbeatAreOutOfBand(self):
+        self._connect()
+        future = self.connection.submit(self._command(31))
+        assert_that(self._read_line(), equal_to("31;\n"))
+        # the reply comes in pieces - with a heartbeat and a wait in between
+        os.write(self.master_fd, "-1,0;\r\n-128,7,")
+        os.write(self.master_fd, "40;\r\n31,3")
+        time.sleep(0.1)
+        assert_that(future.done(), equal_to(False))
+        os.write(self.master_fd, ",40;\r\n")
+        reply = future.result(5)
+        assert_that(reply.command_number, equal_to(31))
+        assert_that(reply.arguments, equal_to(['3', '40']))
+        assert_that(self.connection.wait_replies, equal_to(1))
+        assert_that(self.connection.internal_queue_length, equal_to('7'))
+
+    def testCommandsFromManyThreads(self):
+        self._connect()
+        replies = {}
+
+        def send(number):
+            replies[number] = self.connection.send_command(self._command(number), timeout=5)
+
+        senders = [threading.Thread(target=send, args=(number,)) for number in range(30, 35)]
+        for sender in senders:
+            sender.start()
+        # one command at a time - each reply is for the command just read
+        for _ in senders:
+            number = int(self._read_line()[:-2])
+            os.write(self.master_fd, "%s,0;\r\n" % number)
+        for sender in senders:
+            sender.join(5)
+        assert_that(sorted(replies.keys()), equal_to(range(30, 35)))
+        for number, reply in replies.iteritems():
+            assert_that(reply.command_number, equal_to(number))
+
+    def testNoReplyBreaksTheConnection(self):
+        self._connect()
+        assert_that(calling(self.connection.send_command).with_args(self._command(31), timeout=0.2),
+                    raises(MachineError))
+        assert_that(calling(self.connection.submit).with_args(self._command(31)), raises(MachineError))
+
+    def testMachineOnFirmwareSimulator(self):
+        simulator = FirmwareSimulator(baud_rate=None)
+        machine = Machine(serial_port=simulator.serial_port)
+        try:
+            machine.connect(serial_reactor=self.reactor)
+            machine.start_motion()
+            machine.move_to([{'motor': 1, 'target': 1000, 'type': 'stop', 'nominal_speed': 1000,
+                              'acceleration': 10000, 'entry_speed': 0, 'exit_speed': 0}])
+            machine.finish_motion()
+            assert_that(simulator.moves_received, equal_to(1))
+        finally:
+            machine.disconnect()
+            simulator.stop()
+
+    def _connect(self):
+        # everything before the first heartbeat gets ignored
+        os.write(self.master_fd, "0,0;\r\n-128,0,40;\r\n")
+        self.connection = self.reactor.connect(self.serial, timeout=5)
+
+    def _read_line(self):
+        line = ""
+        while not line.endswith("\n"):
+            line += os.read(self.master_fd, 1)
+        return line
+
+    def _command(self, number):
+        command = MachineCommand()
+        command.command_number = number
+        return command
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(SerialReactorTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
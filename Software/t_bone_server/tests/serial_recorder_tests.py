@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+
+from t_bone.firmware_simulator import FirmwareSimulator
+from t_bone.machine import Machine, encode_command, OUT, IN
+from t_bone.serial_recorder import SerialRecorder, read_recording, command_from_frame, replay, RecordingError
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class SerialRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'serial.rec')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testFramesAreReadBack(self):
+        # small buffers - so they get handed over a few times, but all of them hold everything
+        recorder = SerialRecorder(self.file_name, buffer_size=1024, buffer_count=4)
+        frames = [(OUT if index % 2 else IN, "10,%s,200,1.5,4.1943e+06" % index) for index in range(100)]
+        for direction, frame in frames:
+            recorder.record(direction, frame)
+        recorder.stop()
+        recording = read_recording(self.file_name)
+        assert_that(recorder.frames_dropped, equal_to(0))
+        assert_that([(direction, frame) for direction, _, frame in recording], equal_to(frames))
+        timestamps = [timestamp for _, timestamp, _ in recording]
+        assert_that(timestamps, equal_to(sorted(timestamps)))
+
+    def testNoRecording(self):
+        with open(self.file_name, 'w') as recording_file:
+            recording_file.write("G1 X10 Y10\n")
+        assert_that(calling(read_recording).with_args(self.file_name), raises(RecordingError))
+
+    def testCommandFromFrame(self):
+        for frame in ("9", "11,1,20", "10,2,134400,115,51200,4.1943e+06,1,25600,1,128000,115,29153.9,0,14576.0"):
+            assert_that(encode_command(command_from_frame(frame)), equal_to(frame + ";\n"))
+
+    def testRecordAndReplay(self):
+        simulator = FirmwareSimulator(baud_rate=None, speedup=100.0)
+        machine = Machine(serial_port=simulator.serial_port)
+        try:
+            machine.connect(serial_recorder=SerialRecorder(self.file_name))
+            machine.start_motion()
+            for target in (1000, 2000, 500):
+                machine.move_to([{'motor': 1, 'target': target, 'type': 'stop', 'nominal_speed': 1000,
+                                  'acceleration': 10000, 'entry_speed': 0, 'exit_speed': 0}])
+            machine.finish_motion()
+        finally:
+            machine.disconnect()
+            simulator.stop()
+        recording = read_recording(self.file_name)
+        assert_that([frame for direction, _, frame in recording if direction == OUT][0], equal_to("9"))
+        assert_that(len([frame for direction, _, frame in recording if direction == OUT]), equal_to(6))
+
+        result = replay(self.file_name, target='recording', speedup=10.0)
+        assert_that(result['commands'], equal_to(5))
+        assert_that(result['mismatched_commands'], equal_to(0))
+        assert_that(result['mismatched_replies'], equal_to(0))
+
+        result = replay(self.file_name, target='simulator', speedup=100.0)
+        assert_that(result['commands'], equal_to(5))
+        assert_that(result['mismatched_replies'], equal_to(0))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(SerialRecorderTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,88 @@
+from t_bone import ramps_thermistors, replicape_thermistors, thermistors
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class RampsThermistorTest(unittest.TestCase):
+
+    def testLookupTableMatchesScanning(self):
+        thermistor_table = ramps_thermistors.bed_thermistor_100k
+        for i in range(0, 4097):
+            value = i / 4096.0
+            assert_that(ramps_thermistors.convert_ramps_reading("100k", thermistor_table, value),
+                        equal_to(ramps_thermistors._scan_ramps_reading("100k", thermistor_table, value)))
+
+    def testExactTableEntry(self):
+        result = ramps_thermistors.convert_ramps_reading("100k", ramps_thermistors.bed_thermistor_100k, 591 / 1024.0)
+        assert_that(result, equal_to(100))
+
+    def testInterpolation(self):
+        result = ramps_thermistors.convert_ramps_reading("10k", ramps_thermistors.thermistor_10k, 80 / 1024.0)
+        assert_that(result, close_to(122.0, 0.5))
+
+    def testUnknownTableGetsCompiled(self):
+        thermistor_table = {
+            100: 200,
+            200: 100
+        }
+        result = ramps_thermistors.convert_ramps_reading("test", thermistor_table, 150 / 1024.0)
+        assert_that(result, close_to(150.0, 0.001))
+
+
+class ReplicapeThermistorTest(unittest.TestCase):
+
+    def testExactTableEntry(self):
+        temp_table = replicape_thermistors.temp_table["B57560G104F"]
+        assert_that(replicape_thermistors.resistance_to_degrees(temp_table, 99601.3), close_to(25.3, 0.0001))
+
+    def testInterpolation(self):
+        temp_table = replicape_thermistors.temp_table["B57560G104F"]
+        result = replicape_thermistors.resistance_to_degrees(temp_table, 100000.0)
+        assert_that(result, greater_than(24.3333))
+        assert_that(result, less_than(25.3))
+
+    def testOutsideOfTable(self):
+        temp_table = replicape_thermistors.temp_table["B57560G104F"]
+        assert_that(replicape_thermistors.resistance_to_degrees(temp_table, 1.0e9), close_to(0.0, 0.0001))
+        assert_that(replicape_thermistors.resistance_to_degrees(temp_table, 1.0), close_to(300.0, 0.0001))
+
+    def testBatchConversion(self):
+        temp_table = replicape_thermistors.temp_table["B57560G104F"]
+        readings = [i / 100.0 for i in range(100)]
+        results = replicape_thermistors.convert_readings(temp_table, readings)
+        assert_that(results, has_length(100))
+        for reading, result in zip(readings, results):
+            assert_that(result, close_to(replicape_thermistors.convert_reading(temp_table, reading), 0.0001))
+
+
+class ThermistorRegistryTest(unittest.TestCase):
+
+    def testKnownThermistors(self):
+        result = thermistors.get_thermistor_reading("100k", 591 / 1024.0)
+        assert_that(result, equal_to(100))
+        result = thermistors.get_thermistor_reading("B57560G104F", 0.5)
+        assert_that(result, close_to(
+            replicape_thermistors.convert_reading(replicape_thermistors.temp_table["B57560G104F"], 0.5), 0.0001))
+
+    def testUnknownThermistor(self):
+        try:
+            thermistors.get_converter("no-such-thermistor")
+            exception_thrown = False
+        except Exception:
+            exception_thrown = True
+        assert_that(exception_thrown, equal_to(True))
+
+    def testRegisterThermistor(self):
+        thermistors.register_thermistor("test-thermistor", lambda value: value * 100.0)
+        assert_that(thermistors.get_thermistor_reading("test-thermistor", 0.5), close_to(50.0, 0.0001))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(RampsThermistorTest))
+    suite.addTest(loader.loadTestsFromTestCase(ReplicapeThermistorTest))
+    suite.addTest(loader.loadTestsFromTestCase(ThermistorRegistryTest))
+    return suite
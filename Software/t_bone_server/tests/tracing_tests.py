@@ -0,0 +1,86 @@
+from t_bone import tracing
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def testBucketsCoverAllValues(self):
+        histogram = tracing.LatencyHistogram(highest_latency=1.0)
+        for value in range(0, 1000000, 997):
+            index = histogram._index(value)
+            assert_that(histogram._lowest_equivalent_value(index), less_than_or_equal_to(value))
+            assert_that(histogram._highest_equivalent_value(index), greater_than_or_equal_to(value))
+
+    def testPercentiles(self):
+        histogram = tracing.LatencyHistogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000000.0 * 100)
+        assert_that(histogram.count, equal_to(1000))
+        assert_that(histogram.min, equal_to(100))
+        assert_that(histogram.max, equal_to(100000))
+        assert_that(histogram.percentile(50), close_to(50000, 50000 * 0.04))
+        assert_that(histogram.percentile(99), close_to(99000, 99000 * 0.04))
+        assert_that(histogram.percentile(100), equal_to(100000))
+
+    def testTooHighLatenciesAreClamped(self):
+        histogram = tracing.LatencyHistogram(highest_latency=1.0)
+        histogram.record(5.0)
+        assert_that(histogram.max, equal_to(1000000))
+
+
+class TracerTest(unittest.TestCase):
+
+    def testDisabledTracerDoesNotTrace(self):
+        assert_that(tracing.Tracer().start(), none())
+
+    def testStagesAreMeasured(self):
+        tracer = tracing.Tracer(ring_size=4, enabled=True)
+        for i in range(6):
+            trace = tracer.start()
+            trace.timestamps = [0.0, 0.001, 0.002, 0.004, 0.005, 0.006, 0.016]
+            tracer.record(trace)
+        snapshot = tracer.snapshot(include_traces=True)
+        assert_that(snapshot['traces_recorded'], equal_to(6))
+        assert_that(snapshot['traces'], has_length(4))
+        assert_that(snapshot['stages']['acknowledge']['count'], equal_to(6))
+        assert_that(snapshot['stages']['acknowledge']['mean'], close_to(10000, 400))
+        assert_that(snapshot['stages']['total']['max'], close_to(16000, 1))
+
+    def testIncompleteTracesOnlyCountKnownStages(self):
+        tracer = tracing.Tracer(enabled=True)
+        trace = tracer.start()
+        trace.stamp(tracing.DECODED)
+        tracer.record(trace)
+        snapshot = tracer.snapshot()
+        assert_that(snapshot['stages']['decode']['count'], equal_to(1))
+        assert_that(snapshot['stages']['total']['count'], equal_to(0))
+
+
+class MoveSamplerTest(unittest.TestCase):
+
+    def testEveryNthMoveIsSampled(self):
+        sampler = tracing.MoveSampler(interval=10, ring_size=3)
+        for i in range(1, 101):
+            if sampler.sample():
+                sampler.record(i)
+        assert_that(sampler.samples(), equal_to([80, 90, 100]))
+
+    def testSamplingCanBeSwitchedOff(self):
+        sampler = tracing.MoveSampler(interval=0)
+        assert_that(any(sampler.sample() for i in range(100)), equal_to(False))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(LatencyHistogramTest))
+    suite.addTest(loader.loadTestsFromTestCase(TracerTest))
+    suite.addTest(loader.loadTestsFromTestCase(MoveSamplerTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+import tempfile
+from t_bone.gcode_index import build_index, write_index
+from t_bone.print_analyzer import ANALYSIS_SUFFIX
+from t_bone.upload_directory import UploadDirectory, LISTING_FOLDER
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+_gcode = "G1 Z0.2\nG1 X10 Y10 E1\n"
+
+
+class UploadDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for number in range(5):
+            self._write("print_%s.gcode" % number)
+        self._write("notes.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testPagedListing(self):
+        upload_directory = UploadDirectory(self.directory)
+        files, total = upload_directory.files(offset=2, limit=2)
+        assert_that(total, equal_to(5))
+        assert_that([entry['name'] for entry in files], equal_to(["print_2.gcode", "print_3.gcode"]))
+        assert_that(files[0]['size'], equal_to(len(_gcode)))
+        # new files show up
+        self._write("print_5.gcode")
+        files, total = upload_directory.files(offset=4)
+        assert_that(total, equal_to(6))
+        assert_that([entry['name'] for entry in files], equal_to(["print_4.gcode", "print_5.gcode"]))
+
+    def testIndexAndAnalysisAreListed(self):
+        upload_directory = UploadDirectory(self.directory)
+        files, total = upload_directory.files(limit=1)
+        assert_that(files[0]['lines'], none())
+        path = os.path.join(self.directory, "print_0.gcode")
+        index_dict = build_index(path)
+        index_dict['sha1'] = 'abc'
+        write_index(path, index_dict)
+        stat = os.stat(path)
+        with open(path + ANALYSIS_SUFFIX, 'w') as analysis_file:
+            json.dump({'status': 'done', 'duration': 42.0, 'signature': [stat.st_size, stat.st_mtime, 'config']},
+                      analysis_file)
+        files, total = upload_directory.files(limit=1)
+        assert_that(files[0]['lines'], equal_to(2))
+        assert_that(files[0]['sha1'], equal_to('abc'))
+        assert_that(files[0]['print_time'], equal_to(42.0))
+
+    def testListingIsStored(self):
+        UploadDirectory(self.directory).files()
+        assert_that(os.listdir(os.path.join(self.directory, LISTING_FOLDER)), has_item("listing.json"))
+        # nothing changed - so the stored listing is good
+        upload_directory = UploadDirectory(self.directory)
+        assert_that(upload_directory._mtime, equal_to(os.stat(self.directory).st_mtime))
+        files, total = upload_directory.files(sort='mtime')
+        assert_that(total, equal_to(5))
+
+    def _write(self, name):
+        with open(os.path.join(self.directory, name), 'w') as new_file:
+            new_file.write(_gcode)
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(UploadDirectoryTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from threading import Thread
+from t_bone.gcode_index import read_index
+from t_bone.upload import UploadManager, UploadReader, UploadError, PARTIAL_SUFFIX
+from hamcrest import *
+
+__author__ = 'marcus'
+import unittest
+
+_gcode = "\n".join(["G92 E0", "G1 Z0.2 F600"] + ["G1 X%s Y%s E%s" % (i, i % 7, i * 0.1) for i in range(1, 500)])
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manager = UploadManager(self.directory, chunk_size=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testStreamedUpload(self):
+        upload = self.manager.start("print.gcode")
+        # werkzeug writes the upload line by line
+        for line in StringIO(_gcode):
+            upload.write(line)
+        # the last chunk stays in memory until the upload is finished
+        assert_that(upload.bytes_written, greater_than(0))
+        assert_that(upload.bytes_written, less_than(len(_gcode)))
+        assert_that(os.path.exists(upload.partial_path), equal_to(True))
+        content_hash = self.manager.finish(upload)
+        assert_that(content_hash, equal_to(hashlib.sha1(_gcode).hexdigest()))
+        path = os.path.join(self.directory, "print.gcode")
+        with open(path) as uploaded_file:
+            assert_that(uploaded_file.read(), equal_to(_gcode))
+        assert_that(os.path.exists(path + PARTIAL_SUFFIX), equal_to(False))
+        # the index got built on the way
+        index = read_index(path)
+        assert_that(index.line_count, equal_to(501))
+        assert_that(index.sha1, equal_to(content_hash))
+        assert_that(index.extrusion, close_to(49.9, 0.0001))
+
+    def testDuplicatesAreLinked(self):
+        upload = self.manager.start("first.gcode")
+        upload.copy_from(StringIO(_gcode))
+        self.manager.finish(upload)
+        # a new manager finds the hashes in the indexes
+        manager = UploadManager(self.directory)
+        upload = manager.start("second.gcode")
+        upload.copy_from(StringIO(_gcode), len(_gcode))
+        manager.finish(upload)
+        first = os.stat(os.path.join(self.directory, "first.gcode"))
+        second = os.stat(os.path.join(self.directory, "second.gcode"))
+        assert_that(second.st_ino, equal_to(first.st_ino))
+        assert_that(read_index(os.path.join(self.directory, "second.gcode")), not_none())
+
+    def testAbort(self):
+        upload = self.manager.start("broken.gcode")
+        upload.write(_gcode[:5000])
+        self.manager.abort(upload)
+        assert_that(os.listdir(self.directory), empty())
+        assert_that(self.manager.uploads, empty())
+
+    def testOneUploadPerFile(self):
+        upload = self.manager.start("twice.gcode")
+        assert_that(calling(self.manager.start).with_args("twice.gcode"), raises(UploadError))
+        upload.copy_from(StringIO(_gcode))
+        self.manager.finish(upload)
+        # once it is finished it can be uploaded again
+        upload = self.manager.start("twice.gcode")
+        self.manager.abort(upload)
+
+    def testReadWhileUploading(self):
+        upload = self.manager.start("growing.gcode")
+        reader = UploadReader(upload)
+        lines = []
+        offsets = []
+
+        def read_upload():
+            for line in reader:
+                # the reader never got ahead of the upload
+                offsets.append(reader.offset <= upload.bytes_written)
+                lines.append(line)
+
+        reader_thread = Thread(target=read_upload)
+        reader_thread.start()
+        for line in StringIO(_gcode):
+            upload.write(line)
+        # nothing is lost when the file gets renamed under the reader
+        self.manager.finish(upload)
+        reader_thread.join(5)
+        assert_that(reader_thread.isAlive(), equal_to(False))
+        assert_that("".join(lines), equal_to(_gcode))
+        assert_that(len(lines), equal_to(501))
+        assert_that(all(offsets), equal_to(True))
+
+    def testReadAbortedUpload(self):
+        upload = self.manager.start("broken.gcode")
+        upload.write(_gcode[:1500])
+        reader = iter(UploadReader(upload))
+        assert_that(reader.next(), equal_to("G92 E0\n"))
+        self.manager.abort(upload)
+        assert_that(calling(list).with_args(reader), raises(UploadError))
+
+
+def suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(UploadTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())